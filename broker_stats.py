@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import re
+import subprocess
+import threading
+import time
+
+# docker stats redraws the terminal between two rounds of samples
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+SIZE_UNITS = {'B': 1, 'kB': 10 ** 3, 'KB': 10 ** 3, 'MB': 10 ** 6, 'GB': 10 ** 9,
+              'KiB': 2 ** 10, 'MiB': 2 ** 20, 'GiB': 2 ** 30}
+
+
+def parse_size(value):
+    """'12.5MiB' -> bytes"""
+    match = re.match(r'([\d.]+)\s*([A-Za-z]+)', value.strip())
+    if match is None:
+        return 0.0
+    return float(match.group(1)) * SIZE_UNITS.get(match.group(2), 1)
+
+
+class BrokerStats(threading.Thread):
+    """Samples the CPU and memory of some containers (about once a second) with
+    docker stats while an experiment runs. CPU is in % of one core, as docker
+    reports it. The raw samples are also written to log_path, if given"""
+
+    def __init__(self, containers, log_path=None):
+        super(BrokerStats, self).__init__(daemon=True)
+        self.containers = list(containers)
+        self.log_path = log_path
+        # container -> [(time, cpu %, memory bytes)]
+        self.samples = {name: [] for name in self.containers}
+        self._process = None
+
+    def run(self):
+        cmd = ['docker', 'stats', '--format', '{{.Name}},{{.CPUPerc}},{{.MemUsage}}'] + self.containers
+        self._process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                         universal_newlines=True)
+        log = open(self.log_path, 'w') if self.log_path else None
+        try:
+            for line in self._process.stdout:
+                line = ANSI_ESCAPE.sub('', line).strip()
+                fields = line.split(',')
+                if len(fields) != 3 or fields[0] not in self.samples:
+                    continue
+                now = time.time()
+                try:
+                    cpu = float(fields[1].rstrip('%'))
+                except ValueError:
+                    continue
+                self.samples[fields[0]].append((now, cpu, parse_size(fields[2].split('/')[0])))
+                if log:
+                    log.write('{:.3f},{}\n'.format(now, line))
+        finally:
+            if log:
+                log.close()
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+        self.join(5)
+
+    def summary(self, start=None, end=None):
+        """Per container: samples, mean and max CPU %, the CPU seconds used over
+        [start, end] (mean CPU x length, all the samples if not given) and the
+        mean and maximum memory in MB"""
+        result = {}
+        for name, samples in self.samples.items():
+            selected = [sample for sample in samples
+                        if (start is None or sample[0] >= start) and (end is None or sample[0] <= end)]
+            row = {'samples': len(selected), 'cpu_mean': 0.0, 'cpu_max': 0.0, 'cpu_seconds': 0.0, 'mem_mean': 0.0,
+                   'mem_max': 0.0}
+            if selected:
+                row['cpu_mean'] = sum(sample[1] for sample in selected) / len(selected)
+                row['cpu_max'] = max(sample[1] for sample in selected)
+                length = (end or selected[-1][0]) - (start or selected[0][0])
+                row['cpu_seconds'] = row['cpu_mean'] / 100.0 * length
+                row['mem_mean'] = sum(sample[2] for sample in selected) / len(selected) / 10 ** 6
+                row['mem_max'] = max(sample[2] for sample in selected) / 10 ** 6
+            result[name] = row
+        return result
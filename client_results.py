@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import json
+import os
+import subprocess
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clients', 'alpine_container'))
+from hdr_histogram import HdrHistogram
+
+# Fields of the --brief line of container_python.py
+BRIEF_SUB_THROUGHPUT = 5
+BRIEF_PUB_THROUGHPUT = 9
+BRIEF_RECEIVED = 15
+BRIEF_PUBLISHED = 16
+# Delivery verification totals of the subscribers, see delivery.py
+BRIEF_MISSING = 17
+BRIEF_DUPLICATES = 18
+BRIEF_REORDERED = 19
+# 1 when the load generator was the bottleneck of the run, see health.py
+BRIEF_GENERATOR_BOUND = 20
+
+
+def parse_brief(output):
+    """The fields of the last --brief line of container_python.py, None if it did not print one"""
+    for line in reversed(output.splitlines()):
+        fields = line.strip().split(';')
+        if len(fields) > BRIEF_PUBLISHED:
+            return fields
+    return None
+
+
+def generator_bound(fields):
+    """Whether the --brief fields flag the run as limited by the load generator"""
+    return fields is not None and len(fields) > BRIEF_GENERATOR_BOUND and fields[BRIEF_GENERATOR_BOUND] == '1'
+
+
+class SummaryFile(object):
+    """summary.csv of an experiment, written row by row. The rows of the runs the
+    load generator limited measure our clients, not the brokers: they go to
+    generator_bound.csv instead, so they never reach a comparison"""
+
+    def __init__(self, path, header):
+        self.header = header
+        self.rows = []
+        self.excluded = []
+        self._files = {}
+        for kind in ['summary', 'generator_bound']:
+            self._files[kind] = open(os.path.join(path, '{}.csv'.format(kind)), 'w')
+            self._files[kind].write(header + '\n')
+
+    def add(self, row, bound=False):
+        (self.excluded if bound else self.rows).append(row)
+        f = self._files['generator_bound' if bound else 'summary']
+        f.write(';'.join(str(value) for value in row) + '\n')
+        f.flush()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+    def show(self):
+        print()
+        print(self.header.replace(';', '\t'))
+        for row in self.rows:
+            print('\t'.join(str(value) for value in row))
+        if self.excluded:
+            print('{} runs limited by the load generator left out, see generator_bound.csv:'.format(
+                len(self.excluded)))
+            for row in self.excluded:
+                print('\t'.join(str(value) for value in row))
+
+
+def fetch_json(container, description, kind, broker_octet='100'):
+    """A report (kind: hist, delivery, retained, kernel, health) a container_python.py run saved in a container, None if missing"""
+    cmd = ['docker', 'exec', container, 'cat', '/home/logs/{}_{}_{}.json'.format(description, kind, broker_octet)]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return json.loads(result.stdout)
+
+
+def fetch_histogram(container, description, broker_octet='100'):
+    """The e2e delay histogram a container_python.py run saved in a container, None if missing"""
+    histogram = fetch_json(container, description, 'hist', broker_octet)
+    return HdrHistogram.from_dict(histogram) if histogram is not None else None
+
+
+def merge_histograms(histograms):
+    """The merge of the histograms that are not None, None if all of them are"""
+    merged = None
+    for histogram in histograms:
+        if histogram is None:
+            continue
+        if merged is None:
+            merged = histogram
+        else:
+            merged.merge(histogram)
+    return merged
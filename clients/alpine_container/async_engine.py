@@ -0,0 +1,121 @@
+import asyncio
+import socket
+import struct
+
+import paho.mqtt.client as mqtt
+
+import kernel_time
+
+
+class LoopClient(kernel_time.TimestampedClient):
+    """paho client whose TCP connection is opened by the event loop.
+    paho's own connect() blocks on socket.create_connection; with thousands of
+    clients per process we open the socket with loop.sock_connect and hand it
+    over, so the connects proceed concurrently.
+    on_pubrec(client, userdata, mid) is called when the PUBREC of a QoS 2 message
+    arrives, paho has no callback for the intermediate steps of the handshake.
+    With kernel_timestamps the socket carries the kernel receive times, see
+    kernel_time.TimestampedClient"""
+
+    def __init__(self, *args, **kwargs):
+        super(LoopClient, self).__init__(*args, **kwargs)
+        self._loop_sock = None
+        self.on_pubrec = None
+
+    def _create_socket_connection(self):
+        sock, self._loop_sock = self._loop_sock, None
+        if sock is None:
+            return super(LoopClient, self)._create_socket_connection()
+        return sock
+
+    def _handle_pubrec(self):
+        if self.on_pubrec is not None and self._in_packet['remaining_length'] >= 2:
+            mid, = struct.unpack('!H', self._in_packet['packet'][:2])
+            self.on_pubrec(self, self._userdata, mid)
+        return super(LoopClient, self)._handle_pubrec()
+
+
+class AsyncioHelper(object):
+    """Drives the network I/O of a single paho client from an asyncio loop,
+    replacing the network thread started by loop_start()"""
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        if self.misc is None:
+            self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        # Keepalive pings and retries, what loop_forever() does once per second
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class Engine(object):
+    """Multiplexes many MQTT sessions on one asyncio event loop.
+    A session is any object with an ``async run_async(engine)`` method"""
+
+    def __init__(self):
+        self.loop = None
+
+    def create_client(self, client_id: str = '', clean_session: bool = True,
+                      kernel_timestamps: bool = False) -> LoopClient:
+        client = LoopClient(client_id=client_id, clean_session=clean_session)
+        client.kernel_timestamps = kernel_timestamps
+        AsyncioHelper(self.loop, client)
+        return client
+
+    async def connect(self, client: LoopClient, hostname: str, port: int = 1883, keepalive: int = 60):
+        """Opens the TCP connection without blocking the loop and sends CONNECT.
+        The CONNACK is delivered as usual through client.on_connect"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await self.loop.sock_connect(sock, (hostname, port))
+        except OSError:
+            sock.close()
+            raise
+        # Latency benchmark: do not let Nagle hold back small publishes
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if client.kernel_timestamps:
+            kernel_time.enable(sock)
+        client._loop_sock = sock
+        client.connect(hostname, port=port, keepalive=keepalive)
+
+    async def _run(self, sessions, background=()):
+        self.loop = asyncio.get_running_loop()
+        helpers = [self.loop.create_task(session.run_async(self)) for session in background]
+        tasks = [self.loop.create_task(session.run_async(self)) for session in sessions]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for helper in helpers:
+            helper.cancel()
+        return results
+
+    def run(self, sessions, background=()):
+        """Runs all the sessions until completion and returns their results
+        (or the exception each failed session raised). The background sessions,
+        e.g. progress reporting, are cancelled once the others completed"""
+        return asyncio.run(self._run(sessions, background))
@@ -0,0 +1,48 @@
+import argparse
+import datetime
+import timeit
+
+from container_python import Pub, decode_msg, parse_msg
+from payload import unpack_header
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Encode and decode cost of the text and binary payloads')
+    parser.add_argument('-n', '--number', dest='number', default=200000,
+                        help='decodes per measurement', type=int)
+    parser.add_argument('-s', '--msg-size', dest='msg_size', default=1024,
+                        help='payload size in bytes', type=int)
+    return parser.parse_args()
+
+
+def sample_pub(payload_format):
+    pub = Pub('10.0.1.100', 'test', client_id='pub3', msg_size=args.msg_size, qos=1,
+              payload_format=payload_format)
+    pub.connect_init = pub.connect_accomplish = datetime.datetime.utcnow()
+    return pub
+
+
+def sample_payload(payload_format):
+    return bytes(sample_pub(payload_format).create_msg())
+
+
+def measure(label, func, payload):
+    best = min(timeit.repeat(lambda: func(payload), number=args.number, repeat=3))
+    print('{:<40} {:>10.0f} ns/msg'.format(label, best / args.number * 1e9))
+
+
+def main():
+    for payload_format in ['text', 'binary']:
+        pub = sample_pub(payload_format)
+        measure('create_msg ({}, {} B)'.format(payload_format, args.msg_size), lambda p: p.create_msg(), pub)
+    text = sample_payload('text')
+    binary = sample_payload('binary')
+    measure('text: decode + split + strptime', lambda p: parse_msg(p.decode('utf-8')), text)
+    measure('binary: struct unpack_from', unpack_header, binary)
+    measure('decode_msg (text, on_message path)', decode_msg, text)
+    measure('decode_msg (binary, on_message path)', decode_msg, binary)
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
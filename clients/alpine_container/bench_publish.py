@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+from async_engine import Engine
+from container_python import Pub, WorkerReport
+from fast_mqtt import CONNACK, CONNECT, PINGREQ, PINGRESP, PUBACK, PUBLISH, UINT16, read_packets
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Publish rate per core of paho and of the fast path (fast_mqtt.py)')
+    parser.add_argument('-n', '--number', dest='number', default=200000,
+                        help='messages per publisher', type=int)
+    parser.add_argument('-s', '--msg-size', dest='msg_size', default=1024,
+                        help='payload size in bytes', type=int)
+    parser.add_argument('-q', '--qos', dest='qos', default=0, type=int, choices=[0, 1])
+    parser.add_argument('-p', '--publishers', dest='publishers', default=1, type=int,
+                        help='publishers on the event loop')
+    parser.add_argument('--batch', dest='batch', default='1,8,32,128',
+                        help='comma-separated messages per sendmsg of the fast path')
+    parser.add_argument('--max-inflight', dest='max_inflight', default=100, type=int)
+    parser.add_argument('--hostname', dest='hostname', default=None,
+                        help='broker to publish to, by default a local sink that acknowledges and drops the messages')
+    parser.add_argument('--port', dest='port', default=1883, type=int)
+    return parser.parse_args()
+
+
+async def sink_session(reader, writer):
+    """Answers CONNECT, PUBLISH QoS 1 and PINGREQ, drops everything else"""
+    buffer = bytearray()
+    while True:
+        data = await reader.read(1 << 20)
+        if not data:
+            break
+        buffer += data
+        replies = []
+        for header, body in read_packets(buffer):
+            kind = header & 0xf0
+            if kind == CONNECT:
+                replies.append(bytes([CONNACK, 2, 0, 0]))
+            elif kind == PUBLISH and header & 0x06:
+                topic_length = UINT16.unpack_from(body)[0]
+                replies.append(bytes([PUBACK, 2]) + body[2 + topic_length:4 + topic_length])
+            elif kind == PINGREQ[0]:
+                replies.append(PINGRESP)
+        if replies:
+            writer.write(b''.join(replies))
+    writer.close()
+
+
+def run_sink(port: int, ready):
+    async def serve():
+        server = await asyncio.start_server(sink_session, '127.0.0.1', port)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+    asyncio.run(serve())
+
+
+def measure(label, fast_batch, hostname, port):
+    report = WorkerReport(0, None)
+    pubs = []
+    for i in range(args.publishers):
+        pub = Pub(hostname, 'bench/%s' % i, port=port, client_id='pub%s' % i, max_count=args.number,
+                  msg_size=args.msg_size, qos=args.qos, max_inflight=args.max_inflight)
+        pub.report = report
+        pub.fast_batch = fast_batch
+        pubs.append(pub)
+    wall, cpu = time.perf_counter(), time.process_time()
+    for result in Engine().run(pubs):
+        if isinstance(result, BaseException):
+            raise result
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    # The CPU time of this process only: the rate one core of a pub container sustains
+    print('{:<24} {:>12.0f} msg/s per core {:>12.0f} msg/s {:>8.2f} us/msg'.format(
+        label, report.published / cpu, report.published / wall, cpu / report.published * 1e6))
+
+
+def main():
+    hostname, port, sink = args.hostname, args.port, None
+    if hostname is None:
+        hostname, ready = '127.0.0.1', multiprocessing.Event()
+        sink = multiprocessing.Process(target=run_sink, args=(port, ready), daemon=True)
+        sink.start()
+        ready.wait()
+    print('{} publishers, {} messages each, QoS {}, {} B'.format(args.publishers, args.number, args.qos,
+                                                                 args.msg_size))
+    measure('paho', 0, hostname, port)
+    for batch in [int(batch) for batch in args.batch.split(',')]:
+        measure('fast, batch {}'.format(batch), batch, hostname, port)
+    if sink is not None:
+        sink.terminate()
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import multiprocessing
+import socket
+import struct
+import threading
+import time
+
+DEFAULT_PORT = 12300
+# Probe: client send time. Reply: client send time, server receive and send time (ns)
+PROBE = struct.Struct('!q')
+REPLY = struct.Struct('!qqq')
+UNKNOWN_ERROR = -1
+
+
+def serve(port: int = DEFAULT_PORT, host: str = '0.0.0.0'):
+    """Reference time server: answers every probe with its receive and send time.
+    Run it once, e.g. on the Containernet host, and point all the clients to it"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    print('Clock reference listening on %s:%s' % (host, port))
+    while True:
+        data, address = sock.recvfrom(PROBE.size)
+        received = time.time_ns()
+        if len(data) != PROBE.size:
+            continue
+        sock.sendto(REPLY.pack(PROBE.unpack(data)[0], received, time.time_ns()), address)
+
+
+class SharedOffset(object):
+    """The latest clock estimate of the host, readable by the worker processes.
+    Written by a single thread; a reader may pair the offset of one estimate with
+    the error of the next one, which is harmless"""
+
+    def __init__(self):
+        self.values = multiprocessing.RawArray('q', [0, UNKNOWN_ERROR])
+
+    def set(self, offset_ns: int, error_ns: int):
+        self.values[0] = offset_ns
+        self.values[1] = error_ns
+
+    def get(self) -> tuple:
+        """:return: (offset_ns, error_ns), local time + offset = reference time, error -1 if never synced"""
+        return self.values[0], self.values[1]
+
+
+class ClockSync(threading.Thread):
+    """Estimates the offset of the local clock to a reference server (NTP-style).
+    Each estimate sends samples probes and keeps the one with the smallest round
+    trip: its offset is exact within +-rtt/2 whatever the path asymmetry, so that
+    bound is stored as the error. Re-estimated every interval seconds to follow
+    the drift of the clocks during the run"""
+
+    def __init__(self, server: str, port: int = DEFAULT_PORT, interval: float = 10.0, samples: int = 8,
+                 timeout: float = 1.0, shared: SharedOffset = None):
+        super(ClockSync, self).__init__(daemon=True)
+        self.server = server
+        self.port = port
+        self.interval = interval
+        self.samples = samples
+        self.timeout = timeout
+        self.shared = shared or SharedOffset()
+        self.estimates = []
+        self._halt = threading.Event()
+
+    def probe(self, sock) -> tuple:
+        """:return: (offset_ns, rtt_ns) of one exchange, None if it got lost"""
+        t0 = time.time_ns()
+        try:
+            sock.send(PROBE.pack(t0))
+            while True:
+                data = sock.recv(REPLY.size)
+                t3 = time.time_ns()
+                echo, t1, t2 = REPLY.unpack(data)
+                # Otherwise a late reply to an earlier, timed out probe
+                if echo == t0:
+                    return ((t1 - t0) + (t2 - t3)) // 2, (t3 - t0) - (t2 - t1)
+        except OSError:
+            # Timed out, or refused: nobody listening on the server
+            return None
+
+    def estimate(self) -> tuple:
+        """:return: (offset_ns, error_ns) of the best probe, None if all of them got lost"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect((self.server, self.port))
+            probes = [self.probe(sock) for _ in range(self.samples)]
+        finally:
+            sock.close()
+        probes = [probe for probe in probes if probe is not None]
+        if not probes:
+            return None
+        offset, rtt = min(probes, key=lambda probe: probe[1])
+        return offset, rtt // 2
+
+    def sync(self) -> bool:
+        result = self.estimate()
+        if result is None:
+            print('Clock reference %s:%s did not answer' % (self.server, self.port))
+            return False
+        self.shared.set(*result)
+        self.estimates.append((time.monotonic(), result[0], result[1]))
+        return True
+
+    def drift(self) -> float:
+        """Drift of the local clock to the reference (ppm) between the first and the last estimate"""
+        if len(self.estimates) < 2:
+            return 0.0
+        (start, first, _), (end, last, _) = self.estimates[0], self.estimates[-1]
+        return (last - first) / ((end - start) * 1e9) * 1e6
+
+    def stop(self):
+        self._halt.set()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            self.sync()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Clock reference server and offset probe')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    server = subparsers.add_parser('serve', help='answer the probes of the clients')
+    server.add_argument('-p', '--port', dest='port', default=DEFAULT_PORT, type=int)
+    probe = subparsers.add_parser('probe', help='print the offset of this host to a reference')
+    probe.add_argument('server', help='address of the reference server')
+    probe.add_argument('-p', '--port', dest='port', default=DEFAULT_PORT, type=int)
+    probe.add_argument('-s', '--samples', dest='samples', default=8, type=int)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.port)
+    else:
+        result = ClockSync(args.server, args.port, samples=args.samples).estimate()
+        if result is None:
+            print('No answer from %s:%s' % (args.server, args.port))
+        else:
+            print('offset {:+.1f} us, error +-{:.1f} us'.format(result[0] / 1e3, result[1] / 1e3))
+
+
+if __name__ == '__main__':
+    main()
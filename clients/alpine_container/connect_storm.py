@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import time
+
+import numpy
+import paho.mqtt.client as mqtt
+
+from async_engine import Engine
+from container_python import cpuset_size, is_positive, set_value, shard_clients
+
+# Lead time given to the workers to start before the first connection is due (s)
+START_LEAD = 1.0
+
+
+class StormClient(object):
+    """One client of the storm: in every round it connects at its slot of the
+    schedule, holds the connection until the end of the round and drops it, so
+    all the clients reconnect together in the next round.
+    The results are (round, broker, start_ns, tcp_ns, connack_ns, error) tuples,
+    error is None for an accepted connection"""
+
+    def __init__(self, hostname: str, client_id: str, port: int = 1883, offset: float = 0.0, rounds: int = 1,
+                 round_length: float = 0.0, timeout: float = 30.0, persistent: bool = False, abrupt: bool = False,
+                 auth=None):
+        self.hostname = hostname
+        self.client_id = client_id
+        self.port = port
+        # Seconds after the start of each round this client connects at
+        self.offset = offset
+        self.rounds = rounds
+        self.round_length = round_length
+        self.timeout = timeout
+        self.persistent = persistent
+        self.abrupt = abrupt
+        self.auth = auth
+        # Wall clock time of the first round, set by the parent for all the workers
+        self.start_at = None
+        self.results = []
+        self._connack = None
+        self._rc = None
+
+    def on_connect(self, client, userdata, flags, rc):
+        self._rc = rc
+        self._connack.set()
+
+    async def sleep_until(self, wall_time: float):
+        await asyncio.sleep(max(wall_time - time.time(), 0))
+
+    async def connect_once(self, engine, round_ind: int):
+        client = engine.create_client(client_id=self.client_id, clean_session=not self.persistent)
+        if self.auth:
+            client.username_pw_set(**self.auth)
+        client.on_connect = self.on_connect
+        self._connack = asyncio.Event()
+        self._rc = None
+        _start = time.time_ns()
+        _tcp = None
+        try:
+            await asyncio.wait_for(engine.connect(client, self.hostname, port=self.port), self.timeout)
+            _tcp = time.time_ns()
+            await asyncio.wait_for(self._connack.wait(), self.timeout - (_tcp - _start) / 1e9)
+        except asyncio.TimeoutError:
+            self.results.append((round_ind, self.hostname, _start, _tcp, None, 'timeout'))
+            return client
+        except OSError as err:
+            self.results.append((round_ind, self.hostname, _start, _tcp, None, err.__class__.__name__))
+            return client
+        _connack = time.time_ns()
+        self.results.append((round_ind, self.hostname, _start, _tcp, _connack,
+                             None if self._rc == 0 else mqtt.connack_string(self._rc)))
+        return client
+
+    def drop(self, client):
+        if client.socket() is None:
+            return
+        if self.abrupt:
+            # Like a network failure: no DISCONNECT, the broker finds out from the socket
+            client._sock_close()
+        else:
+            client.disconnect()
+
+    async def run_async(self, engine):
+        for round_ind in range(self.rounds):
+            round_start = self.start_at + round_ind * self.round_length
+            await self.sleep_until(round_start + self.offset)
+            client = await self.connect_once(engine, round_ind)
+            await self.sleep_until(round_start + self.round_length)
+            self.drop(client)
+
+
+def run_storm_worker(worker_id: int, clients: list, channel):
+    """Worker process: runs its slice of the storm on one asyncio event loop"""
+    results = []
+    for client, result in zip(clients, Engine().run(clients)):
+        if isinstance(result, BaseException):
+            print('Client %s failed: %s' % (client.client_id, result))
+        results.extend(client.results)
+    channel.put(('done', worker_id, results))
+
+
+def summarize(results: list, brokers: list, rounds: int) -> list:
+    """One row per round and broker: attempts, accepted, failed, accepted connections/s
+    (over the time from the first CONNECT to the last CONNACK) and the percentiles of the
+    TCP connect and CONNECT->CONNACK latencies (ms)"""
+    rows = []
+    for round_ind in range(rounds):
+        for broker in brokers:
+            selected = [res for res in results if res[0] == round_ind and res[1] == broker]
+            accepted = [res for res in selected if res[5] is None]
+            row = {'round': round_ind, 'broker': broker, 'attempts': len(selected), 'accepted': len(accepted),
+                   'failed': len(selected) - len(accepted), 'rate': 0.0}
+            if accepted:
+                span = (max(res[4] for res in accepted) - min(res[2] for res in selected)) / 1e9
+                row['rate'] = len(accepted) / span if span > 0 else 0.0
+                tcp = numpy.array([res[3] - res[2] for res in accepted]) / 1e6
+                connack = numpy.array([res[4] - res[3] for res in accepted]) / 1e6
+                for name, values in [('tcp', tcp), ('connack', connack)]:
+                    for percentile in [50, 99]:
+                        row['%s_p%s' % (name, percentile)] = numpy.percentile(values, percentile)
+                    row['%s_max' % name] = values.max()
+            errors = {}
+            for res in selected:
+                if res[5] is not None:
+                    errors[res[5]] = errors.get(res[5], 0) + 1
+            row['errors'] = errors
+            rows.append(row)
+    return rows
+
+
+def write_results(path: str, results: list):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('round;broker;connect_start_ns;tcp_connected_ns;connack_ns;error\n')
+        for res in sorted(results, key=lambda res: (res[0], res[2])):
+            f.write('%s;%s;%s;%s;%s;%s\n' % tuple('' if value is None else value for value in res))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CONNECT/CONNACK storm against one or more brokers')
+    parser.add_argument('--hostname', help='The brokers to connect to, comma separated. '
+                                           'The clients are spread evenly across them')
+    parser.add_argument('--port', type=int, help='The port of the brokers. The default is 1883')
+    parser.add_argument('--connections', type=int, help='The number of clients of the storm (default 1000)')
+    parser.add_argument('--rate', type=float,
+                        help='Connections per second opened by the storm, 0 (default) opens all of them at once')
+    parser.add_argument('--rounds', type=int,
+                        help='How many times all the clients connect. From the second round on it is a '
+                             'reconnection storm. The default is 1')
+    parser.add_argument('--hold', type=float,
+                        help='Seconds the connections are held once the whole round has connected '
+                             '(default 5)')
+    parser.add_argument('--timeout', type=float, help='Seconds a client waits for its CONNACK (default 30)')
+    parser.add_argument('--persistent', action='store_true',
+                        help='Connect with clean session off, the brokers resume the session of every '
+                             'client at each reconnection')
+    parser.add_argument('--abrupt', action='store_true',
+                        help='End the rounds by closing the sockets without DISCONNECT, like a network failure')
+    parser.add_argument('--workers', type=int, help='The number of worker processes, by default one per core')
+    parser.add_argument('--username', help='The username to connect with')
+    parser.add_argument('--password', help='The password to connect with')
+    parser.add_argument('--description', help='Prefix of the result file <description>_storm_<broker>.csv')
+    parser.add_argument('--brief', action='store_true', help='One ; separated line per round and broker')
+    opts = parser.parse_args()
+
+    _hostname = getattr(opts, 'hostname') or os.getenv('CLIENT_HOSTNAME')
+    _port = set_value(getattr(opts, 'port'), os.getenv('CLIENT_PORT'), 1883, 'port')
+    _connections = set_value(getattr(opts, 'connections'), os.getenv('CLIENT_CONNECTIONS'), 1000,
+                             'number of connections')
+    _rate = float(getattr(opts, 'rate') or os.getenv('CLIENT_CONNECT_RATE') or 0)
+    _rounds = set_value(getattr(opts, 'rounds'), os.getenv('CLIENT_ROUNDS'), 1, 'number of rounds')
+    _hold = float(getattr(opts, 'hold') or os.getenv('CLIENT_HOLD') or 5)
+    _timeout = float(getattr(opts, 'timeout') or os.getenv('CLIENT_CONNECT_TIMEOUT') or 30)
+    _persistent = getattr(opts, 'persistent') or os.getenv('CLIENT_PERSISTENT') in ['1', 'true', 'True']
+    _abrupt = getattr(opts, 'abrupt') or os.getenv('CLIENT_ABRUPT') in ['1', 'true', 'True']
+    _workers = set_value(getattr(opts, 'workers'), os.getenv('CLIENT_WORKERS'), cpuset_size(), 'number of workers')
+    _description = getattr(opts, 'description') or os.getenv('DESCRIPTION') or ''
+    _brief = getattr(opts, 'brief')
+
+    if _hostname is None:
+        raise Exception('The hostname parameter is required')
+    is_positive(_connections, 'number of connections')
+    is_positive(_rate, 'connection rate')
+    if _rounds < 1:
+        raise Exception('The number of rounds must be at least 1')
+    if _workers < 1:
+        raise Exception('The number of workers must be at least 1')
+    if _timeout <= 0:
+        raise Exception('The connect timeout must be positive')
+
+    _auth = None
+    if opts.username or os.getenv('CLIENT_USERNAME'):
+        _auth = {'username': opts.username or os.getenv('CLIENT_USERNAME'),
+                 'password': opts.password or os.getenv('CLIENT_PASSWORD')}
+
+    brokers = _hostname.split(',')
+    # A round lasts the time to open all the connections, plus the slowest CONNACK, plus the hold
+    spread = _connections / _rate if _rate else 0.0
+    round_length = spread + _timeout + _hold
+    clients = []
+    for ind in range(_connections):
+        clients.append(StormClient(brokers[ind % len(brokers)], 'storm%d' % ind, port=_port,
+                                   offset=ind / _rate if _rate else 0.0, rounds=_rounds,
+                                   round_length=round_length, timeout=_timeout, persistent=_persistent,
+                                   abrupt=_abrupt, auth=_auth))
+    start_at = time.time() + START_LEAD
+    for client in clients:
+        client.start_at = start_at
+
+    channel = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_storm_worker, args=(_ind, _shard, channel))
+               for _ind, _shard in enumerate(shard_clients(clients, _workers))]
+    for worker in workers:
+        worker.start()
+    results = []
+    reported = 0
+    while reported < len(workers):
+        try:
+            _kind, _worker_id, data = channel.get(timeout=START_LEAD + _rounds * round_length + _timeout)
+        except queue.Empty:
+            print('Timed out waiting for the workers, %s of %s reported' % (reported, len(workers)))
+            break
+        results.extend(data)
+        reported += 1
+    for worker in workers:
+        worker.join(1)
+        if worker.is_alive():
+            worker.terminate()
+
+    write_results(os.path.join('/home/logs', '%s_storm_%s.csv' % (_description, brokers[0].split('.')[-1])),
+                  results)
+
+    for row in summarize(results, brokers, _rounds):
+        latency = [row.get(key, 0) for key in ['tcp_p50', 'tcp_p99', 'tcp_max',
+                                               'connack_p50', 'connack_p99', 'connack_max']]
+        if _brief:
+            print(';'.join(str(value) for value in [row['round'], row['broker'], row['attempts'], row['accepted'],
+                                                    row['failed'], row['rate']] + latency))
+            continue
+        print('Round %s, broker %s: %s/%s accepted, %s failed %s, %.1f connections/s'
+              % (row['round'], row['broker'], row['accepted'], row['attempts'], row['failed'],
+                 row['errors'] or '', row['rate']))
+        print('  TCP connect (ms): p50 %.2f, p99 %.2f, max %.2f' % tuple(latency[:3]))
+        print('  CONNECT->CONNACK (ms): p50 %.2f, p99 %.2f, max %.2f' % tuple(latency[3:]))
+
+
+if __name__ == '__main__':
+    main()
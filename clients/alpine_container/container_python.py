@@ -13,20 +13,34 @@
 # under the License.
 
 import argparse
+import asyncio
 import datetime
 import multiprocessing
+import queue
 import random
-import string
+import threading
 import time
 import os
 import json
+import zlib
 
 import numpy
 import paho.mqtt.client as mqtt
 
-SUB_QUEUE = multiprocessing.Queue()
-PUB_QUEUE = multiprocessing.Queue()
-LOG_QUEUE = multiprocessing.Queue()
+import e2e_records
+import topic_workload
+from async_engine import Engine
+from clock_sync import DEFAULT_PORT, ClockSync, SharedOffset
+from control import Controller, DrainGate, ProgressTicker, ReconnectTrigger, SharedProgress, StartGate
+from delivery import DeliveryTracker, merge_groups, print_report, save, total
+from fast_mqtt import FastConnection, publish_prefix
+from hdr_histogram import HdrHistogram
+from health import CPU_THRESHOLD, LAG_THRESHOLD, HealthMonitor, HealthStats, health_report
+from metrics import MetricsFile, MetricsServer, RollingHistogram
+from pacer import ARRIVALS, arrival_intervals
+from payload import HEADER_SIZE, PAYLOAD_FORMATS, PayloadPool, is_binary, pack_address, pack_header_into, \
+    patch_header_into, shared_pool, unpack_header
+from shm_ring import RecordRing
 
 JSON_CLUSTERS = 'clusters'
 JSON_TOPICS = 'topics'
@@ -34,8 +48,23 @@ JSON_SUBS = 'subs'
 JSON_PUBS = 'pubs'
 JSON_ALL = 'all'
 JSON_DEFAULT = 'default'
+JSON_GENERATE = 'generate'
+JSON_WILDCARDS = 'wildcards'
+JSON_RETAINED = 'retained'
+# Sections of a --multiple-topics file generating the clients: (key, validate, generate)
+JSON_GENERATED = [
+    (JSON_GENERATE, topic_workload.validate, topic_workload.generate),
+    (JSON_WILDCARDS, topic_workload.validate_wildcards, topic_workload.wildcard_workload),
+    (JSON_RETAINED, topic_workload.validate_retained, topic_workload.retained_workload),
+]
 
-nr_msg = 0
+LOG_FORMATS = ['csv', 'records']
+# QoS handshake steps timed by the publishers: PUBLISH->PUBACK (QoS 1),
+# PUBLISH->PUBREC and PUBREC->PUBCOMP (QoS 2)
+HANDSHAKE_STEPS = ['puback', 'pubrec', 'pubcomp']
+
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
 
 
 def get_item_from_json(json_obj, item, error_msg: str = None, exit_flag: bool = False,
@@ -72,6 +101,10 @@ class MultipleTopics(object):
         self.publishers = 0
         self.subscribers = 0
         self.json_file = None
+        # The generated sections only create the roles asked for on the command
+        # line, so subscribers and publishers can run in separate processes
+        self.generate_subs = bool(self.sub_clients)
+        self.generate_pubs = bool(self.pub_clients)
 
     def __call__(self, json_file):
         # The argument is the json file
@@ -95,20 +128,31 @@ class MultipleTopics(object):
         # print('The json obj')
         # print(json_obj)
         _ind = 0
-        clients = get_item_from_json(json_obj, JSON_CLUSTERS, exit_flag=True,
-                                          error_msg='The JSON format of the file not recognized')
+        _generated = [(key, validate) for key, validate, _generate in JSON_GENERATED if key in json_obj]
+        for key, validate in _generated:
+            # Generated topic space, the clusters become optional
+            _generate = validate(json_obj[key])
+            if self.generate_subs:
+                self.subscribers += _generate['subs']
+            if self.generate_pubs:
+                self.publishers += _generate['pubs']
+        if _generated:
+            clients = get_item_from_json(json_obj, JSON_CLUSTERS, default_value=[])
+        else:
+            clients = get_item_from_json(json_obj, JSON_CLUSTERS, exit_flag=True,
+                                         error_msg='The JSON format of the file not recognized')
         for group in clients:
             _ind = _ind + 1
-            topics = get_item_from_json(json_obj, JSON_TOPICS, exit_flag=True,
-                                             error_msg=f'Error: Something went wrong parsing (row {_ind})')
+            topics = get_item_from_json(group, JSON_TOPICS, exit_flag=True,
+                                        error_msg=f'Error: Something went wrong parsing (row {_ind})')
             # Initialize the subs and pubs parameter
             # try:
             #     nr_pubs = group[JSON_PUBS]
             # except KeyError:
             #     group[JSON_PUBS] = 0
             #     nr_pubs = 0
-            nr_pubs = get_item_from_json(json_obj, JSON_PUBS, default_value=0)
-            nr_subs = get_item_from_json(json_obj, JSON_SUBS, default_value=0)
+            nr_pubs = get_item_from_json(group, JSON_PUBS, default_value=0)
+            nr_subs = get_item_from_json(group, JSON_SUBS, default_value=0)
             # try:
             #     nr_subs = group[JSON_SUBS]
             # except KeyError:
@@ -146,8 +190,8 @@ class MultipleTopics(object):
     def exception(self, err=None):
         if err is not None:
             return argparse.ArgumentTypeError(err.msg)
-        if self.arg is not None:
-            return argparse.ArgumentError('The JSON file could not be located')
+        if self.json_file is not None:
+            return argparse.ArgumentTypeError('The JSON file %s could not be located' % self.json_file)
 
 
 def set_value(cmd_par, env_par, default: int, par_name: str) -> int:
@@ -173,7 +217,7 @@ def set_value(cmd_par, env_par, default: int, par_name: str) -> int:
             except ValueError:
                 raise Exception('The %s parameter must be of type integer' % par_name)
         if isinstance(env_par, int) or isinstance(cmd_par, int):
-            return cmd_par or env_par
+            return cmd_par if cmd_par is not None else env_par
         else:
             raise Exception('Unexpected parameter type')
 
@@ -184,32 +228,120 @@ def is_positive(param: int, param_name: str):
         raise Exception('The %s must be positive' % param_name)
 
 
-def initialize_log(hostname: str, dest_path: str = 'logs', file_name: str = None, prefix: str = ''):
+def initialize_log(hostname: str, dest_path: str = 'logs', file_name: str = None, prefix: str = '',
+                   log_format: str = 'csv'):
     octets = hostname.split('.')
     if len(octets) != 4:
         raise Exception('Hostname passed is invalid')
     if file_name is None:
-        file_name = prefix + '_log_' + octets[3] + '.csv'
+        file_name = prefix + '_log_' + octets[3] + ('.csv' if log_format == 'csv' else e2e_records.EXTENSION)
     output_path = os.path.join(dest_path, file_name)
+    if log_format == 'records':
+        e2e_records.create(output_path)
+        return output_path
     # Check if directory and file, else create it
     if not os.path.exists(output_path):
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
     # Writing the file header
     with open(output_path, 'w') as f:
         f.write('hostname_origin;pub_client_id;publish_connect_init;')
-        f.write('publish_connect_ack;publish_timestamp;publish_qos;')
-        f.write('hostname_destination;sub_client;arrival_timestamp;e2e_delay')
+        f.write('publish_connect_ack;publish_timestamp;publish_intended;publish_qos;')
+        f.write('hostname_destination;sub_client;arrival_timestamp;e2e_delay;clock_offset_ns;clock_error_ns;')
+        f.write('kernel_arrival_ns')
         f.write('\n')
         f.close()
     return output_path
 
 
-def write(log, data):
-    with open(log, 'a') as f:
-        for chunk in data:
-            f.write(chunk)
-            f.write('\n')
-        f.close()
+def histogram_path(hostname: str, dest_path: str = 'logs', prefix: str = '') -> str:
+    """The file of the merged e2e delay histogram, next to the log file"""
+    return os.path.join(dest_path, prefix + '_hist_' + hostname.split('.')[3] + '.json')
+
+
+def delivery_path(hostname: str, dest_path: str = 'logs', prefix: str = '') -> str:
+    """The file of the delivery verification report, next to the log file"""
+    return os.path.join(dest_path, prefix + '_delivery_' + hostname.split('.')[3] + '.json')
+
+
+def retained_path(hostname: str, dest_path: str = 'logs', prefix: str = '') -> str:
+    """The file of the retained messages summary, next to the log file"""
+    return os.path.join(dest_path, prefix + '_retained_' + hostname.split('.')[3] + '.json')
+
+
+def health_path(hostname: str, dest_path: str = 'logs', prefix: str = '') -> str:
+    """The file of the load generator self-health report, next to the log file"""
+    return os.path.join(dest_path, prefix + '_health_' + hostname.split('.')[3] + '.json')
+
+
+def kernel_path(hostname: str, dest_path: str = 'logs', prefix: str = '') -> str:
+    """The file of the kernel receive timestamps summary, next to the log file"""
+    return os.path.join(dest_path, prefix + '_kernel_' + hostname.split('.')[3] + '.json')
+
+
+LOG_FORMAT = '%s' + ';%s' * 13
+
+
+def format_record(record: tuple) -> str:
+    """Formats a log record (a tuple of the e2e_records.RECORD fields, timestamps in ns) as a row of the log
+    file. The timestamps are the raw ones of each host, the e2e delay is corrected by the clock offset.
+    The kernel arrival is left empty when unknown"""
+    init_ns, ack_ns, pub_ns, intended_ns, arrival_ns, _seq, pub_host, pub_id, sub_host, sub_id, pub_qos, \
+        clock_offset, clock_error, kernel_ns = record
+    return LOG_FORMAT % (e2e_records.int_to_host(pub_host), 'pub%d' % pub_id, ns_to_datetime(init_ns),
+                         ns_to_datetime(ack_ns), ns_to_datetime(pub_ns), ns_to_datetime(intended_ns), pub_qos,
+                         e2e_records.int_to_host(sub_host), 'sub%d' % sub_id, ns_to_datetime(arrival_ns),
+                         datetime.timedelta(microseconds=(arrival_ns + clock_offset - intended_ns) // 1000),
+                         clock_offset, clock_error, '' if kernel_ns == e2e_records.UNKNOWN else kernel_ns)
+
+
+class LogWriter(threading.Thread):
+    """Appends the records of the workers to the log file while the run is going
+    on. Every worker writes its records to its own ring in shared memory (see
+    shm_ring.RecordRing), the writer reads them in place: nothing is pickled nor
+    copied through a pipe, and a full ring makes its worker wait, so the memory
+    used for logging does not grow with the length of the run.
+    log_format csv writes text rows, records the fixed-width records of e2e_records"""
+
+    def __init__(self, log_file: str, rings: list, batch_size: int = 1000, poll_interval: float = 0.01,
+                 log_format: str = 'csv'):
+        super(LogWriter, self).__init__(daemon=True)
+        self.log_file = log_file
+        self.rings = rings
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.log_format = log_format
+        self.written = 0
+        self._halt = threading.Event()
+
+    def close(self):
+        """Writes what is left in the rings and stops, once the workers are done"""
+        self._halt.set()
+        self.join()
+
+    def drain(self, f) -> int:
+        records = self.log_format == 'records'
+        count = 0
+        for ring in self.rings:
+            for chunk in ring.peek(self.batch_size):
+                if records:
+                    f.write(chunk)
+                else:
+                    f.write('\n'.join(map(format_record, chunk.tolist())))
+                    f.write('\n')
+                ring.release(len(chunk))
+                count += len(chunk)
+        if count:
+            f.flush()
+            self.written += count
+        return count
+
+    def run(self):
+        with open(self.log_file, 'ab' if self.log_format == 'records' else 'a') as f:
+            while not self._halt.is_set():
+                if not self.drain(f):
+                    time.sleep(self.poll_interval)
+            while self.drain(f):
+                pass
 
 
 def parse_msg(msg):
@@ -217,40 +349,257 @@ def parse_msg(msg):
     if isinstance(msg, mqtt.MQTTMessage):
         # String format of the arrived message
         msg = msg.payload.decode("utf-8")
-    fields = msg.split("_", 6)
+    fields = msg.split("_", 7)
     _dict = {
         'hostname': fields[0],
         'pub_id': fields[1],
         'pub_con_init': datetime.datetime.strptime(fields[2], '%Y-%m-%d %H:%M:%S.%f'),
         'pub_con_accomplish': datetime.datetime.strptime(fields[3], '%Y-%m-%d %H:%M:%S.%f'),
         'publish_timestamp': datetime.datetime.strptime(fields[4], '%Y-%m-%d %H:%M:%S.%f'),
-        'pub_qos': fields[5]
+        'publish_intended': datetime.datetime.strptime(fields[5], '%Y-%m-%d %H:%M:%S.%f'),
+        'pub_qos': fields[6]
     }
 
     return _dict
 
 
-def write_to_log(pub_host: str = None, pub_id: str = None, pub_con_init: datetime.datetime = None,
-                 pub_con_accomplish: datetime.datetime = None, pub_timestamp: datetime.datetime = None,
-                 pub_qos: str = None, sub_host: str = None, sub_id: str = None,
-                 sub_timestamp: datetime.datetime = None, e2e_delay: datetime.timedelta = None):
-    # print('Writing the message to log')
-    log_format = '%s' + ';%s' * 9
-    LOG_QUEUE.put(log_format % (pub_host, pub_id, pub_con_init, pub_con_accomplish,
-                                pub_timestamp, pub_qos,
-                                sub_host, sub_id, sub_timestamp,
-                                e2e_delay))
+def datetime_to_ns(value: datetime.datetime) -> int:
+    return (value - EPOCH) // ONE_MICROSECOND * 1000
+
+
+def ns_to_datetime(value: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=value // 1000)
+
 
+def decode_msg(payload) -> tuple:
+    """Decodes the header of a payload in either format, binary headers are recognized by their magic byte
+    :return: (hostname, pub_id, seq, qos, connect_init_ns, connect_ack_ns, publish_ns, intended_ns,
+    offset_ns, offset_error_ns), seq is None and the clock offset unknown for the text format
+    """
+    if is_binary(payload):
+        return unpack_header(payload)
+    _dict = parse_msg(payload.decode('utf-8'))
+    return (_dict['hostname'], _dict['pub_id'], None, int(_dict['pub_qos']),
+            datetime_to_ns(_dict['pub_con_init']), datetime_to_ns(_dict['pub_con_accomplish']),
+            datetime_to_ns(_dict['publish_timestamp']), datetime_to_ns(_dict['publish_intended']), 0, -1)
+
+
+def write_to_log(report, pub_host: str = None, pub_id: str = None, pub_con_init: int = None,
+                 pub_con_accomplish: int = None, pub_timestamp: int = None, pub_intended: int = None,
+                 pub_qos: int = None, sub_host: str = None, sub_id: str = None, sub_timestamp: int = None,
+                 seq: int = None, clock_offset: int = 0, clock_error: int = -1,
+                 kernel_timestamp: int = e2e_records.UNKNOWN):
+    # The timestamps stay in ns: the row is formatted by the LogWriter of the parent
+    report.log((pub_host, pub_id, pub_con_init, pub_con_accomplish, pub_timestamp, pub_intended,
+                pub_qos, sub_host, sub_id, sub_timestamp, seq, clock_offset, clock_error, kernel_timestamp))
+
+
+class WorkerReport(object):
+    """Results of the clients hosted by one worker process.
+    Counters and durations are aggregated locally and sent to the parent once,
+    at the end; the log records go to the ring of the worker as they arrive.
+    With raw_log off (no ring) only the e2e histograms of the subscribers are
+    reported"""
+
+    def __init__(self, worker_id: int, channel, ring: RecordRing = None, significant_figures: int = 3):
+        self.worker_id = worker_id
+        self.channel = channel
+        self.ring = ring
+        self.raw_log = ring is not None
+        self.latency = HdrHistogram(significant_figures=significant_figures)
+        # Kernel receive timestamps (--kernel-timestamps): kernel -> on_message and
+        # e2e to the kernel arrival, in us
+        self.receive_delay = HdrHistogram(significant_figures=significant_figures)
+        self.kernel_latency = HdrHistogram(significant_figures=significant_figures)
+        self.handshake = {step: HdrHistogram(significant_figures=significant_figures) for step in HANDSHAKE_STEPS}
+        # Time the publishers spent waiting for a free slot of their in-flight window
+        self.window_waits = 0
+        self.window_wait_time = 0.0
+        self.sub_times = []
+        self.pub_times = []
+        self.received = 0
+        self.published = 0
+        self.failed_subs = 0
+        self.failed_pubs = 0
+        # Progress shown to the coordinator (--control): subscribers with all their
+        # subscriptions acknowledged, connected publishers, lag of the start (ns)
+        self.subscribed = 0
+        self.connected = 0
+        self.start_lag = 0
+        # Live metrics (--metrics-port/--metrics-file): connection state, bytes and
+        # the quantiles of the e2e delays of the last seconds
+        self.sub_connected = 0
+        self.disconnects = 0
+        self.bytes_received = 0
+        self.bytes_published = 0
+        self.rolling = None
+        self.e2e_p50 = self.e2e_p90 = self.e2e_p99 = self.e2e_max = 0
+        self.e2e_window = 0
+        # Delivery verification of the subscribers: {(qos, locality): DeliveryStats}
+        self.delivery = {}
+        # Drain mode: subscribers whose persistent session is parked (subscribed, then
+        # offline), messages of an older session dropped before parking, and for each
+        # subscriber (CONNACK, first message, last message) in s from its reconnection,
+        # messages drained and whether the broker still had the session
+        self.parked = 0
+        self.stale = 0
+        # Payloads in neither format (truncated, foreign), skipped
+        self.malformed = 0
+        self.drain = []
+        # Retained messages of each subscriber: (first, last) in s from its
+        # subscription and how many it got
+        self.retained = []
+        # Self-health of the worker: callback cost, CPU share, loop lag, backlogs
+        self.health = HealthStats()
+
+    def log(self, record: tuple):
+        self.ring.push(e2e_records.record_values(record))
+
+    def update_rolling(self):
+        """Quantiles of the recent e2e delays, for the live metrics"""
+        snapshot = self.rolling.snapshot()
+        self.e2e_window = snapshot.total
+        self.e2e_p50 = snapshot.percentile(50) or 0
+        self.e2e_p90 = snapshot.percentile(90) or 0
+        self.e2e_p99 = snapshot.percentile(99) or 0
+        self.e2e_max = snapshot.max or 0
+
+    def close(self):
+        self.channel.put(('done', self.worker_id, {
+            'sub_times': self.sub_times,
+            'pub_times': self.pub_times,
+            'received': self.received,
+            'published': self.published,
+            'failed_subs': self.failed_subs,
+            'failed_pubs': self.failed_pubs,
+            'latency': self.latency,
+            'receive_delay': self.receive_delay,
+            'kernel_latency': self.kernel_latency,
+            'handshake': self.handshake,
+            'window_waits': self.window_waits,
+            'window_wait_time': self.window_wait_time,
+            'ring_full_waits': self.ring.full_waits if self.ring is not None else 0,
+            'delivery': self.delivery,
+            'stale': self.stale,
+            'malformed': self.malformed,
+            'drain': self.drain,
+            'retained': self.retained,
+            'health': self.health,
+        }))
+
+
+def run_worker(worker_id: int, clients: list, channel, ring: RecordRing = None, significant_figures: int = 3,
+               clock: SharedOffset = None, progress: SharedProgress = None, hold_start: bool = False,
+               verify: bool = True, drain_gate: DrainGate = None):
+    """Worker process: runs its slice of the clients on one asyncio event loop.
+    The log records go to ring (none without the raw log); the counters are
+    copied to progress, if given, for the live metrics and the coordinator;
+    with hold_start (--control) the clients wait for its start. With verify the
+    subscribers check the sequence numbers of the messages (see delivery.py).
+    In drain mode (drain_gate) the publishers wait for the subscribers to park
+    and the subscribers wait for the start to reconnect"""
+    report = WorkerReport(worker_id, channel, ring, significant_figures)
+    clock = clock or SharedOffset()
+    gate = None
+    background = []
+    if progress is not None:
+        report.rolling = RollingHistogram()
+        background.append(ProgressTicker(worker_id, report, progress))
+    background.append(HealthMonitor(report.health, lambda: [client.client for client in clients if client.client],
+                                    lambda: report.received + report.published))
+    if hold_start or drain_gate is not None:
+        gate = StartGate(progress, report, clock)
+    for client in clients:
+        client.report = report
+        client.clock = clock
+        client.gate = drain_gate if drain_gate is not None and isinstance(client, Pub) else gate
+        if verify and isinstance(client, Sub):
+            client.delivery = DeliveryTracker(client.drain_hostname or client.hostname)
+    for client, result in zip(clients, Engine().run(clients, background)):
+        if isinstance(result, BaseException):
+            print('Client %s failed: %s' % (client.client_id, result))
+            if isinstance(client, Sub):
+                report.failed_subs += 1
+            else:
+                report.failed_pubs += 1
+    for client in clients:
+        if isinstance(client, Sub):
+            report.latency.merge(client.latency)
+            report.receive_delay.merge(client.receive_delay)
+            report.kernel_latency.merge(client.kernel_latency)
+            if client.delivery is not None:
+                merge_groups(report.delivery, client.delivery.stats())
+    if progress is not None:
+        progress.update(worker_id, report)
+    report.close()
+
+
+def drain_summary(drain_times: list) -> dict:
+    """Drain mode results of the subscribers, from their (CONNACK, first message,
+    last message, messages, session present) times in s from the reconnection"""
+    connack = [row[0] for row in drain_times if row[0] is not None]
+    first = [row[1] for row in drain_times]
+    drain_time = max([row[2] for row in drain_times] or [0])
+    messages = sum(row[3] for row in drain_times)
+    return {
+        'subscribers': len(drain_times),
+        'sessions_present': sum(1 for row in drain_times if row[4]),
+        'messages': messages,
+        'connack_p50_ms': round(float(numpy.percentile(connack, 50)) * 1e3, 3) if connack else None,
+        'connack_max_ms': round(max(connack) * 1e3, 3) if connack else None,
+        'first_p50_ms': round(float(numpy.percentile(first, 50)) * 1e3, 3) if first else None,
+        'first_max_ms': round(max(first) * 1e3, 3) if first else None,
+        'drain_time': round(drain_time, 3),
+        'throughput': round(messages / drain_time, 1) if drain_time > 0 else 0,
+    }
 
-class Sub(multiprocessing.Process):
+
+def retained_summary(retained_times: list) -> dict:
+    """Retained messages of the subscribers, from their (first, last) times in s
+    from the subscription and counts"""
+    first = [row[0] for row in retained_times]
+    last = [row[1] for row in retained_times]
+    counts = [row[2] for row in retained_times]
+    return {
+        'subscribers': len(retained_times),
+        'min': min(counts) if counts else 0,
+        'max': max(counts) if counts else 0,
+        'total': sum(counts),
+        'first_p50_ms': round(float(numpy.percentile(first, 50)) * 1e3, 3) if first else None,
+        'first_max_ms': round(max(first) * 1e3, 3) if first else None,
+        'last_p50_ms': round(float(numpy.percentile(last, 50)) * 1e3, 3) if last else None,
+        'last_max_ms': round(max(last) * 1e3, 3) if last else None,
+    }
+
+
+def cpuset_size() -> int:
+    """Number of cores this process may run on (the container cpuset)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def shard_clients(clients: list, workers: int) -> list:
+    """Hashes the clients on their id across the given number of workers"""
+    shards = [[] for _ in range(workers)]
+    for client in clients:
+        shards[zlib.crc32(client.client_id.encode('utf-8')) % workers].append(client)
+    return [shard for shard in shards if shard]
+
+
+class Sub(object):
     def __init__(self, hostname, topic, port: int = 1883, client_id: str = None, tls=None, auth=None,
-                 timeout: int = 60, max_count: int = 10, qos: int = 0):
-        super(Sub, self).__init__()
+                 timeout: int = 60, max_count: int = 10, qos: int = 0, significant_figures: int = 3,
+                 idle: float = 0):
         self.hostname = hostname
         self.port = port
         self.client_id = client_id
         self.tls = tls
         self.topic = topic # Single topic or a list of topics
+        # With idle > 0 the subscriber does not know how many messages it gets (e.g.
+        # wildcard filters): it stops after idle seconds without messages instead of max_count
+        self.idle = idle
         self.auth = auth
         self.msg_count = 0
         self.start_time = None
@@ -258,11 +607,52 @@ class Sub(multiprocessing.Process):
         self.end_time = None
         self.timeout = timeout
         self.qos = qos
-        self.end_time_lock = multiprocessing.Lock()
+        self.client = None
+        self.report = None
+        self.clock = None
+        self.gate = None
+        # e2e delays in us
+        self.latency = HdrHistogram(significant_figures=significant_figures)
+        # With kernel_timestamps (--kernel-timestamps) the socket carries the time the
+        # kernel received each message: the part of the delay spent in this client
+        # (kernel -> on_message) and the e2e delay to the kernel arrival, in us
+        self.kernel_timestamps = False
+        self.receive_delay = HdrHistogram(significant_figures=significant_figures)
+        self.kernel_latency = HdrHistogram(significant_figures=significant_figures)
+        # Sequence numbers checked in by run_worker (--no-verify leaves it None)
+        self.delivery = None
+        # Drain mode (--drain): the persistent session (session_id) is parked, then
+        # resumed on drain_hostname, which may be another broker of the cluster
+        self.drain_hostname = None
+        self.session_id = None
+        self.session_present = False
+        self.resume_time = None
+        self.connack_time = None
+        # Retained messages: sent by the broker on subscription, not e2e delays
+        self.subscribe_time = None
+        self.retained = 0
+        self.first_retained = None
+        self.last_retained = None
+        self._done = None
+        self._subscribed = 0
+        self._subscribed_all = None
+        self._offline = None
+        self._online = False
 
     def on_connect(self, client, userdata, flags, rc):
         # Added the condition to connect to passed topic
         print('Client connected')
+        if rc == 0 and not self._online:
+            self._online = True
+            self.report.sub_connected += 1
+        if self.resume_time is not None:
+            # The broker keeps the subscriptions of a resumed session
+            self.connack_time = datetime.datetime.utcnow()
+            self.session_present = bool(flags.get('session present'))
+            if self.session_present:
+                return
+        if self.subscribe_time is None:
+            self.subscribe_time = datetime.datetime.utcnow()
         if isinstance(self.topic, str):
             # Single topic
             client.subscribe(self.topic, qos=self.qos)
@@ -271,74 +661,187 @@ class Sub(multiprocessing.Process):
             for _topic in self.topic:
                 client.subscribe(_topic, qos=self.qos)
 
+    def on_disconnect(self, client, userdata, rc):
+        if self._online:
+            self._online = False
+            self.report.sub_connected -= 1
+        if rc != 0:
+            self.report.disconnects += 1
+        if self._offline is not None:
+            self._offline.set()
+
     def on_subscribe(self, client, obj, mid, granted_qos):
         print('Client subscribed')
-        pass
+        self._subscribed += 1
+        if self._subscribed == (1 if isinstance(self.topic, str) else len(self.topic)):
+            self.report.subscribed += 1
+            self._subscribed_all.set()
         # print("Subscribed: " + str(mid) + " " + str(granted_qos))
 
     def on_message(self, client, userdata, msg):
-        print('A new message has arrived')
+        if self.drain_hostname is not None and self.resume_time is None:
+            # Queued for an older session with the same id before it was parked
+            self.report.stale += 1
+            return
         if self.start_time is None:
             self.start_time = datetime.datetime.utcnow()
-        _msg_arrival_time = datetime.datetime.utcnow()
+        _arrival_ns = time.time_ns()
+        _kernel_ns = client.kernel_ns if self.kernel_timestamps else 0
         # Parse the msg
-        _pub_msg_dictt = parse_msg(msg)
-        # print('The message')
-        # print(_pub_msg_dictt)
-        if isinstance(_pub_msg_dictt['publish_timestamp'], datetime.datetime):
-            # print('The dict parsing works')
-            _msg_e2e_delay = _msg_arrival_time - _pub_msg_dictt['publish_timestamp']
-            # Write the result
-            write_to_log(pub_host=_pub_msg_dictt['hostname'], pub_id=_pub_msg_dictt['pub_id'],
-                              pub_con_init=_pub_msg_dictt['pub_con_init'],
-                              pub_con_accomplish=_pub_msg_dictt['pub_con_accomplish'],
-                              pub_timestamp=_pub_msg_dictt['publish_timestamp'], pub_qos=_pub_msg_dictt['pub_qos'],
-                              sub_host=self.hostname, sub_id=self.client_id, sub_timestamp=_msg_arrival_time,
-                              e2e_delay=_msg_e2e_delay)
-
+        try:
+            _hostname, _pub_id, _seq, _qos, _init_ns, _ack_ns, _pub_ns, _intended_ns, _pub_offset, _pub_error = \
+                decode_msg(msg.payload)
+        except (ValueError, IndexError, KeyError):
+            self.report.malformed += 1
+            return
+        # A duplicate (e.g. a QoS 1 redelivery) is dropped before anything records it,
+        # the delivery report counts it
+        if self.delivery is not None and _seq is not None \
+                and not self.delivery.record(_hostname, _pub_id, msg.topic, _seq, _qos):
+            return
+        if msg.retain:
+            self.last_retained = datetime.datetime.utcnow()
+            if self.first_retained is None:
+                self.first_retained = self.last_retained
+            self.retained += 1
+        # Both clocks brought to the reference one (local time + offset), the error
+        # bounds add up. Unknown (-1) unless both hosts are synced
+        _sub_offset, _sub_error = self.clock.get()
+        _clock_offset = _sub_offset - _pub_offset
+        _clock_error = _sub_error + _pub_error if _sub_error >= 0 and _pub_error >= 0 else -1
+        # The e2e delay is taken from the intended send time: in open loop any time the
+        # message waited behind a slow broker on the publisher side is part of the delay
+        _delay = (_arrival_ns + _clock_offset - _intended_ns) // 1000
+        # The delay of a retained message is its age
+        if not msg.retain:
+            self.latency.record(_delay)
+            if self.report.rolling is not None:
+                self.report.rolling.record(_delay)
+            if _kernel_ns:
+                self.receive_delay.record((_arrival_ns - _kernel_ns) // 1000)
+                self.kernel_latency.record((_kernel_ns + _clock_offset - _intended_ns) // 1000)
+        self.report.bytes_received += len(msg.payload)
+        # Write the result
+        if self.report.raw_log:
+            write_to_log(self.report, pub_host=_hostname, pub_id=_pub_id, pub_con_init=_init_ns,
+                         pub_con_accomplish=_ack_ns, pub_timestamp=_pub_ns, pub_intended=_intended_ns,
+                         pub_qos=_qos, sub_host=self.hostname, sub_id=self.client_id, sub_timestamp=_arrival_ns,
+                         seq=_seq, clock_offset=_clock_offset, clock_error=_clock_error,
+                         kernel_timestamp=_kernel_ns or e2e_records.UNKNOWN)
+
+        self.report.received += 1
         self.msg_count += 1
-        if self.msg_count >= self.max_count:
+        if self.idle:
+            self.end_time = datetime.datetime.utcnow()
+        elif self.msg_count >= self.max_count:
             # print('We hve entered in the final part ')
-            self.end_time_lock.acquire()
             if self.end_time is None:
                 self.end_time = datetime.datetime.utcnow()
-            self.end_time_lock.release()
-            # after we have reached the max count we stop the loop to continue further
-            self.client.loop_stop()
+            # after we have reached the max count we wake up run_async to continue further
+            self._done.set()
 
-    def run(self):
+    def on_message_timed(self, client, userdata, msg):
+        """on_message, its cost goes to the self-health of the worker"""
+        _start = time.perf_counter_ns()
+        self.on_message(client, userdata, msg)
+        self.report.health.record_callback(time.perf_counter_ns() - _start)
 
-        self.client = mqtt.Client()
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.client.on_subscribe = self.on_subscribe
+    def setup_client(self, client):
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_message = self.on_message_timed
+        client.on_subscribe = self.on_subscribe
         if self.tls:
-            self.client.tls_set(**self.tls)
+            client.tls_set(**self.tls)
         if self.auth:
-            self.client.username_pw_set(**self.auth)
-        self.client.connect(self.hostname, port=self.port)
-        self.client.loop_start()
-        while True:
-            # Time sleep is no useful when we have messages coming in bursts
-            time.sleep(1)
-            self.end_time_lock.acquire()
-            if self.end_time:
-                delta = self.end_time - self.start_time
-                SUB_QUEUE.put(delta.total_seconds())
-                self.client.loop_stop()
-                break
-            self.end_time_lock.release()
-            if self.start_time:
-                current_time = datetime.datetime.utcnow()
-                curr_delta = current_time - self.start_time
-                if curr_delta.total_seconds() > self.timeout:
-                    raise Exception('We hit the sub timeout!')
+            client.username_pw_set(**self.auth)
+        self.client = client
 
+    def check_timeout(self):
+        if self.start_time:
+            current_time = datetime.datetime.utcnow()
+            curr_delta = current_time - self.start_time
+            if curr_delta.total_seconds() > self.timeout:
+                raise Exception('We hit the sub timeout!')
 
-class Pub(multiprocessing.Process):
+    async def wait_idle(self):
+        """Returns once idle seconds passed without messages, or timeout seconds
+        without any message at all"""
+        waited = 0.0
+        while True:
+            count = self.msg_count
+            await asyncio.sleep(self.idle)
+            waited += self.idle
+            if self.msg_count == count and (count > 0 or waited >= self.timeout):
+                return
+
+    async def park(self, engine):
+        """Drain mode: opens the persistent session, subscribes and disconnects, the
+        broker queues the messages of the session until it is resumed. Then waits
+        for the start and reconnects"""
+        self._offline = asyncio.Event()
+        self.setup_client(engine.create_client(self.session_id, clean_session=False,
+                                               kernel_timestamps=self.kernel_timestamps))
+        await engine.connect(self.client, self.hostname, port=self.port)
+        await self._subscribed_all.wait()
+        self.client.disconnect()
+        await self._offline.wait()
+        self.report.parked += 1
+        await self.gate.wait()
+        self.resume_time = datetime.datetime.utcnow()
+        await engine.connect(self.client, self.drain_hostname, port=self.port)
+
+    def close_session(self):
+        """Drain mode: the session is left without subscriptions, nothing is queued
+        for it after the run"""
+        self.client.unsubscribe(self.topic)
+        self.report.drain.append((
+            (self.connack_time - self.resume_time).total_seconds() if self.connack_time else None,
+            (self.start_time - self.resume_time).total_seconds(),
+            (self.end_time - self.resume_time).total_seconds(),
+            self.msg_count, self.session_present))
+
+    async def run_async(self, engine):
+        self._done = asyncio.Event()
+        self._subscribed_all = asyncio.Event()
+        if self.drain_hostname is not None:
+            await self.park(engine)
+        else:
+            self.setup_client(engine.create_client(kernel_timestamps=self.kernel_timestamps))
+            await engine.connect(self.client, self.hostname, port=self.port)
+            if self.gate is not None:
+                # The timeouts count from the start of the run
+                await self.gate.wait()
+        if self.idle:
+            await self.wait_idle()
+            if self.start_time is None:
+                self.client.disconnect()
+                raise Exception('No message matched the subscriptions of %s' % self.client_id)
+        while not self.idle:
+            try:
+                await asyncio.wait_for(self._done.wait(), self.timeout)
+                break
+            except asyncio.TimeoutError:
+                if self.resume_time is not None and self.start_time is None:
+                    self.client.disconnect()
+                    raise Exception('Nothing drained by %s (session present: %s)'
+                                    % (self.client_id, self.session_present))
+                self.check_timeout()
+        if self.resume_time is not None:
+            self.close_session()
+        self.client.disconnect()
+        if self.retained:
+            self.report.retained.append(((self.first_retained - self.subscribe_time).total_seconds(),
+                                         (self.last_retained - self.subscribe_time).total_seconds(), self.retained))
+        delta = self.end_time - self.start_time
+        self.report.sub_times.append(delta.total_seconds())
+
+
+class Pub(object):
     def __init__(self, hostname, topic, port=1883, client_id: str = None, tls=None, auth=None,
-                 timeout: int = 60, max_count: int = 10, msg_size: int = 1024, qos: int = 0):
-        super(Pub, self).__init__()
+                 timeout: int = 60, max_count: int = 10, msg_size: int = 1024, qos: int = 0,
+                 rate: float = 0, arrivals: str = 'constant', seed: int = None, payload_format: str = 'binary',
+                 max_inflight: int = 20):
         self.hostname = hostname
         self.port = port
         self.client_id = client_id
@@ -354,82 +857,313 @@ class Pub(multiprocessing.Process):
         self.msg_size = msg_size
         self.connect_init = None
         self.connect_accomplish = None
+        # Messages per second of the open-loop schedule, 0 publishes back to back
+        self.rate = rate
+        self.arrivals = arrivals
+        self.seed = seed
+        self.payload_format = payload_format
+        # Sequence number of the last message of each topic: with several topics the
+        # messages a subscriber gets on each one are numbered without gaps
+        self.seq = {}
+        # Retained messages (--retain), or empty ones clearing them (--clear-retained)
+        self.retain = False
+        self.clear_retained = False
+        # Messages per sendmsg of the fast path (--fast-batch), 0 publishes through paho
+        self.fast_batch = 0
+        self._prefixes = {}
+        self._address = pack_address(hostname)
+        self._pub_index = int(client_id[3:]) if client_id and client_id[3:].isdigit() else 0
+        self.published = 0
+        # QoS 1/2 messages waiting for their handshake to complete, at most max_inflight (0: no limit)
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.client = None
+        self.report = None
+        self.clock = None
+        self.gate = None
+        self._connected = None
+        self._online = False
+        self._flushed = None
+        self._window = None
+        self._pool = None
+        # Send time (perf_counter_ns) of the messages in flight and of their PUBREC, by mid
+        self._sent = {}
+        self._pubrec = {}
+        # Buffers of the window pool held by the messages in flight, by mid
+        self._held = {}
         if self.msg_size < 51:
             raise Exception('Message size should be at least 50 characters')
-
-    def create_msg(self):
+        if self.payload_format == 'binary' and self.msg_size < HEADER_SIZE:
+            raise Exception('Message size should be at least %s bytes' % HEADER_SIZE)
+
+    def create_msg(self, intended: datetime.datetime = None, topic: str = None, buffer: bytearray = None):
+        _seq = self.seq[topic] = self.seq.get(topic, 0) + 1
+        _buffer = buffer if buffer is not None else shared_pool(self.msg_size).next()
+        if self.payload_format == 'binary':
+            _now_ns = time.time_ns()
+            _offset, _error = self.clock.get() if self.clock is not None else (0, -1)
+            pack_header_into(_buffer, self._address, self._pub_index, _seq, self.qos,
+                             datetime_to_ns(self.connect_init), datetime_to_ns(self.connect_accomplish),
+                             _now_ns, datetime_to_ns(intended) if intended else _now_ns, _offset, _error)
+            return _buffer
 
         if self.connect_init is None:
             self.connect_init = ''
         if self.connect_accomplish is None:
             self.connect_accomplish = ''
-        _pre_msg = self.hostname + '_' + self.client_id + '_' + str(self.connect_init) + '_' \
-                   + str(self.connect_accomplish) + '_' + str(datetime.datetime.utcnow()) + '_' \
-                   + str(self.qos) + '_'
-        return _pre_msg + ''.join(
-            random.choice(string.ascii_lowercase) for i in range(self.msg_size - len(_pre_msg.encode('utf-8'))))
+        _now = datetime.datetime.utcnow()
+        _pre_msg = (self.hostname + '_' + self.client_id + '_' + str(self.connect_init) + '_'
+                    + str(self.connect_accomplish) + '_' + str(_now) + '_' + str(intended or _now) + '_'
+                    + str(self.qos) + '_').encode('utf-8')
+        if len(_pre_msg) >= self.msg_size:
+            return _pre_msg
+        # The rest of the buffer is padding, parse_msg never splits past the last field
+        _buffer[:len(_pre_msg)] = _pre_msg
+        return _buffer
 
     def on_publish(self, client, userdata, mid):
         # print('The message was published')
         # Used for qos 1 and 2
         # For QoS 0, this simply means that the message has left the client
         # For other qoses, this means the handshake process has successfully ended
-        pass
-
-    def publish_msg(self, client, topic):
-        self.msg = self.create_msg()
-        client.publish(topic, payload=self.msg, qos=self.qos)
-        if self.start_time:
+        _buffer = self._held.pop(mid, None)
+        if _buffer is not None:
+            self._pool.release(_buffer)
+        _sent = self._sent.pop(mid, None)
+        if _sent is not None:
+            _now = time.perf_counter_ns()
+            _pubrec = self._pubrec.pop(mid, None)
+            if self.qos == 1:
+                self.report.handshake['puback'].record((_now - _sent) // 1000)
+            elif _pubrec is not None:
+                self.report.handshake['pubrec'].record((_pubrec - _sent) // 1000)
+                self.report.handshake['pubcomp'].record((_now - _pubrec) // 1000)
+            self.inflight -= 1
+            self._window.set()
+        self.published += 1
+        self.report.published += 1
+        if self.published >= self.max_count:
+            self._flushed.set()
+
+    def on_pubrec(self, client, userdata, mid):
+        if mid in self._sent:
+            self._pubrec[mid] = time.perf_counter_ns()
+
+    async def wait_window(self):
+        """Backpressure: waits until a slot of the in-flight window is free"""
+        if not self.max_inflight or self.inflight < self.max_inflight:
+            return
+        _start = time.perf_counter()
+        self._window.clear()
+        while self.inflight >= self.max_inflight:
+            try:
+                await asyncio.wait_for(self._window.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                raise Exception('We hit the pub timeout!')
+            self._window.clear()
+        self.report.window_waits += 1
+        self.report.window_wait_time += time.perf_counter() - _start
+
+    def stage_fast(self, connection: FastConnection, topic, intended: datetime.datetime = None):
+        """Fast path: patches the sequence number and the times into the next payload
+        of the pool, whose header was written once, and stages it behind the
+        pre-encoded prefix of its topic. Returns the packet id (None for QoS 0)"""
+        _prefix = self._prefixes.get(topic)
+        if _prefix is None:
+            _prefix = self._prefixes[topic] = publish_prefix(topic, 0 if self.clear_retained else self.msg_size,
+                                                             self.qos, self.retain or self.clear_retained)
+        if self.clear_retained:
+            self.msg = b''
+        else:
+            _seq = self.seq[topic] = self.seq.get(topic, 0) + 1
+            self.msg = self._pool.next()
+            _now_ns = time.time_ns()
+            _offset, _error = self.clock.get() if self.clock is not None else (0, -1)
+            patch_header_into(self.msg, _seq, _now_ns, datetime_to_ns(intended) if intended else _now_ns,
+                              _offset, _error)
+        _mid = connection.next_mid() if self.qos > 0 else None
+        connection.stage(_prefix, _mid, self.msg or None)
+        if intended is not None:
+            # Open loop: every message leaves at its time
+            connection.flush()
+        return _mid
+
+    def publish_msg(self, client, topic, intended: datetime.datetime = None):
+        if self.fast_batch:
+            _sent = time.perf_counter_ns()
+            _mid = self.stage_fast(client, topic, intended)
+        else:
+            # QoS 1/2 messages are kept by paho until acknowledged (and resent after a
+            # reconnection): they hold a buffer of the window pool until their handshake
+            # completes, or get their own copy when none is free
+            _buffer = self._pool.take() if self._pool is not None and not self.clear_retained else None
+            # An empty retained message deletes the retained message of the topic
+            self.msg = b'' if self.clear_retained else self.create_msg(intended, topic, _buffer)
+            _sent = time.perf_counter_ns()
+            _mid = client.publish(topic, payload=self.msg if self.qos == 0 or _buffer is not None else bytes(self.msg),
+                                  qos=self.qos, retain=self.retain or self.clear_retained).mid
+            if _buffer is not None:
+                self._held[_mid] = _buffer
+        self.report.bytes_published += len(self.msg)
+        if self.qos > 0:
+            self._sent[_mid] = _sent
+            self.inflight += 1
+        if intended is not None:
+            # Open loop: the timeout is how far behind the schedule we can fall
+            curr_delta = datetime.datetime.utcnow() - intended
+            if curr_delta.total_seconds() > self.timeout:
+                raise Exception('We hit the pub timeout!')
+        elif self.start_time:
             current_time = datetime.datetime.utcnow()
             curr_delta = current_time - self.start_time
             if curr_delta.total_seconds() > self.timeout:
                 raise Exception('We hit the pub timeout!')
 
+    def topics_to_publish(self):
+        """Yields the topic of each of the max_count messages, cycling over the topics list"""
+        _topics = [self.topic] if isinstance(self.topic, str) else self.topic
+        for i in range(self.max_count):
+            yield _topics[i % len(_topics)]
+
     def on_connect(self, client, obj, flags, rc):
         print('Pub successfully connected')
         # print(mqtt.connack_string(rc))
-        _single_topic = True if isinstance(self.topic, str) else False
-        _nr_topics_to_publish = 1 if _single_topic else len(self.topic)
         self.start_time = datetime.datetime.utcnow()
         if rc == 0:
             self.connect_accomplish = self.start_time
-            # print('The loop started')
-            for i in range(0, self.max_count, _nr_topics_to_publish):
-                if _single_topic:
-                    self.publish_msg(client, self.topic)
-                else:
-                    # we have to publish for each topic in the list
-                    _items_to_print = _nr_topics_to_publish if self.max_count - i > _nr_topics_to_publish\
-                                        else self.max_count - i
-                    for _topic in self.topic[:_items_to_print]:
-                        self.publish_msg(client, _topic)
-
-            self.end_time = datetime.datetime.utcnow()
-            delta = self.end_time - self.start_time
-            PUB_QUEUE.put(delta.total_seconds())
-
-    def run(self):
-
-        client = mqtt.Client()
+            if not self._online:
+                self._online = True
+                self.report.connected += 1
+            # The messages are published by run_async, outside of the paho callbacks
+            self._connected.set()
+
+    def on_disconnect(self, client, userdata, rc):
+        if self._online:
+            self._online = False
+            self.report.connected -= 1
+        if rc != 0:
+            self.report.disconnects += 1
+
+    def setup_client(self, client):
         if self.tls:
             client.tls_set(**self.tls)
         if self.auth:
             client.username_pw_set(**self.auth)
 
         client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
         client.on_publish = self.on_publish
+        client.on_pubrec = self.on_pubrec
+        # The window is enforced by wait_window, paho must not queue behind it
+        client.max_inflight_messages_set(self.max_inflight)
+
+    async def publish_open_loop(self, client):
+        """Publishes on a fixed-rate or poisson schedule that does not wait for the broker,
+        each message carries the time it was scheduled for"""
+        loop = asyncio.get_running_loop()
+        # loop.time() is monotonic, the payload carries wall clock time
+        wall_offset = time.time() - loop.time()
+        intervals = arrival_intervals(1.0 / self.rate, self.arrivals,
+                                      random.Random('%s-%s' % (self.seed, self.client_id)))
+        intended = loop.time()
+        for _topic in self.topics_to_publish():
+            intended += next(intervals)
+            await asyncio.sleep(max(intended - loop.time(), 0))
+            # A full window delays the message, its intended time stays the scheduled one
+            await self.wait_window()
+            self.publish_msg(client, _topic,
+                             intended=datetime.datetime.utcfromtimestamp(intended + wall_offset))
+
+    async def run_fast(self, engine):
+        """run_async on the fast path (fast_mqtt.py): the messages are staged and
+        sent fast_batch at a time with one sendmsg, or when the in-flight window
+        is full. The payloads of a batch are the slots of a private pool, their
+        headers written once after the CONNACK"""
+        self._flushed = asyncio.Event()
+        self._window = asyncio.Event()
+        self._pool = PayloadPool(self.msg_size, slots=self.fast_batch)
+        connection = self.client = FastConnection(engine.loop, on_publish=self.on_publish,
+                                                  on_disconnect=self.on_disconnect)
 
-        # print('The client object was successfully created')
         self.connect_init = datetime.datetime.utcnow()
-        client.connect(self.hostname, port=self.port)
-        client.loop_start()
+        self._connected = asyncio.Event()
+        # The same client ids run in every container and the brokers of a cluster share
+        # them, a random suffix keeps one publisher from taking over the session of another
+        rc = await connection.connect(self.hostname, port=self.port,
+                                      client_id='%s-%06x' % (self.client_id, random.getrandbits(24)), auth=self.auth)
+        if rc != 0:
+            raise Exception('Connection refused: %s' % mqtt.connack_string(rc))
+        self.on_connect(connection, None, None, rc)
+        _offset, _error = self.clock.get() if self.clock is not None else (0, -1)
+        for _buffer in self._pool.buffers:
+            pack_header_into(_buffer, self._address, self._pub_index, 0, self.qos,
+                             datetime_to_ns(self.connect_init), datetime_to_ns(self.connect_accomplish),
+                             0, 0, _offset, _error)
+        if self.gate is not None:
+            await self.gate.wait()
+            self.start_time = datetime.datetime.utcnow()
 
-        # Keep running until we have set the end_time parameter, which happen after everything is finished
-        while True:
-            time.sleep(1)
-            if self.end_time:
-                client.loop_stop()
-                break
+        if self.rate:
+            await self.publish_open_loop(connection)
+        else:
+            for _topic in self.topics_to_publish():
+                if connection.staged >= self.fast_batch or (self.max_inflight and self.inflight >= self.max_inflight):
+                    connection.flush()
+                    await connection.drain()
+                    await self.wait_window()
+                    # Give the other sessions on the loop a chance to run
+                    await asyncio.sleep(0)
+                self.publish_msg(connection, _topic)
+            connection.flush()
+
+        self.end_time = datetime.datetime.utcnow()
+        delta = self.end_time - self.start_time
+        self.report.pub_times.append(delta.total_seconds())
+
+        try:
+            await asyncio.wait_for(self._flushed.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            print('Pub %s timed out waiting for the acknowledgements' % self.client_id)
+        await connection.disconnect()
+
+    async def run_async(self, engine):
+        if self.fast_batch:
+            return await self.run_fast(engine)
+        self._connected = asyncio.Event()
+        self._flushed = asyncio.Event()
+        self._window = asyncio.Event()
+        if self.qos > 0 and self.max_inflight:
+            # A buffer per message in flight, no copy per message
+            self._pool = PayloadPool(self.msg_size, slots=self.max_inflight)
+        client = self.client = engine.create_client()
+        self.setup_client(client)
+
+        self.connect_init = datetime.datetime.utcnow()
+        await engine.connect(client, self.hostname, port=self.port)
+        await self._connected.wait()
+        if self.gate is not None:
+            await self.gate.wait()
+            self.start_time = datetime.datetime.utcnow()
+
+        if self.rate:
+            await self.publish_open_loop(client)
+        else:
+            for _topic in self.topics_to_publish():
+                await self.wait_window()
+                self.publish_msg(client, _topic)
+                # Give the other sessions on the loop a chance to run
+                await asyncio.sleep(0)
+
+        self.end_time = datetime.datetime.utcnow()
+        delta = self.end_time - self.start_time
+        self.report.pub_times.append(delta.total_seconds())
+
+        # Let the QoS 1/2 handshakes complete before closing the connection
+        try:
+            await asyncio.wait_for(self._flushed.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            print('Pub %s timed out waiting for the acknowledgements' % self.client_id)
+        client.disconnect()
 
 
 def main(hostname=None):
@@ -455,10 +1189,31 @@ def main(hostname=None):
                              'will wait to recieve before completing. The '
                              'default count is 0.')
     parser.add_argument('--msg-size', type=int, dest='msg_size',
-                        help='The payload size to use in bytes')
+                        help='The payload size to use in bytes. The default '
+                             'is 1024')
+    parser.add_argument('--payload-format', type=str, dest='payload_format', choices=PAYLOAD_FORMATS,
+                        help='The publishers payload header: binary (fixed '
+                             'layout, decoded with one struct unpack) or text '
+                             '(the former underscore-joined strings). The '
+                             'default is binary')
+    parser.add_argument('--rate', type=float, dest='rate',
+                        help='Open-loop mode: the messages per second of each '
+                             'publisher, sent on schedule whether or not the '
+                             'broker keeps up. By default the messages are '
+                             'published back to back')
+    parser.add_argument('--arrivals', type=str, dest='arrivals', choices=ARRIVALS,
+                        help='The open-loop schedule: constant rate or poisson '
+                             'arrivals. The default is constant')
+    parser.add_argument('--seed', type=int, dest='seed',
+                        help='The seed of the poisson schedules')
     # Added
     parser.add_argument('--msg', type=str, dest='msg',
                         help='The payload of the publish message')
+    parser.add_argument('--sub-idle', type=float, dest='sub_idle',
+                        help='Subscribers stop after this many seconds without '
+                             'messages instead of waiting for --sub-count, for '
+                             'wildcard filters matching an unknown number of '
+                             'messages. 0 (default) disables it')
     parser.add_argument('--sub-timeout', type=int, dest='sub_timeout',
                         help='The amount of time, in seconds, a subscriber '
                              'client will wait for messages. By default this '
@@ -491,11 +1246,102 @@ def main(hostname=None):
                         help='A description of cluster topology. '
                              'Shall be used to set the name of log files of type: '
                              '*description*_*sub_1*')
+    parser.add_argument('--workers', type=int, dest='workers',
+                        help='The number of worker processes the clients are '
+                             'hashed across, each one running its clients on '
+                             'an asyncio event loop. By default one per core '
+                             'of the container cpuset')
+    parser.add_argument('--log-batch-size', type=int, dest='log_batch_size',
+                        help='The maximum number of log records the log writer '
+                             'takes from a worker at once. The default is 1000')
+    parser.add_argument('--log-flush-interval', type=float, dest='log_flush_interval',
+                        help='The time in seconds the log writer waits when no '
+                             'worker has new records. The default is 0.01')
+    parser.add_argument('--log-ring-size', type=int, dest='log_ring_size',
+                        help='The number of log records buffered in shared memory '
+                             'for each worker; a worker waits when its ring is '
+                             'full. The default is 65536')
+    parser.add_argument('--no-raw-log', action='store_true', dest='no_raw_log',
+                        help='Do not log every received message, only the '
+                             'e2e delay histogram of the subscribers')
+    parser.add_argument('--no-verify', action='store_true', dest='no_verify',
+                        help='Do not check the sequence numbers of the received '
+                             'messages for losses, duplicates and reordering')
+    parser.add_argument('--hdr-digits', type=int, dest='hdr_digits',
+                        help='The significant decimal digits of the e2e delay '
+                             'histogram (1-5). The default is 3')
+    parser.add_argument('--log-format', dest='log_format', choices=LOG_FORMATS,
+                        help='csv (default) writes the per-message log as text, '
+                             'records as fixed-width binary records that can be '
+                             'memory-mapped with numpy (see e2e_records.py)')
+    parser.add_argument('--max-inflight', type=int, dest='max_inflight',
+                        help='The maximum number of QoS 1/2 messages a publisher '
+                             'has in flight; when the window is full it waits for '
+                             'an acknowledgement. 0 means no limit, the default is 20')
+    parser.add_argument('--clock-server', dest='clock_server',
+                        help='host[:port] of a clock reference (python3 '
+                             'clock_sync.py serve). The offset of this host to '
+                             'it is estimated before and during the run and '
+                             'removed from the e2e delays')
+    parser.add_argument('--clock-interval', type=float, dest='clock_interval',
+                        help='Seconds between two clock offset estimates. '
+                             'The default is 10')
+    parser.add_argument('--control', action='store_true', dest='control',
+                        help='Driven by coordinator.py: report readiness and '
+                             'progress on stdout and start publishing at the '
+                             'time it sends on stdin')
+    parser.add_argument('--metrics-port', type=int, dest='metrics_port',
+                        help='Serve live metrics (message and byte counters, '
+                             'connections, e2e delay quantiles of the last '
+                             'seconds) in the Prometheus text format on '
+                             'http://<container>:<port>/metrics. Off by default')
+    parser.add_argument('--metrics-file', dest='metrics_file',
+                        help='Rewrite the live metrics to this file every second')
+    parser.add_argument('--retain', action='store_true', dest='retain',
+                        help='The publishers send retained messages, the '
+                             'broker keeps the last one of each topic for the '
+                             'new subscribers')
+    parser.add_argument('--clear-retained', action='store_true', dest='clear_retained',
+                        help='The publishers send empty retained messages, '
+                             'deleting the retained messages of their topics')
+    parser.add_argument('--fast-batch', type=int, dest='fast_batch',
+                        help='Publish through the lean MQTT 3.1.1 codec of '
+                             'fast_mqtt.py instead of paho: pre-encoded '
+                             'packets, up to this many sent with one sendmsg. '
+                             'Binary payloads, QoS 0 or 1, no TLS. 0 (default) '
+                             'publishes through paho')
+    parser.add_argument('--kernel-timestamps', action='store_true', dest='kernel_timestamps',
+                        help='The subscribers enable SO_TIMESTAMPNS on their '
+                             'sockets and log the time the kernel received '
+                             'each message next to the time on_message got it, '
+                             'separating the delay of the client from the '
+                             'network and broker one. Not with TLS')
+    parser.add_argument('--health-cpu', type=float, dest='health_cpu',
+                        help='Share of a core (0-1) a worker may use while '
+                             'the messages flow before the run is flagged as '
+                             'limited by the load generator. The default is %s' % CPU_THRESHOLD)
+    parser.add_argument('--health-lag', type=float, dest='health_lag',
+                        help='p99 lag (ms) of the event loop of a worker from '
+                             'which the run is flagged as limited by the load '
+                             'generator. The default is %s' % int(LAG_THRESHOLD * 1e3))
+    parser.add_argument('--drain', action='store_true', dest='drain',
+                        help='Persistent sessions: the subscribers subscribe '
+                             'with clean_session=False and disconnect, the '
+                             'publishers send their backlog, then the '
+                             'subscribers reconnect and drain their queue. '
+                             'Needs QoS 1 or 2')
+    parser.add_argument('--drain-hostname', dest='drain_hostname',
+                        help='Broker the subscribers reconnect to in drain '
+                             'mode, by default --hostname')
+    parser.add_argument('--drain-offline', type=float, dest='drain_offline',
+                        help='Seconds the subscribers stay offline after the '
+                             'backlog is acknowledged, without --control. '
+                             'The default is 5')
 
     opts = parser.parse_args()
 
-    sub_threads = []
-    pub_threads = []
+    sub_clients = []
+    pub_clients = []
 
     ### parse the parameters
     _topic = getattr(opts, 'topic') or os.getenv('CLIENT_TOPIC') or None
@@ -511,11 +1357,45 @@ def main(hostname=None):
                              'subscriber timeout')
     _pub_timeout = set_value(getattr(opts, 'pub_timeout'), os.getenv('CLIENT_PUBLISHERS_TIMEOUT'), 60,
                              'publisher timeout')
+    _sub_idle = float(getattr(opts, 'sub_idle') or os.getenv('CLIENT_SUBSCRIBERS_IDLE') or 0)
+    _rate = float(getattr(opts, 'rate') or os.getenv('CLIENT_PUBLISHERS_RATE') or 0)
+    _arrivals = getattr(opts, 'arrivals') or os.getenv('CLIENT_ARRIVALS') or 'constant'
+    _msg_size = set_value(getattr(opts, 'msg_size'), os.getenv('CLIENT_MESSAGE_SIZE'), 1024, 'message size')
+    _payload_format = getattr(opts, 'payload_format') or os.getenv('CLIENT_PAYLOAD_FORMAT') or 'binary'
+    _seed = set_value(getattr(opts, 'seed'), os.getenv('CLIENT_SEED'), None, 'seed')
     _qos = set_value(getattr(opts, 'qos'), os.getenv('CLIENT_QOS'), 0, 'qos')
     _msg = getattr(opts, 'msg') or os.getenv('CLIENT_MESSAGE')
     _brief = getattr(opts, 'brief') or os.getenv('CLIENT_BRIEF') or False
     _multiple_topics = getattr(opts, 'multiple_topics') or os.getenv('CLIENT_MULTIPLE_TOPICS') or None
     _description = getattr(opts, 'description') or os.getenv('DESCRIPTION') or ''
+    _workers = set_value(getattr(opts, 'workers'), os.getenv('CLIENT_WORKERS'), cpuset_size(), 'number of workers')
+    _log_batch_size = set_value(getattr(opts, 'log_batch_size'), os.getenv('CLIENT_LOG_BATCH_SIZE'), 1000,
+                                'log batch size')
+    _log_flush_interval = float(getattr(opts, 'log_flush_interval') or os.getenv('CLIENT_LOG_FLUSH_INTERVAL')
+                                or 0.01)
+    _log_ring_size = set_value(getattr(opts, 'log_ring_size'), os.getenv('CLIENT_LOG_RING_SIZE'), 65536,
+                               'log ring size')
+    _raw_log = not (getattr(opts, 'no_raw_log') or os.getenv('CLIENT_RAW_LOG') in ['0', 'false', 'False'])
+    _verify = not (getattr(opts, 'no_verify') or os.getenv('CLIENT_VERIFY') in ['0', 'false', 'False'])
+    _max_inflight = set_value(getattr(opts, 'max_inflight'), os.getenv('CLIENT_MAX_INFLIGHT'), 20,
+                              'max inflight messages')
+    _clock_server = getattr(opts, 'clock_server') or os.getenv('CLIENT_CLOCK_SERVER') or None
+    _clock_interval = float(getattr(opts, 'clock_interval') or os.getenv('CLIENT_CLOCK_INTERVAL') or 10)
+    _control = getattr(opts, 'control') or os.getenv('CLIENT_CONTROL') in ['1', 'true', 'True']
+    _metrics_port = set_value(getattr(opts, 'metrics_port'), os.getenv('CLIENT_METRICS_PORT'), 0, 'metrics port')
+    _metrics_file = getattr(opts, 'metrics_file') or os.getenv('CLIENT_METRICS_FILE') or None
+    _log_format = getattr(opts, 'log_format') or os.getenv('CLIENT_LOG_FORMAT') or 'csv'
+    _hdr_digits = set_value(getattr(opts, 'hdr_digits'), os.getenv('CLIENT_HDR_DIGITS'), 3, 'histogram digits')
+    _retain = getattr(opts, 'retain') or os.getenv('CLIENT_RETAIN') in ['1', 'true', 'True']
+    _clear_retained = getattr(opts, 'clear_retained') or os.getenv('CLIENT_CLEAR_RETAINED') in ['1', 'true', 'True']
+    _health_cpu = float(getattr(opts, 'health_cpu') or os.getenv('CLIENT_HEALTH_CPU') or CPU_THRESHOLD)
+    _health_lag = float(getattr(opts, 'health_lag') or os.getenv('CLIENT_HEALTH_LAG') or LAG_THRESHOLD * 1e3)
+    _kernel_timestamps = getattr(opts, 'kernel_timestamps') or \
+        os.getenv('CLIENT_KERNEL_TIMESTAMPS') in ['1', 'true', 'True']
+    _fast_batch = set_value(getattr(opts, 'fast_batch'), os.getenv('CLIENT_FAST_BATCH'), 0, 'fast batch')
+    _drain = getattr(opts, 'drain') or os.getenv('CLIENT_DRAIN') in ['1', 'true', 'True']
+    _drain_hostname = getattr(opts, 'drain_hostname') or os.getenv('CLIENT_DRAIN_HOSTNAME') or _hostname
+    _drain_offline = float(getattr(opts, 'drain_offline') or os.getenv('CLIENT_DRAIN_OFFLINE') or 5)
 
     if _topic is None and _multiple_topics is None:
         raise Exception('The parameters --topic and --multiple-topics can not be both None type')
@@ -533,12 +1413,45 @@ def main(hostname=None):
     is_positive(_pub_clients, 'number of publishers')
     is_positive(_sub_count, 'number of messages per subscriber')
     is_positive(_pub_count, 'number of messages per publisher')
+    is_positive(_rate, 'publishing rate')
+    is_positive(_sub_idle, 'subscriber idle time')
+    if _payload_format not in PAYLOAD_FORMATS:
+        raise Exception('The payload format must be one of %s' % ', '.join(PAYLOAD_FORMATS))
+    if _arrivals not in ARRIVALS:
+        raise Exception('The arrivals parameter must be one of %s' % ', '.join(ARRIVALS))
+    if _workers < 1:
+        raise Exception('The number of workers must be at least 1')
+    if _log_batch_size < 1:
+        raise Exception('The log batch size must be at least 1')
+    if _log_flush_interval <= 0:
+        raise Exception('The log flush interval must be positive')
+    if _log_ring_size < 1:
+        raise Exception('The log ring size must be at least 1')
+    is_positive(_max_inflight, 'max inflight messages')
+    if _clock_interval <= 0:
+        raise Exception('The clock interval must be positive')
+    if _log_format not in LOG_FORMATS:
+        raise Exception('The log format must be one of %s' % ', '.join(LOG_FORMATS))
+    if _hdr_digits < 1 or _hdr_digits > 5:
+        raise Exception('The histogram digits must be between 1 and 5')
+    is_positive(_drain_offline, 'drain offline time')
 
     if isinstance(_qos, int):
         if _qos not in [0, 1, 2]:
             raise Exception('The QOS value is expected to be 0, 1 or 2')
     else:
         raise Exception('The QOS parameter must be int type ')
+    if _drain and _qos == 0:
+        raise Exception('The drain mode needs QoS 1 or 2, QoS 0 messages are not queued for offline subscribers')
+    is_positive(_fast_batch, 'fast batch')
+    if _health_cpu <= 0 or _health_lag <= 0:
+        raise Exception('The health thresholds must be positive')
+    if _fast_batch and _qos == 2:
+        raise Exception('The fast path supports QoS 0 and 1')
+    if _fast_batch and _payload_format != 'binary':
+        raise Exception('The fast path patches the binary payload header, it needs --payload-format binary')
+    if _fast_batch and _qos == 1 and not 0 < _max_inflight < 65536:
+        raise Exception('The fast path needs an in-flight window of 1-65535 messages at QoS 1')
 
     _tls = None
     if getattr(opts, 'cacert'):
@@ -564,7 +1477,9 @@ def main(hostname=None):
     #     exit(1)
 
     # Log file
-    log_file = initialize_log(_hostname, dest_path='/home/logs', prefix=_description)
+    log_file = None
+    if _raw_log:
+        log_file = initialize_log(_hostname, dest_path='/home/logs', prefix=_description, log_format=_log_format)
 
     ## the multiple-topics
     _multiple_topics_cl = None
@@ -583,16 +1498,15 @@ def main(hostname=None):
 
             sub = Sub(_hostname, topic=_topic, port=_port, client_id='sub' + str(i), tls=_tls,
                       auth=_auth, timeout=_sub_timeout,
-                      max_count=_sub_count, qos=_qos)
-            sub_threads.append(sub)
-            sub.start()
+                      max_count=_sub_count, qos=_qos, significant_figures=_hdr_digits, idle=_sub_idle)
+            sub_clients.append(sub)
 
         for i in range(_pub_clients):
             pub = Pub(_hostname, topic=_topic, port=_port, client_id='pub' + str(i), tls=_tls,
                       auth=_auth, timeout=_pub_timeout,
-                      max_count=_pub_count, qos=_qos)
-            pub_threads.append(pub)
-            pub.start()
+                      max_count=_pub_count, qos=_qos, rate=_rate, arrivals=_arrivals, seed=_seed,
+                      payload_format=_payload_format, msg_size=_msg_size, max_inflight=_max_inflight)
+            pub_clients.append(pub)
 
     if _multiple_topics_dict is not None:
         # print('Multiple topics')
@@ -617,17 +1531,41 @@ def main(hostname=None):
                 _sub_client_id += 1
                 sub = Sub(_hostname, topic=_topics, port=_port, client_id='sub' + str(_sub_client_id), tls=_tls,
                           auth=_auth, timeout=_sub_timeout,
-                          max_count=_sub_count, qos=_qos)
-                sub_threads.append(sub)
-                sub.start()
+                          max_count=_sub_count, qos=_qos, significant_figures=_hdr_digits, idle=_sub_idle)
+                sub_clients.append(sub)
             _nr_pubs = _cluster[JSON_PUBS]
             for _pub_ind in range(_nr_pubs):
                 _pub_client_id += 1
-                pub = Pub(_hostname, topic=_topic, port=_port, client_id='pub' + str(_pub_client_id), tls=_tls,
+                pub = Pub(_hostname, topic=_topics, port=_port, client_id='pub' + str(_pub_client_id), tls=_tls,
                           auth=_auth, timeout=_pub_timeout,
-                          max_count=_pub_count, qos=_qos)
-                pub_threads.append(pub)
-                pub.start()
+                          max_count=_pub_count, qos=_qos, rate=_rate, arrivals=_arrivals, seed=_seed,
+                          payload_format=_payload_format, msg_size=_msg_size, max_inflight=_max_inflight)
+                pub_clients.append(pub)
+
+        # the generated topic spaces
+        for _key, _validate, _generate in JSON_GENERATED:
+            if _key not in _multiple_topics_dict:
+                continue
+            _workload = _generate(_multiple_topics_dict[_key])
+            if not _multiple_topics_cl.generate_subs:
+                _workload['subs'] = []
+            if not _multiple_topics_cl.generate_pubs:
+                _workload['pubs'] = []
+            for _topics in _workload['subs']:
+                _sub_client_id += 1
+                sub = Sub(_hostname, topic=_topics, port=_port, client_id='sub' + str(_sub_client_id), tls=_tls,
+                          auth=_auth, timeout=_sub_timeout,
+                          max_count=_sub_count, qos=_qos, significant_figures=_hdr_digits, idle=_sub_idle)
+                sub_clients.append(sub)
+            for _topics in _workload['pubs']:
+                _pub_client_id += 1
+                pub = Pub(_hostname, topic=_topics, port=_port, client_id='pub' + str(_pub_client_id), tls=_tls,
+                          auth=_auth, timeout=_pub_timeout,
+                          max_count=_pub_count, qos=_qos, rate=_rate, arrivals=_arrivals, seed=_seed,
+                          payload_format=_payload_format, msg_size=_msg_size, max_inflight=_max_inflight)
+                pub_clients.append(pub)
+            print('Generated %s topics for %s subscribers and %s publishers'
+                  % (len(_workload['topics']), len(_workload['subs']), len(_workload['pubs'])))
 
         if _default_topic is not None:
             if _all is not None:
@@ -642,17 +1580,16 @@ def main(hostname=None):
                 pub = Pub(_hostname, topic=_default_topic, port=_port,
                           client_id='pub' + str(_multiple_topics_cl.publishers + _pub_ind)
                           , tls=_tls, auth=_auth, timeout=_pub_timeout,
-                          max_count=_pub_count, qos=_qos)
-                pub_threads.append(pub)
-                pub.start()
+                          max_count=_pub_count, qos=_qos, rate=_rate, arrivals=_arrivals, seed=_seed,
+                          payload_format=_payload_format, msg_size=_msg_size, max_inflight=_max_inflight)
+                pub_clients.append(pub)
 
             for _sub_ind in range(_sub_clients - _multiple_topics_cl.subscribers):
                 sub = Sub(_hostname, topic=_default_topic, port=_port,
                           client_id='sub' + str(_multiple_topics_cl.subscribers + _sub_ind), tls=_tls,
                           auth=_auth, timeout=_sub_timeout,
-                          max_count=_sub_count, qos=_qos)
-                sub_threads.append(sub)
-                sub.start()
+                          max_count=_sub_count, qos=_qos, significant_figures=_hdr_digits, idle=_sub_idle)
+                sub_clients.append(sub)
 
         elif _default_topic is None and _all is not None:
             # For in case just when we haven't
@@ -660,38 +1597,112 @@ def main(hostname=None):
                 pub = Pub(_hostname, topic=_default_topic, port=_port,
                           client_id='pub' + str(_multiple_topics_cl.publishers + _pub_ind)
                           , tls=_tls, auth=_auth, timeout=_pub_timeout,
-                          max_count=_pub_count, qos=_qos)
-                pub_threads.append(pub)
-                pub.start()
+                          max_count=_pub_count, qos=_qos, rate=_rate, arrivals=_arrivals, seed=_seed,
+                          payload_format=_payload_format, msg_size=_msg_size, max_inflight=_max_inflight)
+                pub_clients.append(pub)
 
             for _sub_ind in range(_sub_clients - _multiple_topics_cl.subscribers):
                 sub = Sub(_hostname, topic=_default_topic, port=_port,
                           client_id='sub' + str(_multiple_topics_cl.subscribers + _sub_ind), tls=_tls,
                           auth=_auth, timeout=_sub_timeout,
-                          max_count=_sub_count, qos=_qos)
-                sub_threads.append(sub)
-                sub.start()
+                          max_count=_sub_count, qos=_qos, significant_figures=_hdr_digits, idle=_sub_idle)
+                sub_clients.append(sub)
 
 
 
 
         #### You can insert the logic of the default as well
 
-    start_timer = datetime.datetime.utcnow()
-    for client in sub_threads:
-        client.join(_sub_timeout)
-        curr_time = datetime.datetime.utcnow()
-        delta = start_timer - curr_time
-        if delta.total_seconds() >= _sub_timeout:
-            raise Exception('Timed out waiting for threads to return')
-
-    start_timer = datetime.datetime.utcnow()
-    for client in pub_threads:
-        client.join(_pub_timeout)
-        curr_time = datetime.datetime.utcnow()
-        delta = start_timer - curr_time
-        if delta.total_seconds() >= _sub_timeout:
-            raise Exception('Timed out waiting for threads to return')
+    if _fast_batch and _tls is not None:
+        raise Exception('The fast path does not support TLS')
+    if _kernel_timestamps and _tls is not None:
+        raise Exception('The kernel timestamps are read with recvmsg, which TLS sockets do not support')
+    for pub in pub_clients:
+        pub.retain = _retain
+        pub.clear_retained = _clear_retained
+        pub.fast_batch = _fast_batch
+    for sub in sub_clients:
+        sub.kernel_timestamps = _kernel_timestamps
+    if _drain:
+        for sub in sub_clients:
+            # The id of the session is the same on every broker of the cluster
+            sub.drain_hostname = _drain_hostname
+            sub.session_id = '%s-%s-%s' % (_description or 'drain', _hostname, sub.client_id)
+
+    # A fixed pool of workers, each one hosting a slice of the clients on its event loop.
+    # The channel only carries the results of each worker, once
+    channel = multiprocessing.Queue(maxsize=4 * _workers)
+    clock = SharedOffset()
+    clock_sync = None
+    if _clock_server is not None:
+        _clock_host, _, _clock_port = _clock_server.partition(':')
+        clock_sync = ClockSync(_clock_host, int(_clock_port or DEFAULT_PORT), interval=_clock_interval,
+                               shared=clock)
+        if clock_sync.sync():
+            print('Clock offset %+.1f us, error +-%.1f us' % (clock.get()[0] / 1e3, clock.get()[1] / 1e3))
+        clock_sync.start()
+    shards = shard_clients(sub_clients + pub_clients, _workers)
+    log_writer = None
+    rings = [None] * len(shards)
+    if _raw_log:
+        rings = [RecordRing(e2e_records.RECORD, _log_ring_size) for _shard in shards]
+        log_writer = LogWriter(log_file, rings, _log_batch_size, _log_flush_interval, log_format=_log_format)
+        log_writer.start()
+    progress = controller = drain_gate = None
+    metrics = []
+    if _control or _metrics_port or _metrics_file or _drain:
+        progress = SharedProgress(len(shards))
+    if _control:
+        controller = Controller(progress, len(sub_clients), len(pub_clients), drain=_drain)
+    if _drain:
+        drain_gate = DrainGate(progress, len(sub_clients))
+    workers = [multiprocessing.Process(target=run_worker,
+                                       args=(_ind, _shard, channel, rings[_ind], _hdr_digits, clock, progress,
+                                             _control, _verify, drain_gate))
+               for _ind, _shard in enumerate(shards)]
+    for worker in workers:
+        worker.start()
+    if controller is not None:
+        # Only once the workers are forked: they close stdin, which the reader thread holds
+        controller.start()
+    elif _drain and sub_clients:
+        ReconnectTrigger(progress, len(sub_clients), len(pub_clients) * _pub_count, _drain_offline, clock).start()
+    if _metrics_port:
+        metrics.append(MetricsServer(progress.rows, _metrics_port))
+        print('Metrics on port %s' % _metrics_port)
+    if _metrics_file:
+        metrics.append(MetricsFile(progress.rows, _metrics_file))
+    for exporter in metrics:
+        exporter.start()
+
+    worker_results = []
+    while len(worker_results) < len(workers):
+        try:
+            kind, worker_id, data = channel.get(timeout=max(_sub_timeout, _pub_timeout))
+        except queue.Empty:
+            if (controller is not None or (_drain and sub_clients)) and not progress.start.value:
+                # The clients are waiting for the coordinator or for the backlog
+                continue
+            print('Timed out waiting for the workers, %s of %s reported' % (len(worker_results), len(workers)))
+            break
+        if kind == 'done':
+            worker_results.append(data)
+
+    for worker in workers:
+        worker.join(1)
+        if worker.is_alive():
+            worker.terminate()
+    if log_writer is not None:
+        log_writer.close()
+        for ring in rings:
+            ring.close()
+    for exporter in metrics:
+        exporter.stop()
+    if clock_sync is not None:
+        clock_sync.stop()
+        if clock_sync.estimates:
+            print('Clock: %s estimates, last offset %+.1f us, error +-%.1f us, drift %.2f ppm'
+                  % (len(clock_sync.estimates), clock.get()[0] / 1e3, clock.get()[1] / 1e3, clock_sync.drift()))
 
     # Check if message has been given as a parameter when the nr of pub is greater than 0
     # if _pub_count > 0 and _msg is None:
@@ -709,47 +1720,91 @@ def main(hostname=None):
     else:
         _active_sub_clients = _sub_clients
 
-    if SUB_QUEUE.qsize() < _active_sub_clients:
-        print('Something went horribly wrong, there are less results than '
-              'sub threads')
-        exit(1)
     _active_pub_clients = 0
     if _multiple_topics_cl is not None:
         _active_pub_clients = _multiple_topics_cl.publishers
     else:
         _active_pub_clients = _pub_clients
-    if PUB_QUEUE.qsize() < _active_pub_clients:
-        print('Something went horribly wrong, there are less results than '
-              'pub threads')
-        exit(1)
 
     sub_times = []
-    for i in range(_active_sub_clients):
-        try:
-            sub_times.append(SUB_QUEUE.get(_sub_timeout))
-        except multiprocessing.queues.Empty:
-            continue
+    pub_times = []
+    latency = HdrHistogram(significant_figures=_hdr_digits)
+    receive_delay = HdrHistogram(significant_figures=_hdr_digits)
+    kernel_latency = HdrHistogram(significant_figures=_hdr_digits)
+    handshake = {step: HdrHistogram(significant_figures=_hdr_digits) for step in HANDSHAKE_STEPS}
+    window_waits = 0
+    window_wait_time = 0.0
+    ring_full_waits = 0
+    delivery = {}
+    drain_times = []
+    retained_times = []
+    health_summaries = []
+    received = published = stale = malformed = 0
+    for result in worker_results:
+        sub_times.extend(result['sub_times'])
+        pub_times.extend(result['pub_times'])
+        received += result['received']
+        published += result['published']
+        latency.merge(result['latency'])
+        receive_delay.merge(result['receive_delay'])
+        kernel_latency.merge(result['kernel_latency'])
+        for step in HANDSHAKE_STEPS:
+            handshake[step].merge(result['handshake'][step])
+        window_waits += result['window_waits']
+        window_wait_time += result['window_wait_time']
+        ring_full_waits += result['ring_full_waits']
+        merge_groups(delivery, result['delivery'])
+        drain_times.extend(result['drain'])
+        retained_times.extend(result['retained'])
+        health_summaries.append(result['health'].summary(_health_cpu, _health_lag / 1e3))
+        stale += result['stale']
+        malformed += result['malformed']
+    if ring_full_waits > 0:
+        print('The log rings were full %s times, the log writer slowed the workers down (--log-ring-size)'
+              % ring_full_waits)
+    health = health_report(health_summaries,
+                           ['log rings full %s times' % ring_full_waits] if ring_full_waits > 0 else [])
+    with open(health_path(_hostname, dest_path='/home/logs', prefix=_description), 'w') as f:
+        json.dump(health, f, indent=2)
+    if health['generator_bound']:
+        print('WARNING: the load generator was the bottleneck of this run (%s), its results measure the '
+              'clients, not the brokers' % '; '.join(health['reasons']))
+    if latency.total > 0:
+        latency.save(histogram_path(_hostname, dest_path='/home/logs', prefix=_description))
+    if latency.clamped > 0:
+        print('%s e2e delays out of the histogram range (clocks out of sync?)' % latency.clamped)
+    e2e = latency.summary()
+    if delivery:
+        save(delivery, delivery_path(_hostname, dest_path='/home/logs', prefix=_description))
+    verified = total(delivery).summary()
+    drained = drain_summary(drain_times) if _drain else None
+    retained = retained_summary(retained_times)
+    if retained_times:
+        with open(retained_path(_hostname, dest_path='/home/logs', prefix=_description), 'w') as f:
+            json.dump(retained, f, indent=2)
+    kernel = None
+    if receive_delay.total > 0:
+        kernel = {'messages': receive_delay.total, 'receive_delay': receive_delay.summary(),
+                  'kernel_e2e': kernel_latency.summary()}
+        with open(kernel_path(_hostname, dest_path='/home/logs', prefix=_description), 'w') as f:
+            json.dump(kernel, f, indent=2)
+    elif _kernel_timestamps and received > 0:
+        print('No kernel receive timestamp, the kernel did not attach SO_TIMESTAMPNS to the reads')
+    if stale > 0:
+        print('%s messages of older sessions with the same ids dropped before parking' % stale)
+    if malformed > 0:
+        print('%s messages with a payload in neither format (truncated or foreign) skipped' % malformed)
+
     if len(sub_times) < _active_sub_clients:
         failed_count = _active_sub_clients - len(sub_times)
         print("%s subscription workers failed" % failed_count)
     sub_times = numpy.array(sub_times)
 
-    pub_times = []
-    for i in range(_active_pub_clients):
-        try:
-            pub_times.append(PUB_QUEUE.get(_pub_timeout))
-        except multiprocessing.queues.Empty:
-            continue
     if len(pub_times) < _active_pub_clients:
         failed_count = _active_pub_clients - len(pub_times)
         print("%s publishing workers failed" % failed_count)
     pub_times = numpy.array(pub_times)
 
-    # Get the log from sub
-    logs = []
-    while not LOG_QUEUE.empty():
-        logs.append(LOG_QUEUE.get(_sub_timeout))
-
     # logs = []
     # for i in range(nr_msg):
     #     try:
@@ -767,9 +1822,6 @@ def main(hostname=None):
     # if LOG_QUEUE.qsize() < nr_msg:
     #     print('Something went wrong with logging. There are less messages logged than sent')
 
-    # Writing the result to log file
-    write(log_file, logs)
-
     # Benchmarking components
     sub_mean_duration = sub_std_duration = sub_avg_throughput = sub_total_thpt = 0
     pub_mean_duration = pub_std_duration = pub_avg_throughput = pub_total_thpt = 0
@@ -780,7 +1832,14 @@ def main(hostname=None):
     print(pub_times)
 
     # Check whether sub are present
-    if _sub_count * _sub_clients > 0:
+    if _sub_idle and len(sub_times) > 0:
+        # The subscribers stopped when idle: the count is what they actually received
+        sub_mean_duration = numpy.mean(sub_times)
+        sub_std_duration = numpy.std(sub_times)
+        if sub_mean_duration > 0:
+            sub_avg_throughput = float(received) / len(sub_times) / float(sub_mean_duration)
+            sub_total_thpt = float(received) / float(sub_mean_duration)
+    elif _sub_count * _sub_clients > 0:
         sub_mean_duration = numpy.mean(sub_times)
         sub_std_duration = numpy.std(sub_times)
         sub_avg_throughput = float(_sub_count) / float(sub_mean_duration)
@@ -793,12 +1852,24 @@ def main(hostname=None):
         pub_total_thpt = float(
             _pub_count * _pub_clients) / float(pub_mean_duration)
 
+    if controller is not None:
+        controller.finish({
+            'sub_clients': _sub_clients, 'pub_clients': _pub_clients,
+            'sub_mean_duration': sub_mean_duration, 'sub_total_throughput': sub_total_thpt,
+            'pub_mean_duration': pub_mean_duration, 'pub_total_throughput': pub_total_thpt,
+            'received': received, 'published': published, 'failed_subs': _active_sub_clients - len(sub_times),
+            'failed_pubs': _active_pub_clients - len(pub_times), 'e2e': e2e, 'delivery': verified,
+            'drain': drained, 'retained': retained, 'kernel': kernel, 'health': health,
+        })
+    if progress is not None:
+        progress.close()
+
     ### Explanation of the parameters:
     # pub_times is the overall publish time for each of the clients,
     # starting from the moment the client is connected to the broker
     # and ending when all the messages (pub_count) has been sent
     if _brief:
-        output = '%s;%s;%s;%s;%s;%s;%s;%s;%s;%s'
+        output = '%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s;%s'
     else:
         output = """\
 [ran with %s subscribers and %s publishers]
@@ -816,6 +1887,19 @@ Avg. publisher duration: %s
 Publisher duration std dev: %s
 Avg. Client Throughput: %s
 Total Throughput (msg_count * clients) / (avg. sub time): %s
+================================================================================
+E2E Delay (us)
+================================================================================
+p50: %s
+p90: %s
+p99: %s
+p99.9: %s
+max: %s
+================================================================================
+Messages received: %s
+Messages published: %s
+Missing: %s, duplicates: %s, reordered: %s
+Generator-bound: %s
 """
     # e2e Delay of msg
     # divide the components of the delay
@@ -833,7 +1917,79 @@ Total Throughput (msg_count * clients) / (avg. sub time): %s
         pub_std_duration,
         pub_avg_throughput,
         pub_total_thpt,
+        e2e['p50'],
+        e2e['p90'],
+        e2e['p99'],
+        e2e['p99.9'],
+        e2e['max'],
+        received,
+        published,
+        verified['missing'],
+        verified['duplicates'],
+        verified['reordered'],
+        int(health['generator_bound']),
     ))
+    if not _brief and delivery:
+        print('=' * 80)
+        print('Delivery')
+        print('=' * 80)
+        print_report(delivery)
+    if not _brief and drained and drained['subscribers']:
+        print('=' * 80)
+        print('Drain (%s -> %s)' % (_hostname, _drain_hostname))
+        print('=' * 80)
+        print('Sessions resumed: %s of %s' % (drained['sessions_present'], drained['subscribers']))
+        print('CONNACK after the reconnection (ms): p50 %s, max %s' % (drained['connack_p50_ms'],
+                                                                      drained['connack_max_ms']))
+        print('First message after the reconnection (ms): p50 %s, max %s' % (drained['first_p50_ms'],
+                                                                            drained['first_max_ms']))
+        print('Drained %s messages in %s s: %s msg/s' % (drained['messages'], drained['drain_time'],
+                                                         drained['throughput']))
+
+    if not _brief and retained_times:
+        print('=' * 80)
+        print('Retained messages')
+        print('=' * 80)
+        print('%s subscribers got %s to %s retained messages' % (retained['subscribers'], retained['min'],
+                                                                retained['max']))
+        print('First one after the subscription (ms): p50 %s, max %s' % (retained['first_p50_ms'],
+                                                                       retained['first_max_ms']))
+        print('Last one after the subscription (ms): p50 %s, max %s' % (retained['last_p50_ms'],
+                                                                       retained['last_max_ms']))
+
+    if not _brief and health_summaries:
+        print('=' * 80)
+        print('Generator health')
+        print('=' * 80)
+        print('worker\tcpu %\tcpu max %\tlag p99 ms\tcallbacks\tcallback p50 us\tp99 us\tcallback %\t'
+              'unread max B\tpaho queued max\tunsent max B')
+        for index, summary in enumerate(health['workers']):
+            print('%s\t%.1f\t%.1f\t%s\t%s\t%s\t%s\t%.1f\t%s\t%s\t%s' % (
+                index, 100 * summary['cpu_share'], 100 * summary['cpu_share_max'], summary['lag_p99_ms'],
+                summary['callbacks'], summary['callback_p50_us'], summary['callback_p99_us'],
+                100 * summary['callback_share'], summary['unread_max_bytes'], summary['paho_queued_max'],
+                summary['unsent_max_bytes']))
+
+    if not _brief and kernel is not None:
+        print('=' * 80)
+        print('Kernel receive timestamps (us, %s messages)' % kernel['messages'])
+        print('=' * 80)
+        for label, summary in [('kernel -> on_message', kernel['receive_delay']),
+                               ('e2e to the kernel arrival', kernel['kernel_e2e'])]:
+            print('%s: p50 %s, p90 %s, p99 %s, max %s' % (label, summary['p50'], summary['p90'], summary['p99'],
+                                                         summary['max']))
+
+    if not _brief and _qos > 0 and _pub_clients > 0:
+        print('=' * 80)
+        print('QoS %s Handshake (us)' % _qos)
+        print('=' * 80)
+        for step in HANDSHAKE_STEPS:
+            if handshake[step].total > 0:
+                summary = handshake[step].summary()
+                print('%s: p50 %s, p99 %s, max %s (%s msgs)' % (step, summary['p50'], summary['p99'],
+                                                                summary['max'], handshake[step].total))
+        print('In-flight window (%s) full %s times, %.3f s waited' % (_max_inflight, window_waits,
+                                                                        window_wait_time))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,218 @@
+import asyncio
+import json
+import multiprocessing
+import sys
+import threading
+import time
+
+from shm_ring import SharedCounters
+
+# container_python.py --control talks to coordinator.py with JSON lines on stdin
+# (commands) and stdout (events); events carry this prefix to stand out of the output
+CONTROL_PREFIX = '@control '
+# Counters of each worker process, see SharedProgress. The e2e fields are the
+# delays (us) of the last seconds, see metrics.RollingHistogram
+PROGRESS_FIELDS = ['subscribed', 'connected', 'received', 'published', 'start_lag', 'sub_connected',
+                   'bytes_received', 'bytes_published', 'disconnects', 'e2e_p50', 'e2e_p90', 'e2e_p99', 'e2e_max',
+                   'e2e_window', 'parked']
+# The fields whose total is the largest value of the workers, not the sum
+MAX_FIELDS = ['start_lag', 'e2e_p50', 'e2e_p90', 'e2e_p99', 'e2e_max']
+PROGRESS_INTERVAL = 1.0
+# Period of the shared counters updates and of the readiness checks
+POLL_INTERVAL = 0.05
+# The last part of the wait for the start is spent spinning, asyncio.sleep is late by up to a ms
+START_SPIN = 0.002
+
+
+def send(kind: str, **fields):
+    """Writes an event for the coordinator"""
+    fields['kind'] = kind
+    sys.stdout.write(CONTROL_PREFIX + json.dumps(fields) + '\n')
+    sys.stdout.flush()
+
+
+def totals(rows: list) -> dict:
+    """Sum of the counters of the workers, the largest value of the MAX_FIELDS"""
+    result = {}
+    for field in PROGRESS_FIELDS:
+        column = [row.get(field, 0) for row in rows]
+        result[field] = (max(column) if field in MAX_FIELDS else sum(column)) if column else 0
+    return result
+
+
+def parse(line: str) -> dict:
+    """The event of an output line, None if it is not one"""
+    if not line.startswith(CONTROL_PREFIX):
+        return None
+    try:
+        return json.loads(line[len(CONTROL_PREFIX):])
+    except ValueError:
+        return None
+
+
+class SharedProgress(object):
+    """Progress of the worker processes, readable by the parent at any time: a
+    row of PROGRESS_FIELDS per worker in shared memory, each written only by its
+    worker, and the start time set by the coordinator (ns, on the reference
+    clock, 0 until set)"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.counters = SharedCounters(workers, PROGRESS_FIELDS)
+        self.start = multiprocessing.RawValue('q', 0)
+
+    def update(self, worker_id: int, report):
+        self.counters.values[worker_id] = [getattr(report, field) for field in PROGRESS_FIELDS]
+
+    def rows(self) -> list:
+        """The counters of each worker"""
+        return [dict(zip(PROGRESS_FIELDS, row)) for row in self.counters.values.tolist()]
+
+    def totals(self) -> dict:
+        return totals(self.rows())
+
+    def close(self):
+        self.counters.close()
+
+
+class ProgressTicker(object):
+    """Background session of a worker copying its counters to the shared progress,
+    with the quantiles of its recent e2e delays every PROGRESS_INTERVAL"""
+
+    def __init__(self, worker_id: int, report, progress: SharedProgress, interval: float = POLL_INTERVAL):
+        self.worker_id = worker_id
+        self.report = report
+        self.progress = progress
+        self.interval = interval
+
+    async def run_async(self, engine):
+        last = time.monotonic()
+        while True:
+            if time.monotonic() - last >= PROGRESS_INTERVAL:
+                last = time.monotonic()
+                self.report.update_rolling()
+            self.progress.update(self.worker_id, self.report)
+            await asyncio.sleep(self.interval)
+
+
+class StartGate(object):
+    """Holds the clients of a worker until the start time of the coordinator.
+    A single waiter polls the shared start time, all the clients of the loop are
+    released together; the lag of the release is kept in the report. In drain
+    mode it holds the parked subscribers, the start is their reconnection"""
+
+    def __init__(self, progress: SharedProgress, report, clock=None):
+        self.progress = progress
+        self.report = report
+        self.clock = clock
+        self._released = None
+
+    async def _wait(self):
+        while self.progress.start.value == 0:
+            await asyncio.sleep(0.001)
+        # local time + offset = reference time
+        offset = self.clock.get()[0] if self.clock is not None else 0
+        start_ns = self.progress.start.value - offset
+        remaining = (start_ns - time.time_ns()) / 1e9
+        if remaining > START_SPIN:
+            await asyncio.sleep(remaining - START_SPIN)
+        while time.time_ns() < start_ns:
+            pass
+        self.report.start_lag = time.time_ns() - start_ns
+
+    async def wait(self):
+        if self._released is None:
+            self._released = asyncio.ensure_future(self._wait())
+        await asyncio.shield(self._released)
+
+
+class DrainGate(object):
+    """Drain mode: holds the publishers of the process until all its subscribers
+    parked their persistent session (subscribed, then disconnected)"""
+
+    def __init__(self, progress: SharedProgress, subscribers: int):
+        self.progress = progress
+        self.subscribers = subscribers
+
+    async def wait(self):
+        while self.progress.totals()['parked'] < self.subscribers:
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+class ReconnectTrigger(threading.Thread):
+    """Drain mode without a coordinator: sets the start time, which reconnects the
+    parked subscribers, offline seconds after all of them parked and the broker
+    acknowledged the backlog of the publishers of the process"""
+
+    def __init__(self, progress: SharedProgress, subscribers: int, backlog: int, offline: float, clock=None):
+        super(ReconnectTrigger, self).__init__(daemon=True)
+        self.progress = progress
+        self.subscribers = subscribers
+        self.backlog = backlog
+        self.offline = offline
+        self.clock = clock
+
+    def run(self):
+        while True:
+            totals = self.progress.totals()
+            if totals['parked'] >= self.subscribers and totals['published'] >= self.backlog:
+                break
+            time.sleep(POLL_INTERVAL)
+        print('%s subscribers offline, %s messages queued for them, reconnecting in %s s'
+              % (self.subscribers, self.backlog, self.offline))
+        # The gate takes the start on the reference clock
+        offset = self.clock.get()[0] if self.clock is not None else 0
+        self.progress.start.value = time.time_ns() + offset + int(self.offline * 1e9)
+
+
+class Controller(object):
+    """Parent side of the control channel: reports the progress of the workers
+    every interval seconds, ready once all the subscribers subscribed (in drain
+    mode parked) and all the publishers connected, and sets the start time sent by
+    the coordinator"""
+
+    def __init__(self, progress: SharedProgress, subscribers: int, publishers: int,
+                 interval: float = PROGRESS_INTERVAL, drain: bool = False):
+        self.progress = progress
+        self.subscribers = subscribers
+        self.publishers = publishers
+        self.interval = interval
+        self._subscribed = 'parked' if drain else 'subscribed'
+        self._ready = False
+        self._halt = threading.Event()
+        self._threads = [threading.Thread(target=self.read_commands, daemon=True),
+                         threading.Thread(target=self.report, daemon=True)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def read_commands(self):
+        for line in sys.stdin:
+            try:
+                command = json.loads(line)
+            except ValueError:
+                continue
+            if command.get('cmd') == 'start':
+                self.progress.start.value = int(command['at'])
+
+    def report(self):
+        last = time.monotonic()
+        while not self._halt.wait(POLL_INTERVAL):
+            totals = self.progress.totals()
+            if not self._ready and totals[self._subscribed] >= self.subscribers \
+                    and totals['connected'] >= self.publishers:
+                self._ready = True
+                send('ready', subscribed=totals['subscribed'], parked=totals['parked'], connected=totals['connected'])
+            if time.monotonic() - last >= self.interval:
+                last = time.monotonic()
+                send('progress', **totals)
+
+    def started(self) -> bool:
+        return self.progress.start.value != 0
+
+    def finish(self, result: dict):
+        self._halt.set()
+        self._threads[1].join()
+        send('progress', **self.progress.totals())
+        send('result', **result)
@@ -0,0 +1,149 @@
+import json
+
+from hdr_histogram import HdrHistogram
+
+LOCALITIES = ['local', 'remote']
+
+
+class DeliveryStats(object):
+    """Delivery counters of a group of streams (a stream is the messages of one
+    publisher on one topic as seen by one subscriber). missing counts the gaps
+    between the first and the last sequence number received of every stream: a
+    message lost after the last one received is only seen comparing with what
+    the publishers sent. reorder holds how far behind the highest sequence
+    number already received each late message arrived"""
+
+    def __init__(self, significant_figures: int = 2):
+        self.streams = 0
+        self.received = 0
+        self.unique = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.missing = 0
+        self.reorder = HdrHistogram(significant_figures=significant_figures)
+
+    def merge(self, other: 'DeliveryStats'):
+        self.streams += other.streams
+        self.received += other.received
+        self.unique += other.unique
+        self.duplicates += other.duplicates
+        self.reordered += other.reordered
+        self.missing += other.missing
+        self.reorder.merge(other.reorder)
+
+    def summary(self) -> dict:
+        expected = self.unique + self.missing
+        return {
+            'streams': self.streams,
+            'received': self.received,
+            'unique': self.unique,
+            'missing': self.missing,
+            'duplicates': self.duplicates,
+            'reordered': self.reordered,
+            'loss_rate': self.missing / expected if expected else 0.0,
+            'duplicate_rate': self.duplicates / self.received if self.received else 0.0,
+            'reorder_rate': self.reordered / self.received if self.received else 0.0,
+            'reorder_distance': self.reorder.summary(),
+        }
+
+
+class Stream(object):
+    """The sequence numbers (from 1) received on a stream, one bit each"""
+    __slots__ = ['bitmap', 'lowest', 'highest', 'unique']
+
+    def __init__(self):
+        self.bitmap = bytearray(128)
+        self.lowest = None
+        self.highest = 0
+        self.unique = 0
+
+
+class DeliveryTracker(object):
+    """Delivery verification of one subscriber: a bitmap per stream, grouped by
+    (QoS, locality) for the report. Locality is local when the publisher is
+    connected to the broker of the subscriber (the hosts are the broker addresses)"""
+
+    def __init__(self, hostname: str):
+        self.hostname = hostname
+        self.streams = {}
+        self.groups = {}
+
+    def group(self, qos: int, locality: str) -> DeliveryStats:
+        key = (qos, locality)
+        stats = self.groups.get(key)
+        if stats is None:
+            stats = self.groups[key] = DeliveryStats()
+        return stats
+
+    def record(self, pub_host: str, pub_id, topic: str, seq: int, qos: int) -> bool:
+        """Checks a message in, False if it is a duplicate"""
+        key = (pub_host, pub_id, topic, qos)
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = Stream()
+        stats = self.group(qos, 'local' if pub_host == self.hostname else 'remote')
+        stats.received += 1
+        index, bit = seq >> 3, 1 << (seq & 7)
+        if index >= len(stream.bitmap):
+            stream.bitmap.extend(bytes(max(index + 1, 2 * len(stream.bitmap)) - len(stream.bitmap)))
+        if stream.bitmap[index] & bit:
+            stats.duplicates += 1
+            return False
+        stream.bitmap[index] |= bit
+        stream.unique += 1
+        if seq < stream.highest:
+            stats.reordered += 1
+            stats.reorder.record(stream.highest - seq)
+        else:
+            stream.highest = seq
+        if stream.lowest is None or seq < stream.lowest:
+            stream.lowest = seq
+        return True
+
+    def stats(self) -> dict:
+        """{(qos, locality): DeliveryStats} with the gaps of every stream counted"""
+        groups = {}
+        for key, stats in self.groups.items():
+            groups[key] = DeliveryStats()
+            groups[key].merge(stats)
+        for (pub_host, _pub_id, _topic, qos), stream in self.streams.items():
+            stats = groups[(qos, 'local' if pub_host == self.hostname else 'remote')]
+            stats.streams += 1
+            stats.unique += stream.unique
+            stats.missing += stream.highest - stream.lowest + 1 - stream.unique
+        return groups
+
+
+def merge_groups(target: dict, groups: dict):
+    """Adds {(qos, locality): DeliveryStats} groups to target"""
+    for key, stats in groups.items():
+        if key not in target:
+            target[key] = DeliveryStats()
+        target[key].merge(stats)
+
+
+def total(groups: dict) -> DeliveryStats:
+    result = DeliveryStats()
+    for stats in groups.values():
+        result.merge(stats)
+    return result
+
+
+def report(groups: dict) -> list:
+    """The summary of every group, sorted by QoS and locality"""
+    return [dict(qos=qos, locality=locality, **groups[(qos, locality)].summary())
+            for qos, locality in sorted(groups)]
+
+
+def save(groups: dict, path: str):
+    with open(path, 'w') as f:
+        json.dump(report(groups), f, indent=2)
+
+
+def print_report(groups: dict):
+    print('QoS\tlocality\tstreams\treceived\tunique\tmissing\tloss %\tdup %\treordered\treorder p99\treorder max')
+    for row in report(groups):
+        print('%s\t%s\t%s\t%s\t%s\t%s\t%.4f\t%.4f\t%s\t%s\t%s' % (
+            row['qos'], row['locality'], row['streams'], row['received'], row['unique'], row['missing'],
+            100 * row['loss_rate'], 100 * row['duplicate_rate'], row['reordered'],
+            row['reorder_distance']['p99'], row['reorder_distance']['max']))
@@ -0,0 +1,326 @@
+import argparse
+import datetime
+import functools
+import os
+import re
+import socket
+import struct
+
+import numpy
+
+# One received message. Timestamps are ns since the epoch (UTC), UNKNOWN when the
+# source does not carry them; hosts are IPv4 addresses as integers (0 if unknown)
+# and client ids the number in the client name (-1 if unknown). clock_offset is
+# added to arrival to put it on the clock of the publisher, clock_error bounds it
+# (-1 if the hosts were not synced, see clock_sync.py). kernel_arrival is the time
+# the kernel of the subscriber received the message (--kernel-timestamps, see
+# kernel_time.py), UNKNOWN without it
+_FIELDS_V1 = [
+    ('connect_init', '<i8'),
+    ('connect_ack', '<i8'),
+    ('publish', '<i8'),
+    ('intended', '<i8'),
+    ('arrival', '<i8'),
+    ('seq', '<i8'),
+    ('pub_host', '<u4'),
+    ('pub_id', '<i4'),
+    ('sub_host', '<u4'),
+    ('sub_id', '<i4'),
+    ('qos', '<i4'),
+]
+_FIELDS_V2 = _FIELDS_V1 + [
+    ('clock_offset', '<i8'),
+    ('clock_error', '<i8'),
+]
+RECORD = numpy.dtype(_FIELDS_V2 + [
+    ('kernel_arrival', '<i8'),
+])
+# Version 1 files have no clock offset, version 2 files no kernel arrival
+RECORD_V1 = numpy.dtype(_FIELDS_V1)
+RECORD_V2 = numpy.dtype(_FIELDS_V2)
+UNKNOWN = numpy.iinfo(numpy.int64).min
+
+# File header: magic, format version, record size
+FILE_HEADER = struct.Struct('<8sII')
+MAGIC = b'MQTTE2E\0'
+VERSION = 3
+EXTENSION = '.e2e'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+_CLIENT_NUMBER = re.compile(r'(\d+)')
+
+
+@functools.lru_cache(maxsize=1024)
+def host_to_int(hostname: str) -> int:
+    try:
+        return struct.unpack('!I', socket.inet_aton(hostname))[0]
+    except (OSError, TypeError):
+        return 0
+
+
+@functools.lru_cache(maxsize=1024)
+def int_to_host(value: int) -> str:
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+@functools.lru_cache(maxsize=65536)
+def client_number(client_id: str) -> int:
+    match = _CLIENT_NUMBER.search(client_id or '')
+    return int(match.group(1)) if match else -1
+
+
+def create(path: str):
+    """Creates (or truncates) a record file, writing its header"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(FILE_HEADER.pack(MAGIC, VERSION, RECORD.itemsize))
+
+
+def append(path: str, records: numpy.ndarray):
+    """Appends records to a file created by create(). The file only grows by
+    whole records, a reader can map it while it is being written"""
+    with open(path, 'ab') as f:
+        f.write(records.astype(RECORD, copy=False).tobytes())
+
+
+def load(path: str) -> numpy.ndarray:
+    """Maps a record file read only, no parsing and no copy.
+    A trailing partial record (a writer killed mid-write) is ignored.
+    Older files are mapped with RECORD_V1 or RECORD_V2, without the newer fields"""
+    with open(path, 'rb') as f:
+        magic, version, size = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+    if magic != MAGIC:
+        raise Exception('%s is not an e2e record file' % path)
+    dtype = {VERSION: RECORD, 2: RECORD_V2, 1: RECORD_V1}.get(version)
+    if dtype is None or size != dtype.itemsize:
+        raise Exception('Unsupported e2e record file version %s (record size %s)' % (version, size))
+    count = (os.path.getsize(path) - FILE_HEADER.size) // dtype.itemsize
+    if count == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode='r', offset=FILE_HEADER.size, shape=(count,))
+
+
+def open_tree(root: str) -> dict:
+    """Maps every record file below root
+    :return: {path: records}
+    """
+    found = {}
+    for folder, _dirs, files in os.walk(root):
+        for name in sorted(files):
+            if name.endswith(EXTENSION):
+                path = os.path.join(folder, name)
+                found[path] = load(path)
+    return found
+
+
+def e2e_delay(records: numpy.ndarray) -> numpy.ndarray:
+    """e2e delay in ns from the intended send time, the publish time if the
+    intended one is unknown, corrected by the clock offset"""
+    sent = numpy.where(records['intended'] != UNKNOWN, records['intended'], records['publish'])
+    if 'clock_offset' in records.dtype.names:
+        return records['arrival'] + records['clock_offset'] - sent
+    return records['arrival'] - sent
+
+
+def receive_delay(records: numpy.ndarray) -> numpy.ndarray:
+    """Time in ns the subscriber took from the kernel receive time to its own
+    arrival time, the part of the e2e delay spent in the client. Only the records
+    with a kernel arrival"""
+    if 'kernel_arrival' not in records.dtype.names:
+        return numpy.zeros(0, dtype='<i8')
+    timestamped = records[records['kernel_arrival'] != UNKNOWN]
+    return timestamped['arrival'] - timestamped['kernel_arrival']
+
+
+def from_log_tuples(rows: list) -> numpy.ndarray:
+    """Records from the raw log tuples of container_python.py:
+    (pub_host, pub_id, connect_init, connect_ack, publish, intended, qos, sub_host, sub_id, arrival, seq,
+    clock_offset, clock_error, kernel_arrival)
+    """
+    records = numpy.empty(len(rows), dtype=RECORD)
+    for ind, row in enumerate(rows):
+        records[ind] = record_values(row)
+    return records
+
+
+def record_values(row: tuple) -> tuple:
+    """The RECORD fields of a raw log tuple of container_python.py, see from_log_tuples.
+    Hosts and client ids are converted once, the conversions are cached"""
+    pub_host, pub_id, init_ns, ack_ns, pub_ns, intended_ns, qos, sub_host, sub_id, arrival_ns, seq, \
+        clock_offset, clock_error, kernel_ns = row
+    return (init_ns, ack_ns, pub_ns, intended_ns, arrival_ns, -1 if seq is None else seq,
+            host_to_int(pub_host), client_number(pub_id), host_to_int(sub_host), client_number(sub_id), qos,
+            clock_offset, clock_error, kernel_ns)
+
+
+def _datetime_to_ns(value: str) -> int:
+    # str(datetime) omits the fraction when it is zero, fromisoformat reads both
+    return (datetime.datetime.fromisoformat(value) - EPOCH) // ONE_MICROSECOND * 1000
+
+
+def time_of_day_to_ns(value: str, reference_ns: int) -> int:
+    """The time of day of the pub_thread.py payloads (HH:MM:SS.mmm, UTC in the
+    containers) as ns since the epoch, on the day of reference_ns. mosquitto_sub.py
+    strips the dot"""
+    hours, minutes, seconds = value.strip().split(':')
+    if '.' not in seconds:
+        seconds = seconds[:2] + '.' + seconds[2:]
+    offset = datetime.timedelta(hours=int(hours), minutes=int(minutes), seconds=float(seconds))
+    reference = EPOCH + datetime.timedelta(microseconds=reference_ns // 1000)
+    value = datetime.datetime.combine(reference.date(), datetime.time()) + offset
+    # Sent before midnight, received after
+    if value - reference > datetime.timedelta(hours=12):
+        value -= datetime.timedelta(days=1)
+    return (value - EPOCH) // ONE_MICROSECOND * 1000
+
+
+def split_pub_thread_payload(payload: str) -> tuple:
+    """(publisher broker, publisher number, sent time of day, sequence number) of a
+    pub_thread.py payload, 'src_brk,client_num,sent,msg_id'. The first payloads
+    only had the time: (None, -1, sent, -1)"""
+    fields = payload.split(',')
+    if len(fields) != 4:
+        return None, -1, payload, -1
+    return fields[0], int(fields[1]), fields[2], int(fields[3])
+
+
+def _warn_skipped(f, skipped: int):
+    """The rows of a text e2e file a reader could not parse, e.g. the last line of a killed client"""
+    if skipped:
+        print('WARNING: skipped {} unreadable rows of {}'.format(skipped, getattr(f, 'name', 'the log')))
+
+
+def _read_container_csv(f) -> list:
+    """The ';' log of container_python.py. The first logs had 10 columns, without
+    the intended publish time (taken as the publish time) and the sequence number"""
+    rows = []
+    skipped = 0
+    for line in f:
+        fields = line.rstrip('\r\n').split(';')
+        try:
+            if len(fields) == 10:
+                pub_host, pub_id, init, ack, pub, qos, sub_host, sub_id, arrival = fields[:9]
+                intended = pub
+            else:
+                pub_host, pub_id, init, ack, pub, intended, qos, sub_host, sub_id, arrival = fields[:10]
+            # The clock columns were added later
+            clock_offset, clock_error = (int(fields[11]), int(fields[12])) if len(fields) >= 13 else (0, -1)
+            kernel = int(fields[13]) if len(fields) >= 14 and fields[13] else UNKNOWN
+            rows.append((_datetime_to_ns(init), _datetime_to_ns(ack), _datetime_to_ns(pub),
+                         _datetime_to_ns(intended), _datetime_to_ns(arrival), -1, host_to_int(pub_host),
+                         client_number(pub_id), host_to_int(sub_host), client_number(sub_id), int(qos), clock_offset,
+                         clock_error, kernel))
+        except ValueError:
+            skipped += 1
+    _warn_skipped(f, skipped)
+    return rows
+
+
+def _read_sub_thread_csv(f) -> list:
+    """The ',' e2e file of sub_thread.py: receiver, client, the payload (see
+    split_pub_thread_payload), received ms, qos and, with --kernel-timestamps,
+    the kernel receive time in ns"""
+    rows = []
+    skipped = 0
+    kernel_column = False
+    for line in f:
+        fields = line.rstrip('\r\n').split(',')
+        if fields[0] == 'receiver_brk':
+            kernel_column = fields[-1] == 'kernel_received_ns'
+            continue
+        try:
+            kernel = UNKNOWN
+            if kernel_column and len(fields) in (6, 9):
+                kernel = int(fields.pop())
+            if len(fields) not in (5, 8):
+                raise ValueError('%s columns' % len(fields))
+            sub_host, sub_id = fields[:2]
+            received, qos = fields[-2:]
+            pub_host, pub_id, sent, seq = split_pub_thread_payload(','.join(fields[2:-2]))
+            arrival = int(received) * 10 ** 6
+            rows.append((UNKNOWN, UNKNOWN, UNKNOWN, time_of_day_to_ns(sent, arrival), arrival, seq,
+                         host_to_int(pub_host), pub_id, host_to_int(sub_host), client_number(sub_id), int(qos), 0,
+                         -1, kernel))
+        except ValueError:
+            skipped += 1
+    _warn_skipped(f, skipped)
+    return rows
+
+
+def _read_mosquitto_sub(f, sub_id: int) -> list:
+    """The e2e files of mosquitto_sub.py: 'seconds.us topic payload' lines from ts,
+    or 'secondsus,topic,payload' once the sed of mosquitto_sub.py ran"""
+    rows = []
+    skipped = 0
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if ' ' in line:
+                received, _topic, sent = line.split(None, 2)
+                arrival = int(round(float(received) * 10 ** 6)) * 1000
+                pub_host, pub_id, sent, seq = split_pub_thread_payload(sent)
+            else:
+                received, _topic, sent = line.split(',', 2)
+                arrival = int(received) * 1000
+                pub_host, pub_id, sent, seq = split_pub_thread_payload(sent)
+                # The sed also stripped the dots of the publisher broker
+                pub_host = None
+            rows.append((UNKNOWN, UNKNOWN, UNKNOWN, time_of_day_to_ns(sent, arrival), arrival, seq,
+                         host_to_int(pub_host), pub_id, 0, sub_id, -1, 0, -1, UNKNOWN))
+        except ValueError:
+            skipped += 1
+    _warn_skipped(f, skipped)
+    return rows
+
+
+def read_csv(path: str) -> numpy.ndarray:
+    """Parses an e2e file of any of the clients, the layout is told by its first line"""
+    with open(path) as f:
+        first = f.readline()
+        if first.startswith('hostname_origin;'):
+            rows = _read_container_csv(f)
+        elif first.startswith('receiver_brk,'):
+            f.seek(0)
+            rows = _read_sub_thread_csv(f)
+        else:
+            f.seek(0)
+            rows = _read_mosquitto_sub(f, client_number(re.sub(r'^e2e_c', '', os.path.basename(path))))
+    return numpy.array(rows, dtype=RECORD)
+
+
+def convert(path: str) -> str:
+    """Writes the records of a text e2e file next to it (same name + .e2e)"""
+    output = path + EXTENSION
+    create(output)
+    append(output, read_csv(path))
+    return output
+
+
+def convert_tree(root: str) -> list:
+    """Converts every text e2e file below root: the container_python.py logs
+    (*_log_*.csv) and the sub_thread.py / mosquitto_sub.py e2e* files"""
+    converted = []
+    for folder, _dirs, files in os.walk(root):
+        for name in sorted(files):
+            if name.endswith(EXTENSION):
+                continue
+            if re.match(r'.*_log_\d+\.csv$', name) or name.startswith('e2e'):
+                converted.append(convert(os.path.join(folder, name)))
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts the text e2e results to memory-mappable record files')
+    parser.add_argument('paths', nargs='+', help='e2e files or experiment folders')
+    args = parser.parse_args()
+    for path in args.paths:
+        outputs = convert_tree(path) if os.path.isdir(path) else [convert(path)]
+        for output in outputs:
+            print('{} ({} records)'.format(output, len(load(output))))
+
+
+if __name__ == '__main__':
+    main()
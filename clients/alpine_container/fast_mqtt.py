@@ -0,0 +1,250 @@
+import asyncio
+import socket
+import struct
+
+# First byte of the MQTT 3.1.1 packets of the fast path
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+PINGREQ = b'\xc0\x00'
+PINGRESP = b'\xd0\x00'
+DISCONNECT = b'\xe0\x00'
+PROTOCOL_LEVEL = 4
+MAX_REMAINING_LENGTH = 268435455
+# Buffers a single sendmsg takes on Linux (IOV_MAX), a message is up to 3 of them
+IOV_MAX = 1024
+# Packet ids and the lengths of strings
+UINT16 = struct.Struct('!H')
+
+
+def remaining_length(length: int) -> bytes:
+    """The variable-length encoding of the remaining length of a packet"""
+    if length > MAX_REMAINING_LENGTH:
+        raise Exception('An MQTT packet is at most %s bytes' % MAX_REMAINING_LENGTH)
+    encoded = bytearray()
+    while True:
+        length, byte = divmod(length, 128)
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def string_field(value) -> bytes:
+    data = value.encode('utf-8') if isinstance(value, str) else bytes(value)
+    return UINT16.pack(len(data)) + data
+
+
+def connect_packet(client_id: str, keepalive: int = 60, clean_session: bool = True, username: str = None,
+                   password: str = None) -> bytes:
+    flags = 0x02 if clean_session else 0
+    payload = string_field(client_id)
+    if username is not None:
+        flags |= 0x80
+        payload += string_field(username)
+        if password is not None:
+            flags |= 0x40
+            payload += string_field(password)
+    variable = string_field('MQTT') + bytes([PROTOCOL_LEVEL, flags]) + UINT16.pack(keepalive)
+    return bytes([CONNECT]) + remaining_length(len(variable) + len(payload)) + variable + payload
+
+
+def publish_prefix(topic: str, payload_size: int, qos: int = 0, retain: bool = False) -> bytes:
+    """Fixed header and topic of a PUBLISH, encoded once per topic. The packet is
+    this prefix, the packet id (QoS 1/2) and the payload"""
+    topic_field = string_field(topic)
+    length = len(topic_field) + (UINT16.size if qos else 0) + payload_size
+    return bytes([PUBLISH | qos << 1 | int(retain)]) + remaining_length(length) + topic_field
+
+
+def read_packets(buffer: bytearray) -> list:
+    """Removes the complete packets from the start of buffer and returns them as
+    (first byte, body) tuples, an incomplete packet stays for the next read"""
+    packets = []
+    start = 0
+    while len(buffer) - start >= 2:
+        length, shift, pos = 0, 0, start + 1
+        while pos < len(buffer) and pos - start <= 4:
+            byte = buffer[pos]
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            pos += 1
+            if not byte & 0x80:
+                break
+        else:
+            break
+        if len(buffer) < pos + length:
+            break
+        packets.append((buffer[start], bytes(buffer[pos:pos + length])))
+        start = pos + length
+    del buffer[:start]
+    return packets
+
+
+class FastConnection(object):
+    """Publisher side of an MQTT 3.1.1 connection, without paho: the messages are
+    staged as their buffers (the pre-encoded prefix of the topic, the packet id,
+    the payload) and a flush sends all the staged ones with a single sendmsg
+    (writev), without joining them. What the socket does not take is copied and
+    sent once it is writable, so the staged buffers can be reused after a flush.
+    on_publish(client, userdata, mid) is called like the paho callback: at the
+    flush for QoS 0, at the PUBACK for QoS 1. QoS 2 is not supported"""
+
+    def __init__(self, loop, on_publish=None, on_disconnect=None, keepalive: int = 60):
+        self.loop = loop
+        self.on_publish = on_publish
+        self.on_disconnect = on_disconnect
+        self.keepalive = keepalive
+        self.sock = None
+        self.connected = False
+        # Messages staged for the next flush, and how many of them are QoS 0
+        self.staged = 0
+        self._buffers = []
+        self._staged_qos0 = 0
+        self._mid = 0
+        self._out = bytearray()
+        self._in = bytearray()
+        self._connack = None
+        self._drained = None
+        self._ping = None
+
+    async def connect(self, hostname: str, port: int = 1883, client_id: str = '', clean_session: bool = True,
+                      auth: dict = None) -> int:
+        """Opens the TCP connection, sends CONNECT and returns the CONNACK return code"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await self.loop.sock_connect(sock, (hostname, port))
+        except OSError:
+            sock.close()
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self._connack = self.loop.create_future()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self.loop.add_reader(sock, self._read)
+        auth = auth or {}
+        self._send([connect_packet(client_id, self.keepalive, clean_session, auth.get('username'),
+                                   auth.get('password'))])
+        rc = await self._connack
+        if rc == 0:
+            self.connected = True
+            self._ping = self.loop.create_task(self._keepalive())
+        return rc
+
+    def next_mid(self) -> int:
+        self._mid = self._mid % 65535 + 1
+        return self._mid
+
+    def stage(self, prefix: bytes, mid: int = None, payload=None):
+        """Adds a PUBLISH to the next flush: the publish_prefix of its topic, its
+        packet id (None for QoS 0) and its payload, which must not change until
+        the flush"""
+        self._buffers.append(prefix)
+        if mid is None:
+            self._staged_qos0 += 1
+        else:
+            self._buffers.append(UINT16.pack(mid))
+        if payload is not None:
+            self._buffers.append(payload)
+        self.staged += 1
+        if len(self._buffers) > IOV_MAX - 3:
+            self.flush()
+
+    def flush(self):
+        """Sends the staged messages"""
+        if not self._buffers:
+            return
+        buffers, self._buffers = self._buffers, []
+        published, self._staged_qos0 = self._staged_qos0, 0
+        self.staged = 0
+        self._send(buffers)
+        for _ in range(published):
+            self.on_publish(self, None, 0)
+
+    async def drain(self):
+        """Waits until the socket took all the sent bytes"""
+        if self._out:
+            await self._drained.wait()
+
+    async def disconnect(self):
+        self.flush()
+        await self.drain()
+        if self.connected:
+            self._send([DISCONNECT])
+        self._lost(0)
+
+    def _send(self, buffers: list):
+        if self.sock is None:
+            raise Exception('The connection is closed')
+        if self._out:
+            # Behind the bytes the socket did not take yet
+            self._out += b''.join(buffers)
+            return
+        try:
+            sent = self.sock.sendmsg(buffers)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._lost(1)
+            return
+        if sent < sum(map(len, buffers)):
+            self._out += b''.join(buffers)[sent:]
+            self._drained.clear()
+            self.loop.add_writer(self.sock, self._write)
+
+    def _write(self):
+        try:
+            sent = self.sock.send(self._out)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._lost(1)
+            return
+        del self._out[:sent]
+        if not self._out:
+            self.loop.remove_writer(self.sock)
+            self._drained.set()
+
+    def _read(self):
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._lost(1)
+            return
+        self._in += data
+        for header, body in read_packets(self._in):
+            kind = header & 0xf0
+            if kind == PUBACK:
+                self.on_publish(self, None, UINT16.unpack_from(body)[0])
+            elif kind == CONNACK and not self._connack.done():
+                self._connack.set_result(body[1])
+
+    async def _keepalive(self):
+        while True:
+            await asyncio.sleep(self.keepalive)
+            if not self._buffers and not self._out:
+                self._send([PINGREQ])
+
+    def _lost(self, rc: int):
+        if self.sock is None:
+            return
+        self.loop.remove_reader(self.sock)
+        self.loop.remove_writer(self.sock)
+        self.sock.close()
+        self.sock = None
+        self._out.clear()
+        self._drained.set()
+        if self._ping is not None:
+            self._ping.cancel()
+        if not self._connack.done():
+            self._connack.set_exception(ConnectionError('Connection closed by the broker'))
+        if self.connected:
+            self.connected = False
+            if self.on_disconnect is not None:
+                self.on_disconnect(self, None, rc)
@@ -0,0 +1,132 @@
+import json
+import math
+
+# Latency percentiles reported by the benchmark
+PERCENTILES = [50.0, 90.0, 99.0, 99.9]
+
+
+class HdrHistogram(object):
+    """High dynamic range histogram of integer values (the bucket layout of
+    HdrHistogram): any value between lowest and highest is recorded with
+    significant_figures decimal digits of precision, whatever its magnitude.
+    Counts are kept in a dict indexed by bucket, so an idle histogram costs a
+    few bytes and histograms with the same layout merge by adding counts.
+    Negative values and values above highest are clamped and counted in clamped"""
+
+    def __init__(self, lowest: int = 1, highest: int = 3600 * 10 ** 6, significant_figures: int = 3):
+        if lowest < 1:
+            raise Exception('The lowest trackable value must be at least 1')
+        if highest < 2 * lowest:
+            raise Exception('The highest trackable value must be at least twice the lowest')
+        if significant_figures < 1 or significant_figures > 5:
+            raise Exception('The significant figures must be between 1 and 5')
+        self.lowest = lowest
+        self.highest = highest
+        self.significant_figures = significant_figures
+        self.unit_magnitude = int(math.floor(math.log2(lowest)))
+        self.sub_bucket_count_magnitude = int(math.ceil(math.log2(2 * 10 ** significant_figures)))
+        self.sub_bucket_half_count_magnitude = self.sub_bucket_count_magnitude - 1
+        self.sub_bucket_count = 1 << self.sub_bucket_count_magnitude
+        self.sub_bucket_half_count = self.sub_bucket_count >> 1
+        self.sub_bucket_mask = (self.sub_bucket_count - 1) << self.unit_magnitude
+        self.counts = {}
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.clamped = 0
+
+    def layout(self) -> tuple:
+        return self.lowest, self.highest, self.significant_figures
+
+    def _index(self, value: int) -> int:
+        bucket = (value | self.sub_bucket_mask).bit_length() - self.unit_magnitude - self.sub_bucket_count_magnitude
+        sub_bucket = value >> (bucket + self.unit_magnitude)
+        return ((bucket + 1) << self.sub_bucket_half_count_magnitude) + sub_bucket - self.sub_bucket_half_count
+
+    def _highest_equivalent(self, index: int) -> int:
+        """The highest value counted at index"""
+        bucket = (index >> self.sub_bucket_half_count_magnitude) - 1
+        sub_bucket = (index & (self.sub_bucket_half_count - 1)) + self.sub_bucket_half_count
+        if bucket < 0:
+            sub_bucket -= self.sub_bucket_half_count
+            bucket = 0
+        return ((sub_bucket + 1) << (bucket + self.unit_magnitude)) - 1
+
+    def record(self, value: int, count: int = 1):
+        if value < 0:
+            # e.g. an e2e delay across two hosts whose clocks are not in sync
+            self.clamped += count
+            value = 0
+        elif value > self.highest:
+            self.clamped += count
+            value = self.highest
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.total += count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other: 'HdrHistogram'):
+        if other.layout() != self.layout():
+            raise Exception('Cannot merge histograms with different layouts %s and %s'
+                            % (self.layout(), other.layout()))
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.clamped += other.clamped
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, percentile: float) -> int:
+        """The value below which percentile % of the recorded values fall
+        (within the precision of the histogram), None if empty"""
+        if self.total == 0:
+            return None
+        rank = max(1, int(math.ceil(percentile / 100.0 * self.total)))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._highest_equivalent(index), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """p50, p90, p99, p99.9 and max"""
+        result = {'p%g' % percentile: self.percentile(percentile) for percentile in PERCENTILES}
+        result['max'] = self.max
+        return result
+
+    def to_dict(self) -> dict:
+        return {
+            'lowest': self.lowest,
+            'highest': self.highest,
+            'significant_figures': self.significant_figures,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'clamped': self.clamped,
+            'counts': [[index, count] for index, count in sorted(self.counts.items())],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'HdrHistogram':
+        histogram = cls(data['lowest'], data['highest'], data['significant_figures'])
+        histogram.counts = {index: count for index, count in data['counts']}
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        histogram.clamped = data['clamped']
+        return histogram
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path: str) -> 'HdrHistogram':
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,177 @@
+import asyncio
+import fcntl
+import struct
+import termios
+import threading
+import time
+
+from hdr_histogram import HdrHistogram
+
+# Self-health of the load generator: a run is generator-bound, and its results
+# measure our clients rather than the brokers, when a process was busy for most
+# of the time the messages flowed, when its event loop (or its threads) woke up
+# late, or when its sockets kept unread data most of the time
+HEALTH_INTERVAL = 1.0
+CPU_THRESHOLD = 0.9
+LAG_THRESHOLD = 0.05
+# Unread bytes of a socket from which the client counts as behind
+BACKLOG_BYTES = 64 * 1024
+# Share of the active samples a client must be behind in
+BACKLOG_SHARE = 0.5
+# SIOCINQ and SIOCOUTQ of a TCP socket
+_UNREAD = termios.FIONREAD
+_UNSENT = termios.TIOCOUTQ
+_INT = struct.Struct('i')
+
+
+def socket_queues(sock) -> tuple:
+    """(bytes received not read yet, bytes sent not acknowledged by the peer) of a socket"""
+    try:
+        unread = _INT.unpack(fcntl.ioctl(sock.fileno(), _UNREAD, b'\0' * _INT.size))[0]
+        unsent = _INT.unpack(fcntl.ioctl(sock.fileno(), _UNSENT, b'\0' * _INT.size))[0]
+    except (OSError, ValueError):
+        return 0, 0
+    return unread, unsent
+
+
+def client_socket(client):
+    """The socket of a paho client or of a fast_mqtt.FastConnection, None when closed"""
+    if hasattr(client, 'sock'):
+        return client.sock
+    return client.socket()
+
+
+class HealthStats(object):
+    """Self-health of one process of the load generator: the cost of its on_message
+    callbacks (ns), the share of a core it used and the lag of its wake-ups in each
+    sample, and the backlogs of its clients: bytes the kernel holds for them unread,
+    packets paho has not written yet and bytes the broker did not acknowledge yet.
+    The outgoing backlogs grow with a slow broker too, they are reported but not
+    flagged. Only the samples in which messages flowed (active) are judged"""
+
+    def __init__(self):
+        self.callback = HdrHistogram(significant_figures=2)
+        self.callback_ns = 0
+        self.lag = HdrHistogram(significant_figures=2)
+        self.samples = 0
+        self.active = 0
+        self.active_wall = 0.0
+        self.active_cpu = 0.0
+        self.cpu_max = 0.0
+        self.behind = 0
+        self.unread_max = 0
+        self.queued_max = 0
+        self.unsent_max = 0
+
+    def record_callback(self, cost_ns: int):
+        self.callback.record(cost_ns)
+        self.callback_ns += cost_ns
+
+    def record_sample(self, wall: float, cpu: float, lag: float, active: bool, clients: list):
+        self.samples += 1
+        self.lag.record(max(int(lag * 1e6), 0))
+        if not active:
+            return
+        self.active += 1
+        self.active_wall += wall
+        self.active_cpu += cpu
+        self.cpu_max = max(self.cpu_max, cpu / wall if wall > 0 else 0)
+        unread_max = 0
+        for client in clients:
+            sock = client_socket(client)
+            if sock is None:
+                continue
+            unread, unsent = socket_queues(sock)
+            unread_max = max(unread_max, unread)
+            self.unsent_max = max(self.unsent_max, unsent)
+            self.queued_max = max(self.queued_max, len(getattr(client, '_out_packet', ())))
+        self.unread_max = max(self.unread_max, unread_max)
+        if unread_max >= BACKLOG_BYTES:
+            self.behind += 1
+
+    def summary(self, cpu_threshold: float = CPU_THRESHOLD, lag_threshold: float = LAG_THRESHOLD) -> dict:
+        """The figures of the process and the reasons it was the bottleneck, if any"""
+        cpu = self.active_cpu / self.active_wall if self.active_wall > 0 else 0.0
+        lag_p99 = (self.lag.percentile(99) or 0) / 1e6
+        reasons = []
+        if self.active and cpu >= cpu_threshold:
+            reasons.append('cpu %.0f%%' % (100 * cpu))
+        if self.active and lag_p99 >= lag_threshold:
+            reasons.append('wake-up lag p99 %.0f ms' % (lag_p99 * 1e3))
+        if self.active and self.behind >= BACKLOG_SHARE * self.active:
+            reasons.append('unread socket data in %s of %s samples' % (self.behind, self.active))
+        return {
+            'active_samples': self.active,
+            'cpu_share': round(cpu, 3),
+            'cpu_share_max': round(self.cpu_max, 3),
+            'lag_p99_ms': round(lag_p99 * 1e3, 3),
+            'callbacks': self.callback.total,
+            'callback_p50_us': round((self.callback.percentile(50) or 0) / 1e3, 3),
+            'callback_p99_us': round((self.callback.percentile(99) or 0) / 1e3, 3),
+            'callback_share': round(self.callback_ns / 1e9 / self.active_wall, 3) if self.active_wall > 0 else 0.0,
+            'unread_max_bytes': self.unread_max,
+            'paho_queued_max': self.queued_max,
+            'unsent_max_bytes': self.unsent_max,
+            'reasons': reasons,
+        }
+
+
+def health_report(summaries: list, extra_reasons: list = ()) -> dict:
+    """The verdict of a run from the summaries of its processes (workers)"""
+    reasons = list(extra_reasons)
+    for index, summary in enumerate(summaries):
+        reasons.extend('worker %s: %s' % (index, reason) for reason in summary['reasons'])
+    return {'generator_bound': bool(reasons), 'reasons': reasons, 'workers': summaries}
+
+
+class Sampler(object):
+    """Takes a sample of the process every interval: its CPU share, how late it
+    woke up, and the backlogs of the clients. activity() is a counter that moves
+    while messages flow, clients() the connected clients"""
+
+    def __init__(self, stats: HealthStats, clients, activity, interval: float = HEALTH_INTERVAL):
+        self.stats = stats
+        self.clients = clients
+        self.activity = activity
+        self.interval = interval
+        self._wall = time.monotonic()
+        self._cpu = time.process_time()
+        self._count = activity()
+
+    def sample(self, lag: float):
+        wall, cpu, count = time.monotonic(), time.process_time(), self.activity()
+        self.stats.record_sample(wall - self._wall, cpu - self._cpu, lag, count != self._count, self.clients())
+        self._wall, self._cpu, self._count = wall, cpu, count
+
+
+class HealthMonitor(Sampler):
+    """Background session of a worker: samples its event loop, the lag is how late
+    the loop runs a timer"""
+
+    async def run_async(self, engine):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.sample(loop.time() - start - self.interval)
+
+
+class HealthThread(Sampler, threading.Thread):
+    """Sampler of a threaded client (sub_thread.py), the lag is how late the thread
+    wakes up, e.g. waiting for the GIL"""
+
+    def __init__(self, *args, **kwargs):
+        Sampler.__init__(self, *args, **kwargs)
+        threading.Thread.__init__(self, daemon=True)
+        self._halt = threading.Event()
+
+    def run(self):
+        while True:
+            start = time.monotonic()
+            if self._halt.wait(self.interval):
+                break
+            self.sample(time.monotonic() - start - self.interval)
+
+    def stop(self):
+        self._halt.set()
+        self.join()
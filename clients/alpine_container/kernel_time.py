@@ -0,0 +1,60 @@
+import socket
+import struct
+
+import paho.mqtt.client as mqtt
+
+# SO_TIMESTAMPNS (SO_TIMESTAMPNS_OLD on Linux, not exported by every Python): the
+# kernel attaches the time it received the data (CLOCK_REALTIME, the clock of
+# time.time_ns) to every recvmsg, as a SCM_TIMESTAMPNS message holding a timespec
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+TIMESPEC = struct.Struct('@ll')
+ANCILLARY_SIZE = socket.CMSG_SPACE(TIMESPEC.size)
+
+
+def enable(sock: socket.socket):
+    sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+
+
+def receive_ns(ancillary: list) -> int:
+    """The kernel receive time (ns since the epoch) in the ancillary data of a recvmsg, 0 if there is none"""
+    for level, kind, data in ancillary:
+        if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMPNS and len(data) >= TIMESPEC.size:
+            seconds, nanoseconds = TIMESPEC.unpack_from(data)
+            return seconds * 10 ** 9 + nanoseconds
+    return 0
+
+
+class TimestampedClient(mqtt.Client):
+    """paho client that, with kernel_timestamps set before connecting, reads its
+    socket with recvmsg and SO_TIMESTAMPNS. kernel_ns is the time the kernel
+    received the first byte of the packet paho is handling (of the TCP segment
+    holding it), e.g. in on_message: the time before it is what the network and
+    the broker took, the time after it what our own client took to read, parse
+    and dispatch the packet. 0 when the kernel gave no timestamp. Not with TLS,
+    an SSL socket has no recvmsg"""
+
+    def __init__(self, *args, **kwargs):
+        super(TimestampedClient, self).__init__(*args, **kwargs)
+        self.kernel_timestamps = False
+        self.kernel_ns = 0
+
+    def _create_socket_connection(self):
+        sock = super(TimestampedClient, self)._create_socket_connection()
+        if self.kernel_timestamps:
+            enable(sock)
+        return sock
+
+    def _sock_recv(self, bufsize):
+        if not self.kernel_timestamps:
+            return super(TimestampedClient, self)._sock_recv(bufsize)
+        # The socket can go away while the loop reads, paho turns that into a lost connection
+        try:
+            data, ancillary, _flags, _address = self._sock.recvmsg(bufsize, ANCILLARY_SIZE)
+        except AttributeError as err:
+            self._easy_log(mqtt.MQTT_LOG_DEBUG, 'socket was None: %s', err)
+            raise ConnectionError() from err
+        # paho reads the first byte of a packet on its own, its segment is the arrival of the packet
+        if self._in_packet['command'] == 0:
+            self.kernel_ns = receive_ns(ancillary)
+        return data
@@ -0,0 +1,146 @@
+import argparse
+import http.server
+import os
+import threading
+import time
+
+from control import totals
+from hdr_histogram import HdrHistogram
+
+# Exposed in the Prometheus text format: (name, type, help, field of the progress counters)
+METRICS = [
+    ('mqttbench_messages_received_total', 'counter', 'Messages received by the subscribers', 'received'),
+    ('mqttbench_messages_published_total', 'counter', 'Messages published', 'published'),
+    ('mqttbench_bytes_received_total', 'counter', 'Payload bytes received by the subscribers', 'bytes_received'),
+    ('mqttbench_bytes_published_total', 'counter', 'Payload bytes published', 'bytes_published'),
+    ('mqttbench_subscribers_connected', 'gauge', 'Subscribers connected to the broker', 'sub_connected'),
+    ('mqttbench_subscribers_subscribed', 'gauge', 'Subscribers with all their subscriptions acknowledged',
+     'subscribed'),
+    ('mqttbench_publishers_connected', 'gauge', 'Publishers connected to the broker', 'connected'),
+    ('mqttbench_disconnects_total', 'counter', 'Connections lost without a DISCONNECT', 'disconnects'),
+    ('mqttbench_e2e_delay_window_count', 'gauge', 'e2e delays in the rolling window', 'e2e_window'),
+]
+# Rolling e2e delay quantiles: (quantile label, field)
+QUANTILES = [('0.5', 'e2e_p50'), ('0.9', 'e2e_p90'), ('0.99', 'e2e_p99'), ('1', 'e2e_max')]
+# Seconds of e2e delays behind the rolling quantiles (between one and two windows)
+ROLLING_WINDOW = 10.0
+
+
+class RollingHistogram(object):
+    """The e2e delays of the last window to 2 x window seconds: the values go to
+    the current histogram, which becomes the previous one every window seconds.
+    Two significant digits are enough for a live view and keep it cheap"""
+
+    def __init__(self, window: float = ROLLING_WINDOW, significant_figures: int = 2):
+        self.window = window
+        self.significant_figures = significant_figures
+        self.current = HdrHistogram(significant_figures=significant_figures)
+        self.previous = HdrHistogram(significant_figures=significant_figures)
+        self._rotated = time.monotonic()
+
+    def record(self, value: int):
+        self.current.record(value)
+
+    def snapshot(self) -> HdrHistogram:
+        if time.monotonic() - self._rotated >= self.window:
+            self._rotated = time.monotonic()
+            self.previous = self.current
+            self.current = HdrHistogram(significant_figures=self.significant_figures)
+        merged = HdrHistogram(significant_figures=self.significant_figures)
+        merged.merge(self.previous)
+        merged.merge(self.current)
+        return merged
+
+
+def render(rows: list) -> str:
+    """The metrics of the progress counters of the workers in the Prometheus text
+    format, the quantiles are given per worker too"""
+    total = totals(rows)
+    lines = []
+    for name, kind, description, field in METRICS:
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.append('%s %s' % (name, total[field]))
+    name = 'mqttbench_e2e_delay_us'
+    lines.append('# HELP %s e2e delay of the last seconds, largest of the workers' % name)
+    lines.append('# TYPE %s gauge' % name)
+    for quantile, field in QUANTILES:
+        lines.append('%s{quantile="%s"} %s' % (name, quantile, total[field]))
+    for worker, row in enumerate(rows):
+        for quantile, field in QUANTILES:
+            lines.append('%s{quantile="%s",worker="%s"} %s' % (name, quantile, worker, row.get(field, 0)))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(threading.Thread):
+    """Serves render(source()) on http://<host>:<port>/metrics while the run goes on.
+    source returns the progress counters of each worker"""
+
+    def __init__(self, source, port: int, host: str = '0.0.0.0'):
+        super(MetricsServer, self).__init__(daemon=True)
+        self.source = source
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ['/metrics', '/']:
+                    self.send_error(404)
+                    return
+                body = render(server.source()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+
+
+class MetricsFile(threading.Thread):
+    """Rewrites render(source()) to path every interval seconds, for a collector
+    that reads files (e.g. the node exporter textfile collector). The file is
+    replaced atomically, a reader never sees half of it"""
+
+    def __init__(self, source, path: str, interval: float = 1.0):
+        super(MetricsFile, self).__init__(daemon=True)
+        self.source = source
+        self.path = path
+        self.interval = interval
+        self._halt = threading.Event()
+
+    def write(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(render(self.source()))
+        os.replace(tmp, self.path)
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        self._halt.set()
+        self.join(self.interval + 1)
+        self.write()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prints the metrics of a running client')
+    parser.add_argument('url', nargs='?', default='http://127.0.0.1:9100/metrics')
+    args = parser.parse_args()
+    import urllib.request
+    with urllib.request.urlopen(args.url, timeout=5) as response:
+        print(response.read().decode('utf-8'), end='')
+
+
+if __name__ == '__main__':
+    main()
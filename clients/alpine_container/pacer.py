@@ -0,0 +1,121 @@
+import heapq
+import random
+import threading
+import time
+
+# Below this many seconds from a deadline the scheduler spins instead of sleeping:
+# time.sleep() overshoots by 50-100us on a stock kernel
+SPIN_THRESHOLD = 0.0002
+
+ARRIVALS = ['constant', 'poisson']
+
+
+def arrival_intervals(interval: float, arrivals: str = 'constant', rng: random.Random = None):
+    """Yields the gaps between consecutive sends of an open-loop schedule
+    :param interval: The mean gap in seconds
+    :param arrivals: constant (fixed rate) or poisson (exponential gaps)
+    :param rng: The random generator of the poisson gaps, seed it to replay a schedule
+    """
+    if arrivals == 'constant':
+        while True:
+            yield interval
+    elif arrivals == 'poisson':
+        rng = rng or random.Random()
+        while True:
+            yield rng.expovariate(1.0 / interval)
+    else:
+        raise Exception('Unknown arrival process %s' % arrivals)
+
+
+class PacedTask(object):
+    """A callback fired count times, every interval seconds on average, starting
+    phase seconds after the scheduler starts. The callback receives the intended
+    (scheduled) wall clock time of the call"""
+
+    def __init__(self, callback, interval: float, count: int, phase: float = 0.0, intervals=None):
+        self.callback = callback
+        self.interval = interval
+        self.intervals = intervals or arrival_intervals(interval)
+        self.count = count
+        self.phase = phase
+        self.sent = 0
+        self.first = None
+        self.last = None
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def record(self, deadline: float, now: float):
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.sent += 1
+        lateness = now - deadline
+        self.total_lateness += lateness
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+
+
+class Pacer(object):
+    """Drives the callbacks of many clients from a single thread.
+    Deadlines are kept in a heap and advanced by the interval from the previous
+    deadline, not from the time the callback ran, so the lateness of one
+    message does not drift the whole schedule (open loop)"""
+
+    def __init__(self):
+        self.tasks = []
+        self._thread = None
+
+    def add(self, callback, interval: float, count: int, phase: float = 0.0, arrivals: str = 'constant',
+            rng: random.Random = None) -> PacedTask:
+        if interval <= 0:
+            raise Exception('The interval must be positive')
+        task = PacedTask(callback, interval, count, phase, arrival_intervals(interval, arrivals, rng))
+        self.tasks.append(task)
+        return task
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    def run(self):
+        clock = time.perf_counter
+        start = clock()
+        wall_offset = time.time() - start
+        heap = [(start + task.phase, ind, task) for ind, task in enumerate(self.tasks) if task.count > 0]
+        heapq.heapify(heap)
+        while heap:
+            deadline, ind, task = heap[0]
+            remaining = deadline - clock()
+            if remaining > SPIN_THRESHOLD:
+                time.sleep(remaining - SPIN_THRESHOLD)
+                continue
+            now = clock()
+            while now < deadline:
+                now = clock()
+            task.callback(deadline + wall_offset)
+            task.record(deadline, now)
+            if task.sent < task.count:
+                heapq.heapreplace(heap, (deadline + next(task.intervals), ind, task))
+            else:
+                heapq.heappop(heap)
+
+    def report(self) -> dict:
+        """Achieved vs target aggregated rate (msg/s) and lateness of the callbacks (seconds)"""
+        sent = sum(task.sent for task in self.tasks)
+        fired = [task for task in self.tasks if task.sent > 0]
+        target_rate = sum(1.0 / task.interval for task in self.tasks)
+        achieved_rate = 0.0
+        if fired:
+            span = max(task.last for task in fired) - min(task.first for task in fired)
+            if span > 0:
+                achieved_rate = (sent - 1) / span
+        return {
+            'sent': sent,
+            'target_rate': target_rate,
+            'achieved_rate': achieved_rate,
+            'mean_lateness': sum(task.total_lateness for task in fired) / sent if sent else 0.0,
+            'max_lateness': max([task.max_lateness for task in fired] or [0.0]),
+        }
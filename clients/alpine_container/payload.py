@@ -0,0 +1,124 @@
+import os
+import socket
+import struct
+
+# Binary payload header, network byte order:
+# magic, version, qos, flags, publisher broker (IPv4), publisher index, sequence number,
+# connect init, connack, publish and intended publish time (ns since the epoch),
+# clock offset of the publisher host to the reference and its error bound (ns, -1 if unknown)
+HEADER = struct.Struct('!BBBB4sIQqqqqqq')
+HEADER_SIZE = HEADER.size
+# The fields of the header the fast path rewrites per message, in place: the
+# sequence number, then the publish and intended times and the clock offset
+SEQ = struct.Struct('!Q')
+SEQ_OFFSET = struct.calcsize('!BBBB4sI')
+TIMES = struct.Struct('!qqqq')
+TIMES_OFFSET = struct.calcsize('!BBBB4sIQqq')
+# Version 1 had no clock offset
+HEADER_V1 = struct.Struct('!BBBB4sIQqqqq')
+# Not a printable character: the text payloads start with the publisher hostname
+MAGIC = 0xB5
+VERSION = 2
+# Header size of every version a subscriber decodes
+HEADER_SIZES = {VERSION: HEADER.size, 1: HEADER_V1.size}
+
+PAYLOAD_FORMATS = ['binary', 'text']
+
+# Maps every byte value to a lowercase letter, turns os.urandom output into padding
+_LOWERCASE = bytes(ord('a') + value % 26 for value in range(256))
+
+_pools = {}
+
+
+def pack_address(hostname: str) -> bytes:
+    try:
+        return socket.inet_aton(hostname)
+    except OSError:
+        return b'\0\0\0\0'
+
+
+def pack_header(address: bytes, pub_index: int, seq: int, qos: int, connect_init_ns: int,
+                connect_ack_ns: int, publish_ns: int, intended_ns: int, offset_ns: int = 0,
+                offset_error_ns: int = -1) -> bytes:
+    return HEADER.pack(MAGIC, VERSION, qos, 0, address, pub_index, seq,
+                       connect_init_ns, connect_ack_ns, publish_ns, intended_ns, offset_ns, offset_error_ns)
+
+
+def pack_header_into(buffer: bytearray, address: bytes, pub_index: int, seq: int, qos: int, connect_init_ns: int,
+                     connect_ack_ns: int, publish_ns: int, intended_ns: int, offset_ns: int = 0,
+                     offset_error_ns: int = -1):
+    HEADER.pack_into(buffer, 0, MAGIC, VERSION, qos, 0, address, pub_index, seq,
+                     connect_init_ns, connect_ack_ns, publish_ns, intended_ns, offset_ns, offset_error_ns)
+
+
+def patch_header_into(buffer: bytearray, seq: int, publish_ns: int, intended_ns: int, offset_ns: int = 0,
+                      offset_error_ns: int = -1):
+    """Rewrites the per-message fields of a header written once with pack_header_into"""
+    SEQ.pack_into(buffer, SEQ_OFFSET, seq)
+    TIMES.pack_into(buffer, TIMES_OFFSET, publish_ns, intended_ns, offset_ns, offset_error_ns)
+
+
+def random_padding(size: int) -> bytes:
+    return os.urandom(size).translate(_LOWERCASE)
+
+
+class PayloadPool(object):
+    """Ring of preallocated payload buffers of one size, filled once with random
+    lowercase padding. Per message only the header is patched in place, so the
+    cost of a message does not depend on its size. next() hands the buffers out in
+    turn; take() and release() instead lend a buffer until it is given back, for
+    messages a client holds until they are acknowledged"""
+
+    def __init__(self, size: int, slots: int = 1):
+        padding = random_padding(size)
+        self.size = size
+        self.buffers = [bytearray(padding) for _ in range(slots)]
+        self._next = 0
+        self._free = list(self.buffers)
+
+    def next(self) -> bytearray:
+        buffer = self.buffers[self._next]
+        self._next = (self._next + 1) % len(self.buffers)
+        return buffer
+
+    def take(self) -> bytearray:
+        """A buffer no message holds, None when all of them are lent"""
+        return self._free.pop() if self._free else None
+
+    def release(self, buffer: bytearray):
+        self._free.append(buffer)
+
+
+def shared_pool(size: int) -> PayloadPool:
+    """The pool of this process for the given size. A buffer can be shared by all
+    the publishers of an event loop because paho copies the payload into the
+    PUBLISH packet before publish() returns"""
+    if size not in _pools:
+        _pools[size] = PayloadPool(size)
+    return _pools[size]
+
+
+def is_binary(payload) -> bool:
+    """The magic byte, a known version and the whole header of that version"""
+    if len(payload) < 2 or payload[0] != MAGIC:
+        return False
+    return payload[1] in HEADER_SIZES and len(payload) >= HEADER_SIZES[payload[1]]
+
+
+def unpack_header(payload) -> tuple:
+    """Decodes the binary header with a single unpack_from, no copy of the payload
+    :return: (hostname, pub_id, seq, qos, connect_init_ns, connect_ack_ns, publish_ns, intended_ns,
+    offset_ns, offset_error_ns)
+    """
+    version = payload[1]
+    if version == VERSION:
+        _magic, _version, qos, _flags, address, pub_index, seq, init_ns, ack_ns, pub_ns, intended_ns, \
+            offset_ns, offset_error_ns = HEADER.unpack_from(payload)
+    elif version == 1:
+        _magic, _version, qos, _flags, address, pub_index, seq, init_ns, ack_ns, pub_ns, intended_ns = \
+            HEADER_V1.unpack_from(payload)
+        offset_ns, offset_error_ns = 0, -1
+    else:
+        raise Exception('Unsupported payload header version %s' % version)
+    return socket.inet_ntoa(address), 'pub%d' % pub_index, seq, qos, init_ns, ack_ns, pub_ns, intended_ns, \
+        offset_ns, offset_error_ns
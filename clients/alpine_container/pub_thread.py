@@ -3,10 +3,11 @@ import paho.mqtt.client as mqtt
 import random
 import string
 import sys
-import threading
 import time
 from datetime import datetime
 
+from pacer import ARRIVALS, Pacer
+
 
 def arg_parse():
     parser = argparse.ArgumentParser(description='MQTT thread publisher', add_help=False)
@@ -21,53 +22,88 @@ def arg_parse():
     parser.add_argument('-c', '--clients-num', dest='clients_num', default=10,
                         help='number of different clients', type=int)
     parser.add_argument('-d', '--delay', dest='delay', default=1,
-                        help='delay between pubblications', type=int)
+                        help='delay between pubblications of a client in seconds (e.g. 0.0005)', type=float)
+    parser.add_argument('-p', '--phase', dest='phase', default='spread', choices=['spread', 'random', 'none'],
+                        help='offset of the first publication of each client: spread evenly over one delay, '
+                             'random within one delay or none (all the clients in lockstep)')
+    parser.add_argument('-a', '--arrivals', dest='arrivals', default='constant', choices=ARRIVALS,
+                        help='open-loop schedule of each client: constant delay or poisson arrivals with mean delay')
+    parser.add_argument('-s', '--seed', dest='seed', default=None,
+                        help='seed of the poisson schedules and random phases', type=int)
+    parser.add_argument('--retain', dest='retain', default=False, action='store_true',
+                        help='publish retained messages, the broker keeps the last one for the new subscribers')
+    parser.add_argument('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                        help='print every publication')
     # parser.print_help()
 
     return parser.parse_args()
 
 
-class Sender(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
+class Sender(object):
+    def __init__(self, index):
+        self.index = index
+        self.name = "Thread-{}".format(index)
         self.client = mqtt.Client("pub_" + self.name + '-' + ''.join(random.choice(string.ascii_lowercase) for i in range(6)))
         self.messages_published = 0
-        self.is_running = True
 
-    def publish_periodic(self):
-        now = str(datetime.now().strftime("%H:%M:%S.%f")[:-3])
-        self.client.publish(args.topic, now, qos=args.qos, retain=False)
-        print("{}) published {}".format(self.messages_published, now))
+    def connect(self):
+        self.client.connect(args.host)
+        # network thread for the QoS 1/2 acknowledgements, publishing is driven by the pacer
+        self.client.loop_start()
+        print("Client {} connected to {}".format(self.client._client_id, args.host))
+
+    def publish_periodic(self, intended):
+        # The intended send time, not the actual one: when the pacer falls behind the
+        # lateness ends up in the measured delay instead of being hidden (coordinated omission)
+        now = str(datetime.fromtimestamp(intended).strftime("%H:%M:%S.%f")[:-3])
         self.messages_published += 1
+        # src_brk,client_num,sent,msg_id: the sequence number lets the subscribers
+        # find lost, duplicated and reordered messages
+        payload = "{},{},{},{}".format(args.host, self.index, now, self.messages_published)
+        self.client.publish(args.topic, payload, qos=args.qos, retain=args.retain)
+        if args.verbose:
+            print("{}) published {}".format(self.messages_published, payload))
 
-        if self.messages_published < args.msg_num:
-            threading.Timer(args.delay, self.publish_periodic).start()
-        else:
-            self.is_running = False
+    def disconnect(self):
+        self.client.disconnect()
+        self.client.loop_stop()
 
-    def run(self):
-        self.client.connect(args.host)
-        print("Client {} connected to {}".format(self.client._client_id, args.host))
 
-        self.publish_periodic()
-        while self.is_running:
-            pass
+def phase_offset(index):
+    if args.phase == 'spread':
+        return index * args.delay / args.clients_num
+    if args.phase == 'random':
+        return rng.uniform(0, args.delay)
+    return 0.0
 
 
 def main():
     clients = []
     for cl in range(0, args.clients_num):
-        t = Sender()
-        t.setDaemon(True)
-        clients.append(t)
-
-    for x in clients:
-        x.start()
+        s = Sender(cl)
+        s.connect()
+        clients.append(s)
 
     time.sleep(1)
 
-    for x in clients:
-        x.join()
+    # a single thread publishes for all the clients
+    pacer = Pacer()
+    for cl, s in enumerate(clients):
+        pacer.add(s.publish_periodic, args.delay, args.msg_num, phase=phase_offset(cl),
+                  arrivals=args.arrivals, rng=random.Random(rng.random()))
+    pacer.start()
+    pacer.join()
+
+    report = pacer.report()
+    print("Published {} messages: target {:.1f} msg/s, achieved {:.1f} msg/s".format(
+        report['sent'], report['target_rate'], report['achieved_rate']))
+    print("Lateness: mean {:.1f} us, max {:.1f} us".format(
+        report['mean_lateness'] * 1e6, report['max_lateness'] * 1e6))
+
+    # let the QoS 1/2 handshakes of the last messages complete
+    time.sleep(1)
+    for s in clients:
+        s.disconnect()
 
     print("PUB DONE")
     sys.exit(1)
@@ -75,4 +111,5 @@ def main():
 
 if __name__ == "__main__":
     args = arg_parse()
+    rng = random.Random(args.seed)
     main()
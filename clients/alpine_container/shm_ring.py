@@ -0,0 +1,139 @@
+import multiprocessing
+import platform
+import struct
+import time
+from multiprocessing import shared_memory
+
+import numpy
+
+# Header of a ring: records written by the producer and records read by the
+# consumer, each on its own cache line so the two sides do not share one
+RING_HEADER = 128
+_HEAD = 0
+_TAIL = 64
+INDEX = struct.Struct('<Q')
+_pack_index = INDEX.pack_into
+# struct codes of the numpy field types a ring can hold
+STRUCT_CODES = {'<i8': 'q', '<u8': 'Q', '<i4': 'i', '<u4': 'I', '<i2': 'h', '<u2': 'H', '<f8': 'd', '<f4': 'f'}
+# Sleep of a producer waiting for a free slot
+FULL_WAIT = 0.0005
+# x86 keeps the stores of a core in program order (TSO): a consumer that sees the
+# new head sees the record before it. arm64 and the other weakly ordered CPUs do
+# not, and Python has no memory barrier, the rings lock their indexes there
+ORDERED_STORES = platform.machine().lower() in ('x86_64', 'amd64', 'i386', 'i686')
+
+
+class SharedCounters(object):
+    """A rows x fields table of int64 counters in shared memory, created by the
+    parent before forking the workers. Every row is written by one worker only;
+    the parent reads the table in place (values is a numpy view, no copy)"""
+
+    def __init__(self, rows: int, fields: list):
+        self.fields = list(fields)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(rows * len(self.fields) * 8, 8))
+        self.values = numpy.ndarray((rows, len(self.fields)), dtype='<i8', buffer=self._shm.buf)
+        self.values[:] = 0
+
+    def close(self):
+        """Releases the memory, from the parent once the workers are gone"""
+        del self.values
+        self._shm.close()
+        self._shm.unlink()
+
+
+class RecordRing(object):
+    """Single-producer single-consumer ring of fixed-width numpy records in shared
+    memory. The producer (a worker) writes a slot then publishes it by moving its
+    head, the consumer (the log writer of the parent) reads the published slots in
+    place then frees them by moving its tail: each index has a single writer, so no
+    lock is needed on x86, where the aligned 8-byte stores of the indexes are atomic
+    and seen in program order, and nothing is pickled. On weakly ordered CPUs
+    (arm64) the indexes are read and written under a lock, whose acquire and
+    release order the accesses to the records around them. A full ring makes the
+    producer wait, like a full bounded queue did"""
+
+    def __init__(self, dtype: numpy.dtype, capacity: int):
+        if capacity < 1:
+            raise Exception('The capacity of a ring must be positive')
+        self.dtype = numpy.dtype(dtype)
+        self.capacity = capacity
+        try:
+            # The producer packs the records with struct, a numpy item assignment costs several times more
+            self.record = struct.Struct('<' + ''.join(STRUCT_CODES[self.dtype.fields[name][0].str]
+                                                      for name in self.dtype.names))
+        except KeyError:
+            raise Exception('Unsupported field type in the record of a ring: %s' % self.dtype)
+        if self.record.size != self.dtype.itemsize:
+            raise Exception('The record of a ring must be packed, without padding')
+        self._shm = shared_memory.SharedMemory(create=True, size=RING_HEADER + self.dtype.itemsize * capacity)
+        self._buf = self._shm.buf
+        INDEX.pack_into(self._buf, _HEAD, 0)
+        INDEX.pack_into(self._buf, _TAIL, 0)
+        self.slots = numpy.ndarray((capacity,), dtype=self.dtype, buffer=self._buf, offset=RING_HEADER)
+        # Local copies of the index each side owns, and the end of the free slots
+        # last seen by the producer
+        self._written = 0
+        self._read = 0
+        self._free_until = capacity
+        self._pack = self.record.pack_into
+        self._lock = None if ORDERED_STORES else multiprocessing.Lock()
+        # Times the producer found the ring full
+        self.full_waits = 0
+
+    # Producer side
+
+    def push(self, values: tuple):
+        """Appends a record (a tuple of the fields of dtype), waits while the ring is full"""
+        if self._written >= self._free_until:
+            self._free_until = self._load(_TAIL) + self.capacity
+            if self._written >= self._free_until:
+                self.full_waits += 1
+                while self._written >= self._free_until:
+                    time.sleep(FULL_WAIT)
+                    self._free_until = self._load(_TAIL) + self.capacity
+        written = self._written
+        self._pack(self._buf, RING_HEADER + written % self.capacity * self.dtype.itemsize, *values)
+        self._written = written + 1
+        if self._lock is None:
+            _pack_index(self._buf, _HEAD, written + 1)
+        else:
+            with self._lock:
+                _pack_index(self._buf, _HEAD, written + 1)
+
+    # Consumer side
+
+    def available(self) -> int:
+        return self._load(_HEAD) - self._read
+
+    def peek(self, limit: int = None) -> list:
+        """Up to limit published records, as views of the ring (two when they wrap around)"""
+        count = self.available()
+        if limit is not None:
+            count = min(count, limit)
+        start = self._read % self.capacity
+        first = min(count, self.capacity - start)
+        chunks = [self.slots[start:start + first]]
+        if count > first:
+            chunks.append(self.slots[:count - first])
+        return [chunk for chunk in chunks if len(chunk)]
+
+    def release(self, count: int):
+        """Frees the count oldest records, once the views of peek are no longer used"""
+        self._read += count
+        if self._lock is None:
+            INDEX.pack_into(self._buf, _TAIL, self._read)
+        else:
+            with self._lock:
+                INDEX.pack_into(self._buf, _TAIL, self._read)
+
+    def _load(self, offset: int) -> int:
+        if self._lock is None:
+            return INDEX.unpack_from(self._buf, offset)[0]
+        with self._lock:
+            return INDEX.unpack_from(self._buf, offset)[0]
+
+    def close(self):
+        """Releases the memory, from the parent once the workers are gone"""
+        del self._buf, self.slots
+        self._shm.close()
+        self._shm.unlink()
@@ -1,16 +1,26 @@
 import argparse
-import paho.mqtt.client as mqtt
+import json
 import random
 import string
 import sys
 import threading
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 from pathlib import Path
 
+from delivery import DeliveryTracker, merge_groups, print_report, save
+from e2e_records import split_pub_thread_payload, time_of_day_to_ns
+from hdr_histogram import HdrHistogram
+from health import CPU_THRESHOLD, LAG_THRESHOLD, HealthStats, HealthThread, health_report
+from kernel_time import TimestampedClient
+from metrics import MetricsServer, RollingHistogram
+
 
 current_milli_time = lambda: int(round(time.time() * 1000))
 
+# Stop waiting when no message arrives for this long (seconds)
+IDLE_TIMEOUT = 120
+
 
 def arg_parse():
     parser = argparse.ArgumentParser(description='MQTT thread subscriber', add_help=False)
@@ -28,6 +38,14 @@ def arg_parse():
                         help='name of the simulation folder')
     parser.add_argument('-n', '--file-name', dest='file_name', default=datetime.now().strftime("%H%M%S"),
                         help='name of the file')
+    parser.add_argument('--kernel-timestamps', dest='kernel_timestamps', default=False, action='store_true',
+                        help='log the kernel receive time (SO_TIMESTAMPNS) of every message next to the received one')
+    parser.add_argument('--health-cpu', dest='health_cpu', default=CPU_THRESHOLD, type=float,
+                        help='share of a core from which the process counts as the bottleneck of the run')
+    parser.add_argument('--health-lag', dest='health_lag', default=LAG_THRESHOLD * 1e3, type=float,
+                        help='p99 wake-up lag (ms) of the health sampler from which the process counts as the bottleneck')
+    parser.add_argument('--metrics-port', dest='metrics_port', default=0, type=int,
+                        help='serve live metrics on http://<container>:<port>/metrics, off by default')
     # parser.print_help()
 
     return parser.parse_args()
@@ -36,20 +54,45 @@ def arg_parse():
 class Receiver(threading.Thread):
     def __init__(self):
         threading.Thread.__init__(self)
-        self.is_running = True
+        self.first_msg = threading.Event()
+        self.done = threading.Event()
         self.counter = 0
         self.e2e_result = []
         self.connect_start = 0
         self.connect_result = []
         self.e2e_dict = {}
         self.last_msg = None
+        # Live metrics
+        self.bytes_received = 0
+        self.connected = False
+        self.subscribed = False
+        self.disconnects = 0
+        self.delivery = DeliveryTracker(args.host)
+        # Kernel receive time -> on_message (us), with --kernel-timestamps
+        self.receive_delay = HdrHistogram()
+        # Cost of on_message, merged into the self-health of the process at the end
+        self.health = HealthStats()
+        self.client = None
 
     def on_message(self, client, userdata, message):
-        self.last_msg = datetime.now()
-        self.e2e_result.append(
-            "{},{},{},{},{}".format(args.host, client._client_id, str(message.payload.decode("utf-8")),
-                                    current_milli_time(),
-                                    args.qos))
+        received_ns = time.time_ns()
+        self.last_msg = time.monotonic()
+        self.first_msg.set()
+        payload = message.payload.decode("utf-8")
+        pub_host, pub_id, sent, seq = split_pub_thread_payload(payload)
+        # A duplicate (e.g. a QoS 1 redelivery) is dropped before anything records it,
+        # the delivery report counts it
+        if seq >= 0 and not self.delivery.record(pub_host, pub_id, message.topic, seq, message.qos):
+            return
+        self.bytes_received += len(message.payload)
+        if args.metrics_port:
+            record_delay(sent)
+        line = "{},{},{},{},{}".format(args.host, client._client_id, payload, round(received_ns / 10 ** 6), args.qos)
+        if args.kernel_timestamps:
+            if client.kernel_ns:
+                self.receive_delay.record((received_ns - client.kernel_ns) // 1000)
+            line += ",{}".format(client.kernel_ns)
+        self.e2e_result.append(line)
         # self.e2e_dict[self.counter] = "{}, {}, {}, {}".format(args.host, client._client_id,
         #                                                       str(message.payload.decode("utf-8")),
         #                                                       datetime.now().strftime("%H:%M:%S.%f")[:-3],
@@ -60,8 +103,12 @@ class Receiver(threading.Thread):
             print(".", end='', flush=True)
 
         if self.counter >= args.msg_num:
-            self.is_running = False
+            self.done.set()
 
+    def on_message_timed(self, client, userdata, message):
+        _start = time.perf_counter_ns()
+        self.on_message(client, userdata, message)
+        self.health.record_callback(time.perf_counter_ns() - _start)
 
     def on_connect(self, client, userdata, flags, rc):
         print("Client {} connected to {}".format(client._client_id, args.host))
@@ -69,24 +116,44 @@ class Receiver(threading.Thread):
         self.connect_result.append("{},{},{},{}".format(args.host, client._client_id, self.connect_start,
                                                            current_milli_time()))
 
+        self.connected = True
         client.subscribe(args.topic, args.qos)
 
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+        self.subscribed = True
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0:
+            self.disconnects += 1
+
+    def wait_done(self):
+        # Sleep until the last message arrives, waking up only when the idle timeout may have expired
+        self.first_msg.wait()
+        timeout = IDLE_TIMEOUT
+        while not self.done.wait(timeout):
+            idle = time.monotonic() - self.last_msg
+            if idle >= IDLE_TIMEOUT:
+                print("waited too much")
+                break
+            timeout = IDLE_TIMEOUT - idle
+
     def run(self):
-        client = mqtt.Client("sub" + self.name + '-' + ''.join(random.choice(string.ascii_lowercase) for i in range(6)))
+        client = TimestampedClient("sub" + self.name + '-' + ''.join(random.choice(string.ascii_lowercase)
+                                                                      for i in range(6)))
+        client.kernel_timestamps = args.kernel_timestamps
+        self.client = client
 
-        client.on_message = self.on_message
+        client.on_message = self.on_message_timed
         client.on_connect = self.on_connect
+        client.on_subscribe = self.on_subscribe
+        client.on_disconnect = self.on_disconnect
 
         self.connect_start = current_milli_time()
         client.connect(args.host)
         client.loop_start()
 
-        while self.is_running:
-            if self.last_msg is not None:
-                if datetime.now() - self.last_msg > timedelta(minutes=2):
-                    self.is_running = False
-                    print("waited too much")
-            pass
+        self.wait_done()
 
         print("{} received {} messages".format(self.name, len(self.e2e_result)))
         with open(args.folder + "/e2e" + file_name, "a") as f:
@@ -101,7 +168,37 @@ class Receiver(threading.Thread):
         print("Client {} disconnected".format(self.name))
 
 
+def record_delay(sent):
+    """Adds the e2e delay of a message (its sent time of day) to the rolling histogram"""
+    now = time.time_ns()
+    try:
+        delay = now - time_of_day_to_ns(sent, now)
+    except ValueError:
+        return
+    with rolling_lock:
+        rolling.record(max(delay // 1000, 0))
+
+
+def metrics_rows(clients):
+    """The counters of all the receivers, as the single worker of metrics.render"""
+    with rolling_lock:
+        window = rolling.snapshot()
+    row = {'received': sum(x.counter for x in clients),
+           'bytes_received': sum(x.bytes_received for x in clients),
+           'sub_connected': sum(x.connected for x in clients),
+           'subscribed': sum(x.subscribed for x in clients),
+           'disconnects': sum(x.disconnects for x in clients),
+           'e2e_window': window.total,
+           'e2e_p50': window.percentile(50) or 0,
+           'e2e_p90': window.percentile(90) or 0,
+           'e2e_p99': window.percentile(99) or 0,
+           'e2e_max': window.max or 0}
+    return [row]
+
+
 def main():
+    wall_start = time.monotonic()
+    cpu_start = time.process_time()
     clients = []
     for cl in range(0, args.clients_num):
         t_mqtt = Receiver()
@@ -109,11 +206,22 @@ def main():
         clients.append(t_mqtt)
 
     with open(args.folder + "/e2e" + file_name, "a") as f:
-        f.write("receiver_brk,receiver_id,src_brk,client_num,sent,msg_id,received,qos\n")
+        f.write("receiver_brk,receiver_id,src_brk,client_num,sent,msg_id,received,qos")
+        f.write(",kernel_received_ns\n" if args.kernel_timestamps else "\n")
 
     with open(args.folder + "/conn" + file_name, "a") as f:
         f.write("broker,client,conn,connack\n")
 
+    server = None
+    if args.metrics_port:
+        server = MetricsServer(lambda: metrics_rows(clients), args.metrics_port)
+        server.start()
+
+    health = HealthStats()
+    sampler = HealthThread(health, lambda: [x.client for x in clients if x.client],
+                           lambda: sum(x.counter for x in clients))
+    sampler.start()
+
     for x in clients:
         x.start()
 
@@ -122,7 +230,35 @@ def main():
     for x in clients:
         x.join()
 
+    sampler.stop()
+    if server is not None:
+        server.stop()
     print("SUBSCRIBER {} is done receiving".format(broker_num[2]))
+    delivery = {}
+    for x in clients:
+        merge_groups(delivery, x.delivery.stats())
+    if delivery:
+        print_report(delivery)
+        save(delivery, args.folder + "/delivery" + file_name.replace(".txt", ".json"))
+    receive_delay = HdrHistogram()
+    for x in clients:
+        receive_delay.merge(x.receive_delay)
+    if receive_delay.total:
+        summary = receive_delay.summary()
+        print("Kernel -> on_message (us): p50 {}, p99 {}, max {} ({} messages)".format(
+            summary['p50'], summary['p99'], summary['max'], receive_delay.total))
+    for x in clients:
+        health.callback.merge(x.health.callback)
+        health.callback_ns += x.health.callback_ns
+    verdict = health_report([health.summary(args.health_cpu, args.health_lag / 1e3)])
+    with open(args.folder + "/health" + file_name.replace(".txt", ".json"), "w") as f:
+        json.dump(verdict, f, indent=2)
+    if verdict['generator_bound']:
+        print("WARNING: the load generator was the bottleneck of this run ({}), its results measure the "
+              "clients, not the brokers".format("; ".join(verdict['reasons'])))
+    cpu = time.process_time() - cpu_start
+    wall = time.monotonic() - wall_start
+    print("CPU time {:.2f}s over {:.2f}s ({:.1f}% of one core)".format(cpu, wall, 100 * cpu / wall))
     time.sleep(1)
     sys.exit(1)
 
@@ -132,6 +268,8 @@ if __name__ == "__main__":
     args = arg_parse()
     broker_num = "_b" + args.host.split('.')[2] + "_"
     file_name = broker_num + args.file_name + ".txt"
+    rolling = RollingHistogram()
+    rolling_lock = threading.Lock()
     print(">>> folder by sub: ", args.folder)
     print(">>>> file name: ", file_name)
     Path(args.folder).mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,311 @@
+import argparse
+import json
+import time
+
+import numpy
+
+DISTRIBUTIONS = ['uniform', 'zipf', 'hotset']
+WILDCARD_KINDS = ['literal', 'plus', 'hash']
+
+# Parameters of the "generate" section of a --multiple-topics file and their defaults
+DEFAULTS = {
+    'topics': 1000,
+    'distribution': 'zipf',
+    # Exponent of the zipf popularity, topic of rank r gets 1 / r^s
+    'zipf_s': 1.0,
+    # hotset: hot_fraction of the topics receive hot_weight of the subscriptions
+    'hot_fraction': 0.1,
+    'hot_weight': 0.9,
+    'depth': 3,
+    'fanout': 10,
+    'prefix': 'bench',
+    'subs': 0,
+    'pubs': 0,
+    # An integer, or [min, max] drawn uniformly for each subscriber
+    'subs_per_client': 1,
+    'topics_per_pub': 1,
+    'seed': None,
+}
+
+# Parameters of the "wildcards" section of a --multiple-topics file and their defaults
+WILDCARD_DEFAULTS = {
+    # Levels of the topics below the prefix
+    'depth': 7,
+    'fanout': 10,
+    'prefix': 'bench',
+    'subs': 0,
+    'pubs': 0,
+    'filters_per_sub': 1,
+    # Share of literal, single-level (+) and multi-level (#) filters
+    'mix': {'literal': 0.2, 'plus': 0.5, 'hash': 0.3},
+    # Levels replaced by + in a plus filter
+    'plus_levels': 1,
+    # A hash filter keeps at least this many levels before the #
+    'hash_min_level': 2,
+    'topics_per_pub': 1,
+    # Share of the publisher topics matching at least one filter
+    'matching': 0.5,
+    'seed': None,
+}
+
+# Parameters of the "retained" section of a --multiple-topics file and their defaults
+RETAINED_DEFAULTS = {
+    # Retained topics, each one published once by one of the publishers
+    'topics': 10000,
+    'depth': 3,
+    'fanout': 10,
+    'prefix': 'retained',
+    'subs': 0,
+    'pubs': 1,
+    # Filter of every subscriber: prefix/# or prefix/+/.../+ (depth levels), both match the whole set
+    'filter': 'hash',
+}
+RETAINED_FILTERS = ['hash', 'plus']
+
+
+def topic_names(count: int, depth: int = 3, fanout: int = 10, prefix: str = 'bench') -> list:
+    """Hierarchical topic names: depth - 1 levels of fanout branches and the topic
+    index as the leaf, e.g. bench/4/2/142"""
+    indexes = numpy.arange(count)
+    levels = [((indexes // fanout ** level) % fanout).astype(str) for level in range(depth - 1, 0, -1)]
+    levels.append(indexes.astype(str))
+    return ['/'.join(parts) for parts in zip([prefix] * count, *levels)]
+
+
+def popularity(count: int, distribution: str = 'zipf', zipf_s: float = 1.0, hot_fraction: float = 0.1,
+               hot_weight: float = 0.9) -> numpy.ndarray:
+    """Probability of each topic (by index) to be picked by a client"""
+    if distribution == 'uniform':
+        weights = numpy.ones(count)
+    elif distribution == 'zipf':
+        weights = 1.0 / numpy.arange(1, count + 1) ** zipf_s
+    elif distribution == 'hotset':
+        hot = min(count, max(1, int(count * hot_fraction)))
+        weights = numpy.full(count, (1.0 - hot_weight) / max(count - hot, 1))
+        weights[:hot] = hot_weight / hot
+    else:
+        raise Exception('Unknown topic distribution %s' % distribution)
+    return weights / weights.sum()
+
+
+def assign(clients: int, per_client, probabilities: numpy.ndarray, rng: numpy.random.Generator,
+           max_rounds: int = 32) -> list:
+    """Draws the distinct topics of each client, all the clients at once.
+    Duplicates inside a row are redrawn by popularity for a few rounds, then
+    uniformly so that very skewed popularities converge too; a client may still
+    end up with fewer topics than asked for when the rounds run out
+    :param per_client: The topics of each client, or [min, max]
+    :return: One array of topic indexes per client
+    """
+    count = len(probabilities)
+    if isinstance(per_client, (list, tuple)):
+        low, high = per_client
+        counts = rng.integers(low, high + 1, size=clients)
+    else:
+        counts = numpy.full(clients, per_client)
+    width = int(counts.max()) if clients else 0
+    if width > count:
+        raise Exception('A client cannot take %s distinct topics out of %s' % (width, count))
+    draws = rng.choice(count, size=(clients, width), p=probabilities)
+    # Only the first counts[i] columns of row i are used
+    used = numpy.arange(width) < counts[:, None]
+    for round_ind in range(max_rounds):
+        order = numpy.argsort(numpy.where(used, draws, count), axis=1, kind='stable')
+        ordered = numpy.take_along_axis(draws, order, axis=1)
+        ordered_used = numpy.take_along_axis(used, order, axis=1)
+        duplicate = numpy.zeros_like(used)
+        duplicate[:, 1:] = (ordered[:, 1:] == ordered[:, :-1]) & ordered_used[:, 1:]
+        if not duplicate.any():
+            break
+        ordered[duplicate] = rng.choice(count, size=int(duplicate.sum()),
+                                        p=probabilities if round_ind < max_rounds // 2 else None)
+        draws = ordered
+        used = ordered_used
+    return [numpy.unique(draws[ind][used[ind]]) for ind in range(clients)]
+
+
+def validate(params: dict) -> dict:
+    """The generate parameters merged with the defaults, raises on invalid ones"""
+    unknown = set(params) - set(DEFAULTS)
+    if unknown:
+        raise Exception('Unknown topic generator parameters: %s' % ', '.join(sorted(unknown)))
+    merged = dict(DEFAULTS, **params)
+    if merged['distribution'] not in DISTRIBUTIONS:
+        raise Exception('The topic distribution must be one of %s' % ', '.join(DISTRIBUTIONS))
+    for key in ['topics', 'depth', 'fanout']:
+        if not isinstance(merged[key], int) or merged[key] < 1:
+            raise Exception('The %s parameter of the topic generator must be a positive integer' % key)
+    for key in ['subs', 'pubs']:
+        if not isinstance(merged[key], int) or merged[key] < 0:
+            raise Exception('The %s parameter of the topic generator must be a non negative integer' % key)
+    if not 0 < merged['hot_fraction'] <= 1 or not 0 < merged['hot_weight'] <= 1:
+        raise Exception('hot_fraction and hot_weight must be in (0, 1]')
+    return merged
+
+
+def generate(params: dict) -> dict:
+    """Generates a topic space and the topics of every client
+    :return: {'topics': [names], 'subs': [[topics of subscriber i]], 'pubs': [[topics of publisher i]]}
+    """
+    params = validate(params)
+    rng = numpy.random.default_rng(params['seed'])
+    names = topic_names(params['topics'], params['depth'], params['fanout'], params['prefix'])
+    probabilities = popularity(params['topics'], params['distribution'], params['zipf_s'],
+                               params['hot_fraction'], params['hot_weight'])
+    # The popularity follows the rank, not the position in the hierarchy
+    ranks = rng.permutation(params['topics'])
+    probabilities = probabilities[ranks]
+    subs = assign(params['subs'], params['subs_per_client'], probabilities, rng)
+    pubs = assign(params['pubs'], params['topics_per_pub'], probabilities, rng)
+    return {
+        'topics': names,
+        'subs': [[names[ind] for ind in row] for row in subs],
+        'pubs': [[names[ind] for ind in row] for row in pubs],
+    }
+
+
+def validate_wildcards(params: dict) -> dict:
+    """The wildcards parameters merged with the defaults, raises on invalid ones"""
+    unknown = set(params) - set(WILDCARD_DEFAULTS)
+    if unknown:
+        raise Exception('Unknown wildcard generator parameters: %s' % ', '.join(sorted(unknown)))
+    merged = dict(WILDCARD_DEFAULTS, **params)
+    for key in ['depth', 'fanout', 'filters_per_sub', 'topics_per_pub', 'hash_min_level']:
+        if not isinstance(merged[key], int) or merged[key] < 1:
+            raise Exception('The %s parameter of the wildcard generator must be a positive integer' % key)
+    for key in ['subs', 'pubs', 'plus_levels']:
+        if not isinstance(merged[key], int) or merged[key] < 0:
+            raise Exception('The %s parameter of the wildcard generator must be a non negative integer' % key)
+    if set(merged['mix']) - set(WILDCARD_KINDS) or sum(merged['mix'].values()) <= 0:
+        raise Exception('The wildcard mix must give a weight to some of %s' % ', '.join(WILDCARD_KINDS))
+    if merged['depth'] < 2:
+        raise Exception('The wildcard topics need at least 2 levels')
+    if merged['plus_levels'] > merged['depth'] - 1:
+        raise Exception('At most depth - 1 levels can be replaced by +')
+    if merged['hash_min_level'] > merged['depth'] - 1:
+        raise Exception('hash_min_level must be smaller than the depth')
+    if not 0 <= merged['matching'] <= 1:
+        raise Exception('matching must be in [0, 1]')
+    return merged
+
+
+def _join(prefix: str, levels) -> str:
+    return '/'.join([prefix] + [str(level) for level in levels])
+
+
+def wildcard_workload(params: dict) -> dict:
+    """Subscription filters with a mix of literal, + and # filters over a deep
+    hierarchy, and publisher topics of which a share matches some filter.
+    The first level below the prefix is always literal: the non matching topics
+    use first-level values no filter has, so no # filter can catch them
+    :return: {'topics': [filters], 'subs': [[filters of subscriber i]], 'pubs': [[topics of publisher i]]}
+    """
+    params = validate_wildcards(params)
+    rng = numpy.random.default_rng(params['seed'])
+    depth, fanout, prefix = params['depth'], params['fanout'], params['prefix']
+    count = params['subs'] * params['filters_per_sub']
+    paths = rng.integers(0, fanout, size=(count, depth))
+    weights = numpy.array([params['mix'].get(kind, 0) for kind in WILDCARD_KINDS], dtype=float)
+    kinds = rng.choice(len(WILDCARD_KINDS), size=count, p=weights / weights.sum())
+    # The levels a plus filter replaces: the first plus_levels of a random order of the levels 1..depth-1
+    plus = numpy.argsort(rng.random((count, depth - 1)), axis=1)[:, :params['plus_levels']] + 1
+    cuts = rng.integers(params['hash_min_level'], depth, size=count)
+
+    filters = []
+    for ind in range(count):
+        levels = paths[ind].tolist()
+        if kinds[ind] == 1:
+            for level in plus[ind]:
+                levels[level] = '+'
+        elif kinds[ind] == 2:
+            levels = levels[:cuts[ind]] + ['#']
+        filters.append(_join(prefix, levels))
+
+    topic_count = params['pubs'] * params['topics_per_pub']
+    topics = []
+    if topic_count:
+        matching = rng.random(topic_count) < params['matching']
+        sources = rng.integers(0, max(count, 1), size=topic_count)
+        misses = rng.integers(0, fanout, size=(topic_count, depth))
+        misses[:, 0] += fanout
+        for ind in range(topic_count):
+            # The concrete path a filter was made from matches it, whatever its kind
+            levels = paths[sources[ind]] if matching[ind] and count else misses[ind]
+            topics.append(_join(prefix, levels.tolist()))
+
+    per_sub, per_pub = params['filters_per_sub'], params['topics_per_pub']
+    return {
+        'topics': filters,
+        'subs': [filters[ind * per_sub:(ind + 1) * per_sub] for ind in range(params['subs'])],
+        'pubs': [topics[ind * per_pub:(ind + 1) * per_pub] for ind in range(params['pubs'])],
+    }
+
+
+def validate_retained(params: dict) -> dict:
+    """The retained parameters merged with the defaults, raises on invalid ones"""
+    unknown = set(params) - set(RETAINED_DEFAULTS)
+    if unknown:
+        raise Exception('Unknown retained generator parameters: %s' % ', '.join(sorted(unknown)))
+    merged = dict(RETAINED_DEFAULTS, **params)
+    for key in ['topics', 'depth', 'fanout']:
+        if not isinstance(merged[key], int) or merged[key] < 1:
+            raise Exception('The %s parameter of the retained generator must be a positive integer' % key)
+    for key in ['subs', 'pubs']:
+        if not isinstance(merged[key], int) or merged[key] < 0:
+            raise Exception('The %s parameter of the retained generator must be a non negative integer' % key)
+    if merged['filter'] not in RETAINED_FILTERS:
+        raise Exception('The retained filter must be one of %s' % ', '.join(RETAINED_FILTERS))
+    return merged
+
+
+def retained_workload(params: dict) -> dict:
+    """A set of topics to publish retained messages to, split evenly among the
+    publishers, and a wildcard filter matching all of them for every subscriber
+    :return: {'topics': [names], 'subs': [[filter]], 'pubs': [[topics of publisher i]]}
+    """
+    params = validate_retained(params)
+    names = topic_names(params['topics'], params['depth'], params['fanout'], params['prefix'])
+    if params['filter'] == 'hash':
+        topic_filter = params['prefix'] + '/#'
+    else:
+        topic_filter = _join(params['prefix'], ['+'] * params['depth'])
+    pubs = numpy.array_split(numpy.arange(params['topics']), params['pubs']) if params['pubs'] else []
+    return {
+        'topics': names,
+        'subs': [[topic_filter] for _ind in range(params['subs'])],
+        'pubs': [[names[ind] for ind in row] for row in pubs if len(row)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a topic workload and prints its statistics')
+    parser.add_argument('params', help='JSON file with a "generate", "wildcards" or "retained" section '
+                                       '(or the section itself)')
+    parser.add_argument('--wildcards', action='store_true', help='the bare section is a wildcards one')
+    parser.add_argument('--retained', action='store_true', help='the bare section is a retained one')
+    args = parser.parse_args()
+    with open(args.params) as f:
+        params = json.load(f)
+    if args.retained or 'retained' in params:
+        build = retained_workload
+    else:
+        build = wildcard_workload if args.wildcards or 'wildcards' in params else generate
+    params = params.get('retained', params.get('wildcards', params.get('generate', params)))
+
+    start = time.perf_counter()
+    workload = build(params)
+    elapsed = time.perf_counter() - start
+    subscriptions = sum(len(topics) for topics in workload['subs'])
+    per_topic = {}
+    for topics in workload['subs']:
+        for topic in topics:
+            per_topic[topic] = per_topic.get(topic, 0) + 1
+    busiest = sorted(per_topic.values(), reverse=True)
+    print('%s topics, %s subscribers, %s subscriptions, %s publishers, generated in %.3f s'
+          % (len(workload['topics']), len(workload['subs']), subscriptions, len(workload['pubs']), elapsed))
+    print('%s topics with subscribers, busiest ones: %s' % (len(per_topic), busiest[:10]))
+    print('examples: %s' % workload['topics'][:3])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clients', 'alpine_container'))
+from control import parse
+
+# Seconds between the start command and the start of the run: the command has to
+# cross docker exec and be read by every process before that time
+START_LEAD = 0.5
+
+
+class ClientProcess(object):
+    """container_python.py --control running in a container through docker exec -i.
+    The output goes to log_path, the control events to the events queue of the coordinator"""
+
+    def __init__(self, name, container, client_args, log_path, events):
+        self.name = name
+        self.container = container
+        self.client_args = client_args
+        self.log_path = log_path
+        self.events = events
+        self.process = None
+        self.ready = False
+        self.progress = {}
+        self.result = None
+        self._reader = None
+
+    def start(self):
+        cmd = ['docker', 'exec', '-i', self.container, 'python3', '-u', 'container_python.py', '--control',
+               '--brief'] + self.client_args
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1)
+        self._reader = threading.Thread(target=self.read_output, daemon=True)
+        self._reader.start()
+
+    def read_output(self):
+        with open(self.log_path, 'w') as log:
+            for line in self.process.stdout:
+                event = parse(line)
+                if event is None:
+                    log.write(line)
+                else:
+                    self.events.put((self, event))
+        self.events.put((self, {'kind': 'exit'}))
+
+    def send(self, **command):
+        self.process.stdin.write(json.dumps(command) + '\n')
+        self.process.stdin.flush()
+
+    def wait(self, timeout=None):
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self._reader.join(5)
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Starts container_python.py in the client containers together')
+    parser.add_argument('-b', '--brokers', dest='num_broker', default=1, type=int,
+                        help='cluster size, the clients of broker i run in mn.sub<i>')
+    parser.add_argument('--broker-address', dest='broker_address', default='10.0.{}.100',
+                        help='address of broker {}')
+    parser.add_argument('--pub-container', dest='pub_container', default='mn.sub{}',
+                        help='container of the publishers of broker {} (the mn.pub<i> image has no '
+                             'container_python.py)')
+    parser.add_argument('-s', '--subscribers', dest='subscribers', default=10, type=int,
+                        help='subscribers per broker')
+    parser.add_argument('-p', '--publishers', dest='publishers', default=1, type=int,
+                        help='publishers per broker')
+    parser.add_argument('-t', '--topic', dest='topic', default='topic')
+    parser.add_argument('-m', '--messages', dest='messages', default=100, type=int,
+                        help='messages per publisher')
+    parser.add_argument('-r', '--rate', dest='rate', default=10, type=float,
+                        help='messages/s of each publisher')
+    parser.add_argument('-q', '--qos', dest='qos', default=0, type=int)
+    parser.add_argument('--clock-server', dest='clock_server', default=None,
+                        help='clock reference of the clients, e.g. this host running clock_sync.py serve')
+    parser.add_argument('--ready-timeout', dest='ready_timeout', default=120, type=float,
+                        help='seconds to wait for every process to be ready')
+    parser.add_argument('--extra', dest='extra', default='',
+                        help='more options for every container_python.py, e.g. "--no-raw-log --workers 2"')
+    parser.add_argument('--folder', dest='folder', default=None,
+                        help='results folder, by default experiments/<day>/coordinator/<time>')
+    return parser.parse_args()
+
+
+def build_processes(args, folder, events):
+    extra = args.extra.split()
+    if args.clock_server:
+        extra += ['--clock-server', args.clock_server]
+    processes = []
+    for b_id in range(args.num_broker):
+        common = ['--hostname', args.broker_address.format(b_id), '--topic', args.topic, '--qos', str(args.qos)] + extra
+        if args.subscribers:
+            processes.append(ClientProcess(
+                'sub{}'.format(b_id), 'mn.sub{}'.format(b_id),
+                common + ['--sub-clients', str(args.subscribers),
+                          '--sub-count', str(args.messages * args.publishers * args.num_broker),
+                          '--description', 'coord_sub{}'.format(b_id)],
+                os.path.join(folder, 'output_sub{}.txt'.format(b_id)), events))
+        if args.publishers:
+            processes.append(ClientProcess(
+                'pub{}'.format(b_id), args.pub_container.format(b_id),
+                common + ['--pub-clients', str(args.publishers), '--pub-count', str(args.messages),
+                          '--rate', str(args.rate), '--description', 'coord_pub{}'.format(b_id)],
+                os.path.join(folder, 'output_pub{}.txt'.format(b_id)), events))
+    return processes
+
+
+def print_progress(processes, started):
+    totals = {}
+    for client in processes:
+        for field, value in client.progress.items():
+            if field == 'kind':
+                continue
+            totals[field] = max(totals.get(field, 0), value) if field == 'start_lag' else \
+                totals.get(field, 0) + value
+    print('[{:7.1f} s] subscribed {subscribed}, connected {connected}, published {published}, '
+          'received {received}, start lag {lag:.3f} ms'.format(
+              time.time() - started, lag=totals.get('start_lag', 0) / 1e6,
+              **{field: totals.get(field, 0) for field in ['subscribed', 'connected', 'published', 'received']}))
+
+
+def main():
+    args = arg_parse()
+    folder = args.folder or 'experiments/{}/coordinator/{}'.format(datetime.now().strftime("%m-%d"),
+                                                                  datetime.now().strftime("%H%M%S"))
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    print("++ Directory path: {}".format(folder))
+
+    events = queue.Queue()
+    processes = build_processes(args, folder, events)
+    launched = time.time()
+    for client in processes:
+        client.start()
+
+    # Ready: every subscriber acknowledged its subscriptions, every publisher connected
+    deadline = time.time() + args.ready_timeout
+    running = len(processes)
+    while not all(client.ready for client in processes):
+        try:
+            client, event = events.get(timeout=max(deadline - time.time(), 0.001))
+        except queue.Empty:
+            missing = [client.name for client in processes if not client.ready]
+            print('Not ready after {} s: {}'.format(args.ready_timeout, ', '.join(missing)))
+            for client in processes:
+                client.process.kill()
+            return
+        if event['kind'] == 'ready':
+            client.ready = True
+            print('{} ready in {:.2f} s: {}'.format(client.name, time.time() - launched, event))
+        elif event['kind'] == 'progress':
+            client.progress = event
+        elif event['kind'] == 'exit':
+            print('{} exited before being ready, see {}'.format(client.name, client.log_path))
+            running -= 1
+            client.ready = True
+
+    start_ns = time.time_ns() + int(START_LEAD * 1e9)
+    for client in processes:
+        if client.process.poll() is None:
+            client.send(cmd='start', at=start_ns)
+    print('Start at {}'.format(datetime.utcfromtimestamp(start_ns / 1e9)))
+
+    last_print = time.time()
+    while running:
+        try:
+            client, event = events.get(timeout=1)
+        except queue.Empty:
+            event = None
+        if event is not None:
+            if event['kind'] == 'progress':
+                client.progress = event
+            elif event['kind'] == 'result':
+                client.result = event
+            elif event['kind'] == 'exit':
+                running -= 1
+        if time.time() - last_print >= 1:
+            last_print = time.time()
+            print_progress(processes, start_ns / 1e9)
+    for client in processes:
+        client.wait(10)
+    print_progress(processes, start_ns / 1e9)
+
+    results = {client.name: {'container': client.container, 'args': client.client_args,
+                             'progress': client.progress, 'result': client.result} for client in processes}
+    with open(os.path.join(folder, 'results.json'), 'w') as f:
+        json.dump({'start_ns': start_ns, 'processes': results}, f, indent=2)
+    print()
+    for client in processes:
+        result = client.result or {}
+        e2e = result.get('e2e') or {}
+        delivery = result.get('delivery') or {}
+        health = result.get('health') or {}
+        print('{}\treceived {}\tpublished {}\tfailed {}\tmissing {} dup {}\te2e p50 {} p99 {} us\t'
+              'start lag {:.3f} ms{}'.format(
+                  client.name, result.get('received'), result.get('published'),
+                  (result.get('failed_subs') or 0) + (result.get('failed_pubs') or 0), delivery.get('missing'),
+                  delivery.get('duplicates'), e2e.get('p50'), e2e.get('p99'), client.progress.get('start_lag', 0) / 1e6,
+                  '\tGENERATOR-BOUND: ' + ', '.join(health['reasons']) if health.get('generator_bound') else ''))
+
+
+if __name__ == "__main__":
+    main()
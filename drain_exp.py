@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import queue
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+
+from broker_stats import BrokerStats
+from client_results import BRIEF_PUBLISHED, SummaryFile, generator_bound, parse_brief
+from coordinator import START_LEAD, ClientProcess
+
+SUMMARY_HEADER = 'move;subscribers;published;queued;drained;missing;duplicates;sessions_resumed;connack_max_ms;' \
+                 'first_msg_p50_ms;first_msg_max_ms;drain_s;drain_msg_s;broker_mem_before_mb;broker_mem_after_mb;' \
+                 'bytes_per_queued_msg'
+
+
+def get_cluster_size():
+    import docker
+    client = docker.from_env()
+    size = 0
+    for container in client.containers.list():
+        if not any(x in container.attrs['Name'] for x in ['pub', 'sub']):
+            size += 1
+    return size
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Persistent session drain: offline queueing and reconnect delivery')
+    parser.add_argument('-t', '--type', dest='BROKER_TYPE', required=True,
+                        help='Cluster type')
+    parser.add_argument('-b', '--brokers', dest='num_broker', default=None,
+                        help='cluster size, by default the running broker containers', type=int)
+    parser.add_argument('-s', '--subscribers', dest='subscribers', default=10,
+                        help='offline subscribers per broker', type=int)
+    parser.add_argument('-p', '--publishers', dest='publishers', default=1,
+                        help='publishers of the backlog per broker', type=int)
+    parser.add_argument('-m', '--messages', dest='messages', default=1000,
+                        help='backlog messages per publisher', type=int)
+    parser.add_argument('--msg-size', dest='msg_size', default=1024, type=int)
+    parser.add_argument('-r', '--rate', dest='rate', default=0, type=float,
+                        help='messages/s of each publisher, 0 (default) sends back to back')
+    parser.add_argument('-q', '--qos', dest='qos', default=1, type=int, choices=[1, 2])
+    parser.add_argument('--moves', dest='moves', default='0,1',
+                        help='comma-separated runs: the subscribers of broker i reconnect to broker i + move')
+    parser.add_argument('--settle', dest='settle', default=5, type=float,
+                        help='seconds before measuring the memory of the brokers, before and after the backlog')
+    parser.add_argument('--ready-timeout', dest='ready_timeout', default=120, type=float,
+                        help='seconds to wait for the subscribers to park their sessions')
+    return parser.parse_args()
+
+
+def broker_address(b_id):
+    return '10.0.{}.100'.format(b_id % CLUSTER_SIZE)
+
+
+def broker_memory(stats, start, end):
+    """Mean memory (MB) of every broker over [start, end], summed over the cluster"""
+    return sum(row['mem_mean'] for row in stats.summary(start, end).values())
+
+
+def wait_for(processes, events, kind, timeout=None):
+    """Handles the events of the subscriber processes until each one sent kind
+    (or exited), False if it takes longer than timeout seconds"""
+    deadline = time.time() + timeout if timeout else None
+    waiting = set(client.name for client in processes)
+    while waiting:
+        try:
+            client, event = events.get(timeout=max(deadline - time.time(), 0.001) if deadline else 1)
+        except queue.Empty:
+            if deadline and time.time() >= deadline:
+                print('No {} from {}'.format(kind, ', '.join(sorted(waiting))))
+                return False
+            continue
+        if event['kind'] == 'progress':
+            client.progress = event
+        elif event['kind'] == 'result':
+            client.result = event
+        elif event['kind'] == 'ready':
+            client.ready = True
+        if event['kind'] == 'exit':
+            if kind != 'exit':
+                print('{} exited, see {}'.format(client.name, client.log_path))
+            waiting.discard(client.name)
+        elif event['kind'] == kind:
+            waiting.discard(client.name)
+    return True
+
+
+def publisher_cmd(b_id, topic, description):
+    return ['docker', 'exec', 'mn.sub{}'.format(b_id), 'python3', 'container_python.py',
+            '--hostname', broker_address(b_id), '--topic', topic, '--qos', str(args.qos), '--no-raw-log', '--brief',
+            '--description', description, '--pub-clients', str(args.publishers), '--pub-count', str(args.messages),
+            '--rate', str(args.rate), '--msg-size', str(args.msg_size)]
+
+
+def run_move(move, path):
+    # A topic per run, the sessions of the previous run do not match it
+    topic = 'drain/{}'.format(move)
+    description = 'drain_{}'.format(move)
+    backlog = args.messages * args.publishers * CLUSTER_SIZE
+    print()
+    print("-" * 80)
+    print("++ {} subscribers per broker reconnect to broker i+{}, {} queued messages each".format(
+        args.subscribers, move, backlog))
+    print("-" * 80)
+
+    stats = BrokerStats(['mn.{}{}'.format(BROKER_TYPE, b_id) for b_id in range(CLUSTER_SIZE)],
+                        log_path=os.path.join(path, 'stats_{}.txt'.format(move)))
+    stats.start()
+    events = queue.Queue()
+    subscribers = [ClientProcess('sub{}'.format(b_id), 'mn.sub{}'.format(b_id),
+                                 ['--hostname', broker_address(b_id), '--topic', topic, '--qos', str(args.qos),
+                                  '--drain', '--drain-hostname', broker_address(b_id + move),
+                                  '--sub-clients', str(args.subscribers), '--sub-count', str(backlog),
+                                  '--no-raw-log', '--description', '{}_sub{}'.format(description, b_id)],
+                                 os.path.join(path, 'output_sub{}_{}.txt'.format(b_id, move)), events)
+                   for b_id in range(CLUSTER_SIZE)]
+    for client in subscribers:
+        client.start()
+    # Ready: every subscriber subscribed and disconnected, its session is parked
+    if not wait_for(subscribers, events, 'ready', args.ready_timeout):
+        for client in subscribers:
+            client.process.kill()
+        stats.stop()
+        return None
+
+    time.sleep(args.settle)
+    parked = time.time()
+    publishers = [subprocess.Popen(publisher_cmd(b_id, topic, '{}_pub{}'.format(description, b_id)),
+                                   stdout=subprocess.PIPE, universal_newlines=True)
+                  for b_id in range(CLUSTER_SIZE)]
+    pub_outputs = [process.communicate()[0] for process in publishers]
+    published = sum(int(fields[BRIEF_PUBLISHED]) for fields in map(parse_brief, pub_outputs) if fields)
+    # The QoS 1/2 messages are acknowledged: the brokers hold the backlog
+    queued_at = time.time()
+    time.sleep(args.settle)
+    loaded = time.time()
+
+    # The whole fleet comes back at once
+    start_ns = time.time_ns() + int(START_LEAD * 1e9)
+    for client in subscribers:
+        if client.process.poll() is None:
+            client.send(cmd='start', at=start_ns)
+    wait_for(subscribers, events, 'exit')
+    for client in subscribers:
+        client.wait(10)
+    stats.stop()
+
+    with open(os.path.join(path, 'output_pub_{}.txt'.format(move)), 'w') as f:
+        f.write('\n'.join(pub_outputs))
+    with open(os.path.join(path, 'results_{}.json'.format(move)), 'w') as f:
+        json.dump({'start_ns': start_ns, 'published': published,
+                   'processes': {client.name: client.result for client in subscribers}}, f, indent=2)
+
+    results = [client.result or {} for client in subscribers]
+    drains = [result.get('drain') or {} for result in results]
+    deliveries = [result.get('delivery') or {} for result in results]
+    queued = published * args.subscribers * CLUSTER_SIZE
+    drained = sum(drain.get('messages', 0) for drain in drains)
+    # The reconnections are synchronized: the drain of the cluster lasts as long as the slowest one
+    drain_time = max([drain.get('drain_time', 0) for drain in drains] or [0])
+    bound = any((result.get('health') or {}).get('generator_bound') for result in results) or \
+        any(generator_bound(parse_brief(output)) for output in pub_outputs)
+    mem_before = broker_memory(stats, parked - args.settle, parked)
+    mem_after = broker_memory(stats, queued_at, loaded)
+    return bound, [move, args.subscribers * CLUSTER_SIZE, published, queued, drained,
+            max(queued - drained, 0),
+            sum(delivery.get('duplicates', 0) for delivery in deliveries),
+            sum(drain.get('sessions_present', 0) for drain in drains),
+            max([drain.get('connack_max_ms') or 0 for drain in drains] or [0]),
+            max([drain.get('first_p50_ms') or 0 for drain in drains] or [0]),
+            max([drain.get('first_max_ms') or 0 for drain in drains] or [0]),
+            drain_time, round(drained / drain_time, 1) if drain_time > 0 else 0,
+            round(mem_before, 1), round(mem_after, 1),
+            round((mem_after - mem_before) * 10 ** 6 / queued, 1) if queued else 0]
+
+
+def main():
+    path = "experiments/{day}/drain/{type}/{minute}/{qos}qos/".format(day=START_DAY, type=BROKER_TYPE,
+                                                                       minute=START_MINUTE, qos=args.qos)
+    Path(path).mkdir(parents=True, exist_ok=True)
+    print("++ Directory path: {}".format(path))
+
+    summary = SummaryFile(path, SUMMARY_HEADER)
+    for move in [int(move) for move in args.moves.split(',')]:
+        result = run_move(move, path)
+        if result is not None:
+            summary.add(result[1], result[0])
+    summary.close()
+    summary.show()
+
+
+if __name__ == "__main__":
+    print(">>> Persistent session drain <<<")
+    START_DAY = datetime.now().strftime("%m-%d")
+    START_MINUTE = datetime.now().strftime("%H%M%S")
+    args = arg_parse()
+    BROKER_TYPE = args.BROKER_TYPE
+    CLUSTER_SIZE = args.num_broker or get_cluster_size()
+    main()
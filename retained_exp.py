@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import math
+import os
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+
+from broker_stats import BrokerStats
+from client_results import BRIEF_PUB_THROUGHPUT, BRIEF_PUBLISHED, SummaryFile, fetch_json, generator_bound, \
+    parse_brief
+
+SUMMARY_HEADER = 'topics;source;broker;subscribers;got_retained;retained_min;retained_max;first_p50_ms;first_max_ms;' \
+                 'all_p50_ms;all_max_ms;set_msg_s;preloaded;preload_msg_s;broker_mem_growth_mb;bytes_per_retained_msg'
+
+
+def get_cluster_size():
+    import docker
+    client = docker.from_env()
+    size = 0
+    for container in client.containers.list():
+        if not any(x in container.attrs['Name'] for x in ['pub', 'sub']):
+            size += 1
+    return size
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Retained messages: subscribe-time delivery of large retained sets')
+    parser.add_argument('-t', '--type', dest='BROKER_TYPE', required=True,
+                        help='Cluster type')
+    parser.add_argument('-b', '--brokers', dest='num_broker', default=None,
+                        help='cluster size, by default the running broker containers', type=int)
+    parser.add_argument('-n', '--topics', dest='topics', default='1000,10000,100000',
+                        help='comma-separated sizes of the retained set')
+    parser.add_argument('--source', dest='source', default=0, type=int,
+                        help='broker the retained messages are published to')
+    parser.add_argument('--include-source', dest='include_source', default=False, action='store_true',
+                        help='subscribe on the source broker too')
+    parser.add_argument('-p', '--publishers', dest='publishers', default=10, type=int,
+                        help='publishers sharing the retained topics')
+    parser.add_argument('-s', '--subscribers', dest='subscribers', default=5, type=int,
+                        help='wildcard subscribers per broker')
+    parser.add_argument('--filter', dest='filter', default='hash', choices=['hash', 'plus'],
+                        help='filter of the subscribers: retained/<n>/# or retained/<n>/+/.../+')
+    parser.add_argument('--depth', dest='depth', default=3, type=int,
+                        help='levels of the retained topics below the prefix')
+    parser.add_argument('--fanout', dest='fanout', default=10, type=int)
+    parser.add_argument('--msg-size', dest='msg_size', default=256, type=int)
+    parser.add_argument('-r', '--rate', dest='rate', default=0, type=float,
+                        help='messages/s of each publisher, 0 (default) sends back to back')
+    parser.add_argument('-q', '--qos', dest='qos', default=1, type=int)
+    parser.add_argument('--idle', dest='idle', default=10, type=float,
+                        help='seconds without messages after which a subscriber stops')
+    parser.add_argument('--timeout', dest='timeout', default=300, type=int,
+                        help='seconds a subscriber waits for its first retained message')
+    parser.add_argument('--settle', dest='settle', default=5, type=float,
+                        help='seconds for the brokers to replicate the set and for the memory samples')
+    parser.add_argument('--keep', dest='keep', default=False, action='store_true',
+                        help='do not clear the retained messages at the end of a size')
+    return parser.parse_args()
+
+
+def broker_memory(stats, start, end):
+    """Mean memory (MB) of every broker over [start, end], summed over the cluster"""
+    return sum(row['mem_mean'] for row in stats.summary(start, end).values())
+
+
+def client_cmd(broker_id, config, description, role_args):
+    return ['docker', 'exec', 'mn.sub{}'.format(broker_id), 'python3', 'container_python.py',
+            '--hostname', '10.0.{}.100'.format(broker_id), '--multiple-topics', config,
+            '--qos', str(args.qos), '--no-raw-log', '--brief', '--description', description] + role_args
+
+
+def publish(config, description, topics, role_args):
+    cmd = client_cmd(args.source, config, description,
+                     ['--pub-clients', str(args.publishers), '--pub-count', str(math.ceil(topics / args.publishers)),
+                      '--rate', str(args.rate), '--msg-size', str(args.msg_size)] + role_args)
+    return subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def run_size(topics, path):
+    print()
+    print("-" * 80)
+    print("++ {} retained topics published through broker {}".format(topics, args.source))
+    print("-" * 80)
+    # The experiments folder is mounted in the working directory of the client containers
+    config = os.path.join(path, 'retained_{}.json'.format(topics))
+    with open(config, 'w') as f:
+        # A prefix per size, the sets of two sizes never mix
+        json.dump({'retained': {'topics': topics, 'pubs': args.publishers, 'subs': args.subscribers,
+                                'prefix': 'retained/{}'.format(topics), 'filter': args.filter,
+                                'depth': args.depth, 'fanout': args.fanout}}, f, indent=2)
+
+    stats = BrokerStats(['mn.{}{}'.format(BROKER_TYPE, b_id) for b_id in range(CLUSTER_SIZE)],
+                        log_path=os.path.join(path, 'stats_{}.txt'.format(topics)))
+    stats.start()
+    time.sleep(args.settle)
+    empty = time.time()
+
+    output = publish(config, 'retained_{}_pub'.format(topics), topics, ['--retain'])
+    fields = parse_brief(output)
+    preloaded = int(fields[BRIEF_PUBLISHED]) if fields else 0
+    preload_rate = round(float(fields[BRIEF_PUB_THROUGHPUT]), 1) if fields else 0
+    loaded = time.time()
+    time.sleep(args.settle)
+    growth = broker_memory(stats, loaded, time.time()) - broker_memory(stats, empty - args.settle, empty)
+    print("Preloaded {} retained messages at {} msg/s, brokers +{:.1f} MB".format(preloaded, preload_rate, growth))
+
+    # Every broker gets its subscribers at the same time, the cluster serves them all together
+    targets = [b_id for b_id in range(CLUSTER_SIZE) if args.include_source or b_id != args.source]
+    subscribers = [subprocess.Popen(client_cmd(b_id, config, 'retained_{}_sub{}'.format(topics, b_id),
+                                               ['--sub-clients', str(args.subscribers), '--sub-idle', str(args.idle),
+                                                '--sub-timeout', str(args.timeout)]),
+                                    stdout=subprocess.PIPE, universal_newlines=True)
+                   for b_id in targets]
+    outputs = [process.communicate()[0] for process in subscribers]
+    stats.stop()
+    if not args.keep:
+        publish(config, 'retained_{}_clear'.format(topics), topics, ['--clear-retained'])
+
+    with open(os.path.join(path, 'output_{}.txt'.format(topics)), 'w') as f:
+        f.write('\n'.join([output] + outputs))
+    # A preload limited by the publishers only slows the preload down, the subscribers are what is compared
+    bound = any(generator_bound(parse_brief(output)) for output in outputs)
+    rows = []
+    for b_id in targets:
+        retained = fetch_json('mn.sub{}'.format(b_id), 'retained_{}_sub{}'.format(topics, b_id), 'retained') or {}
+        last = retained.get('last_p50_ms')
+        rows.append([topics, args.source, b_id, args.subscribers, retained.get('subscribers', 0),
+                     retained.get('min', 0), retained.get('max', 0), retained.get('first_p50_ms'),
+                     retained.get('first_max_ms'), last, retained.get('last_max_ms'),
+                     round(retained.get('min', 0) / last * 1e3, 1) if last else 0, preloaded, preload_rate,
+                     round(growth, 1), round(growth * 10 ** 6 / preloaded, 1) if preloaded else 0])
+    return bound, rows
+
+
+def main():
+    path = "experiments/{day}/retained/{type}/{minute}/".format(day=START_DAY, type=BROKER_TYPE,
+                                                                minute=START_MINUTE)
+    Path(path).mkdir(parents=True, exist_ok=True)
+    print("++ Directory path: {}".format(path))
+
+    summary = SummaryFile(path, SUMMARY_HEADER)
+    for topics in [int(topics) for topics in args.topics.split(',')]:
+        bound, rows = run_size(topics, path)
+        for row in rows:
+            summary.add(row, bound)
+    summary.close()
+    summary.show()
+
+
+if __name__ == "__main__":
+    print(">>> Retained messages experiment <<<")
+    START_DAY = datetime.now().strftime("%m-%d")
+    START_MINUTE = datetime.now().strftime("%H%M%S")
+    args = arg_parse()
+    BROKER_TYPE = args.BROKER_TYPE
+    CLUSTER_SIZE = args.num_broker or get_cluster_size()
+    main()
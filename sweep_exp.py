@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+
+from broker_stats import BrokerStats
+from client_results import (BRIEF_DUPLICATES, BRIEF_MISSING, BRIEF_PUB_THROUGHPUT, BRIEF_PUBLISHED, BRIEF_RECEIVED,
+                            BRIEF_SUB_THROUGHPUT, SummaryFile, fetch_histogram, generator_bound, merge_histograms,
+                            parse_brief)
+from watch_metrics import MetricsWatcher
+
+# Smallest payload of container_python.py: the binary header (payload.HEADER_SIZE)
+MIN_SIZE = 68
+# Seconds given to the subscribers to subscribe before the publishers start
+SUBSCRIBE_TIME = 10
+
+SUMMARY_HEADER = 'size_bytes;messages;published;delivered;missing;duplicates;pub_msg_s;delivered_msg_s;delivered_mb_s;' \
+                 'e2e_p50_us;e2e_p99_us;e2e_p99.9_us;e2e_max_us;broker_cpu_mean;broker_cpu_max;broker_mem_max_mb;aborted'
+
+
+def get_cluster_size():
+    import docker
+    client = docker.from_env()
+    size = 0
+    for container in client.containers.list():
+        if not any(x in container.attrs['Name'] for x in ['pub', 'sub']):
+            size += 1
+    return size
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Payload size sweep')
+    parser.add_argument('-t', '--type', dest='BROKER_TYPE', required=True,
+                        help='Cluster type')
+    parser.add_argument('-b', '--brokers', dest='num_broker', default=None,
+                        help='cluster size, by default the running broker containers', type=int)
+    parser.add_argument('--min-size', dest='min_size', default=64, type=int,
+                        help='smallest payload (bytes), raised to the {} bytes of the header'.format(MIN_SIZE))
+    parser.add_argument('--max-size', dest='max_size', default=4 * 2 ** 20, type=int,
+                        help='largest payload (bytes)')
+    parser.add_argument('--factor', dest='factor', default=4, type=float,
+                        help='ratio between two consecutive sizes')
+    parser.add_argument('-s', '--subscribers', dest='subscribers', default=5,
+                        help='subscribers per broker', type=int)
+    parser.add_argument('-p', '--publishers', dest='publishers', default=5,
+                        help='publishers per broker', type=int)
+    parser.add_argument('-m', '--messages', dest='messages', default=2000,
+                        help='messages per publisher', type=int)
+    parser.add_argument('--max-bytes', dest='max_bytes', default=500 * 2 ** 20, type=int,
+                        help='bytes each publisher sends at most per size, fewer messages for the large sizes')
+    parser.add_argument('-r', '--rate', dest='rate', default=0, type=float,
+                        help='messages/s of each publisher, 0 (default) sends back to back')
+    parser.add_argument('-q', '--qos', dest='qos', default=0, type=int)
+    parser.add_argument('--idle', dest='idle', default=5, type=float,
+                        help='seconds without messages after which a subscriber stops')
+    parser.add_argument('--metrics-port', dest='metrics_port', default=0, type=int,
+                        help='watch the live metrics of the clients (publishers on the next port), off by default')
+    parser.add_argument('--abort-p99', dest='abort_p99', default=0, type=float,
+                        help='with --metrics-port, stop a size when the e2e p99 goes above this (us)')
+    parser.add_argument('--stall', dest='stall', default=30, type=float,
+                        help='with --metrics-port, stop a size after this many seconds without messages')
+    return parser.parse_args()
+
+
+def payload_sizes(min_size, max_size, factor):
+    """Geometric series of payload sizes from min_size to max_size (both included)"""
+    sizes = []
+    size = float(min_size)
+    while round(size) < max_size:
+        sizes.append(max(int(round(size)), MIN_SIZE))
+        size *= factor
+    sizes.append(max_size)
+    return sorted(set(sizes))
+
+
+def client_cmd(broker_id, topic, description, role_args):
+    return ['docker', 'exec', 'mn.sub{}'.format(broker_id), 'python3', 'container_python.py',
+            '--hostname', '10.0.{}.100'.format(broker_id), '--topic', topic, '--qos', str(args.qos),
+            '--no-raw-log', '--brief', '--description', description] + role_args
+
+
+def metrics_args(offset):
+    return ['--metrics-port', str(args.metrics_port + offset)] if args.metrics_port else []
+
+
+def run_size(size, path):
+    messages = max(1, min(args.messages, args.max_bytes // size))
+    # A topic per size, nothing left over from the previous size reaches the subscribers
+    topic = 'sweep/{}'.format(size)
+    description = 'sweep_{}'.format(size)
+    print()
+    print("-" * 80)
+    print("++ Payload {} bytes, {} messages per publisher".format(size, messages))
+    print("-" * 80)
+
+    stats = BrokerStats(['mn.{}{}'.format(BROKER_TYPE, b_id) for b_id in range(CLUSTER_SIZE)],
+                        log_path=os.path.join(path, 'stats_{}.txt'.format(size)))
+    stats.start()
+    subscribers = [subprocess.Popen(client_cmd(b_id, topic, description + '_sub',
+                                               ['--sub-clients', str(args.subscribers),
+                                                '--sub-idle', str(args.idle)] + metrics_args(0)),
+                                    stdout=subprocess.PIPE, universal_newlines=True)
+                   for b_id in range(CLUSTER_SIZE)]
+    time.sleep(SUBSCRIBE_TIME)
+
+    watcher = None
+    if args.metrics_port:
+        # A size that saturates the cluster is stopped early instead of running to the end
+        watcher = MetricsWatcher([('mn.sub{}'.format(b_id), args.metrics_port + offset)
+                                  for b_id in range(CLUSTER_SIZE) for offset in [0, 1]],
+                                 abort_p99=args.abort_p99, stall=args.stall)
+        watcher.start()
+    start = time.time()
+    publishers = [subprocess.Popen(client_cmd(b_id, topic, description + '_pub',
+                                              ['--pub-clients', str(args.publishers), '--pub-count', str(messages),
+                                               '--rate', str(args.rate), '--msg-size', str(size)] +
+                                              metrics_args(1)),
+                                   stdout=subprocess.PIPE, universal_newlines=True)
+                  for b_id in range(CLUSTER_SIZE)]
+    pub_outputs = [process.communicate()[0] for process in publishers]
+    sub_outputs = [process.communicate()[0] for process in subscribers]
+    # The subscribers stop idle seconds after their last message
+    end = time.time() - args.idle
+    stats.stop()
+    aborted = None
+    if watcher is not None:
+        watcher.stop()
+        aborted = watcher.aborted
+
+    with open(os.path.join(path, 'output_{}.txt'.format(size)), 'w') as f:
+        f.write('\n'.join(sub_outputs + pub_outputs))
+
+    published = pub_rate = delivered = delivered_rate = missing = duplicates = 0
+    for output in pub_outputs:
+        fields = parse_brief(output)
+        if fields:
+            published += int(fields[BRIEF_PUBLISHED])
+            pub_rate += float(fields[BRIEF_PUB_THROUGHPUT])
+    for output in sub_outputs:
+        fields = parse_brief(output)
+        if fields:
+            delivered += int(fields[BRIEF_RECEIVED])
+            delivered_rate += float(fields[BRIEF_SUB_THROUGHPUT])
+            if len(fields) > BRIEF_DUPLICATES:
+                missing += int(fields[BRIEF_MISSING])
+                duplicates += int(fields[BRIEF_DUPLICATES])
+    latency = merge_histograms(fetch_histogram('mn.sub{}'.format(b_id), description + '_sub')
+                               for b_id in range(CLUSTER_SIZE))
+    e2e = latency.summary() if latency is not None else {}
+
+    brokers = stats.summary(start, end).values()
+    bound = any(generator_bound(parse_brief(output)) for output in pub_outputs + sub_outputs)
+    return bound, [size, messages, published, delivered, missing, duplicates, round(pub_rate, 1), round(delivered_rate, 1),
+            round(delivered_rate * size / 2 ** 20, 3), e2e.get('p50'), e2e.get('p99'), e2e.get('p99.9'),
+            e2e.get('max'), round(max([row['cpu_mean'] for row in brokers] or [0]), 1),
+            round(max([row['cpu_max'] for row in brokers] or [0]), 1),
+            round(max([row['mem_max'] for row in brokers] or [0]), 1), aborted or '']
+
+
+def main():
+    path = "experiments/{day}/sweep/{type}/{minute}/{qos}qos/".format(day=START_DAY, type=BROKER_TYPE,
+                                                                       minute=START_MINUTE, qos=args.qos)
+    Path(path).mkdir(parents=True, exist_ok=True)
+    print("++ Directory path: {}".format(path))
+
+    sizes = payload_sizes(args.min_size, args.max_size, args.factor)
+    print("Payload sizes: {}".format(sizes))
+    # The cluster keeps running between two sizes, the summary grows as the sizes complete
+    summary = SummaryFile(path, SUMMARY_HEADER)
+    for size in sizes:
+        bound, row = run_size(size, path)
+        summary.add(row, bound)
+        time.sleep(SUBSCRIBE_TIME / 2)
+    summary.close()
+    summary.show()
+
+
+if __name__ == "__main__":
+    print(">>> Payload size sweep <<<")
+    START_DAY = datetime.now().strftime("%m-%d")
+    START_MINUTE = datetime.now().strftime("%H%M%S")
+    args = arg_parse()
+    BROKER_TYPE = args.BROKER_TYPE
+    CLUSTER_SIZE = args.num_broker or get_cluster_size()
+    main()
@@ -0,0 +1,52 @@
+#!/bin/bash
+# Compares the CPU used by sub_thread.py against an older revision of it at the same message rate.
+# usage: ./compare_sub_cpu.sh <broker_ip> <old_revision> [clients] [messages_per_publisher] [delay]
+# e.g.:  ./compare_sub_cpu.sh 10.0.0.100 HEAD~1 10 60 1
+
+BROKER=$1
+OLD_REV=$2
+CLIENTS=${3:-10}
+MESSAGES=${4:-60}
+DELAY=${5:-1}
+TOPIC="cpu_compare"
+QOS=1
+
+if [ -z "$BROKER" ] || [ -z "$OLD_REV" ]; then
+  echo "usage: $0 <broker_ip> <old_revision> [clients] [messages_per_publisher] [delay]"
+  exit 2
+fi
+
+CLIENT_DIR="$(cd "$(dirname "$0")/../clients/alpine_container" && pwd)"
+WORK_DIR=$(mktemp -d)
+# sub_thread.py imports its sibling modules: each version runs from a copy of its whole client folder
+mkdir "$WORK_DIR"/old "$WORK_DIR"/new
+git -C "$CLIENT_DIR" archive "$OLD_REV" . | tar -x -C "$WORK_DIR"/old || exit 1
+cp "$CLIENT_DIR"/*.py "$WORK_DIR"/new/
+
+# every subscriber receives the messages of all the publishers
+SUB_MESSAGES=$((CLIENTS*MESSAGES))
+TIMEFORMAT="%U %S %R"
+
+for version in old new; do
+  ( time python3 "$WORK_DIR"/$version/sub_thread.py -h "$BROKER" -t "$TOPIC" -q $QOS -c "$CLIENTS" \
+    -m "$SUB_MESSAGES" --folder "$WORK_DIR" --file-name "$version" > "$WORK_DIR"/out_$version \
+    2> "$WORK_DIR"/err_$version ) 2> "$WORK_DIR"/time_$version &
+  SUB_PID=$!
+  sleep 2
+  python3 "$CLIENT_DIR"/pub_thread.py -h "$BROKER" -t "$TOPIC" -q $QOS -c "$CLIENTS" -m "$MESSAGES" -d "$DELAY" \
+    > /dev/null
+  wait $SUB_PID
+  STATUS=$?
+  # sub_thread.py exits with 1 at the end of a normal run too, a crash never gets to the done line
+  if [ $STATUS -gt 1 ] || ! grep -q "is done receiving" "$WORK_DIR"/out_$version; then
+    echo "$version: sub_thread.py failed (exit status $STATUS), no result" >&2
+    cat "$WORK_DIR"/err_$version >&2
+    rm -rf "$WORK_DIR"
+    exit 1
+  fi
+  read -r USER_CPU SYS_CPU WALL < "$WORK_DIR"/time_$version
+  echo "$version: user ${USER_CPU}s sys ${SYS_CPU}s wall ${WALL}s" \
+    "($(awk "BEGIN {printf \"%.1f\", 100 * ($USER_CPU + $SYS_CPU) / $WALL}")% of one core)"
+done
+
+rm -rf "$WORK_DIR"
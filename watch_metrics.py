@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import argparse
+import re
+import subprocess
+import threading
+import time
+
+# A sample line of the Prometheus text format: name{labels} value
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*(?:\{[^}]*\})?)\s+(\S+)')
+RECEIVED = 'mqttbench_messages_received_total'
+PUBLISHED = 'mqttbench_messages_published_total'
+BYTES_RECEIVED = 'mqttbench_bytes_received_total'
+CONNECTED = ['mqttbench_subscribers_connected', 'mqttbench_publishers_connected']
+P99 = 'mqttbench_e2e_delay_us{quantile="0.99"}'
+
+
+def parse_metrics(text):
+    """{name or name{labels}: value} of a metrics page, the comments are skipped"""
+    result = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match is None:
+            continue
+        try:
+            result[match.group(1)] = float(match.group(2))
+        except ValueError:
+            continue
+    return result
+
+
+def scrape(container, port, timeout=5):
+    """The metrics of the client serving on port in a container, None if it does not answer"""
+    cmd = ['docker', 'exec', container, 'wget', '-qO-', '-T', str(timeout),
+           'http://127.0.0.1:{}/metrics'.format(port)]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True, timeout=timeout + 5)
+    except subprocess.TimeoutExpired:
+        return None
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return parse_metrics(result.stdout)
+
+
+class MetricsWatcher(threading.Thread):
+    """Scrapes the live metrics of some clients ((container, port) targets) every
+    interval seconds and prints their rates. The run is stopped (the clients
+    matching kill_pattern are killed in every container) when the e2e p99 of a
+    client goes above abort_p99 us, or when nothing is received nor published for
+    stall seconds after the first message; 0 turns a check off. It ends once none
+    of the clients that answered before answers anymore"""
+
+    def __init__(self, targets, interval=2.0, abort_p99=0, stall=0, kill_pattern='container_python.py',
+                 verbose=True):
+        super(MetricsWatcher, self).__init__(daemon=True)
+        self.targets = list(targets)
+        self.interval = interval
+        self.abort_p99 = abort_p99
+        self.stall = stall
+        self.kill_pattern = kill_pattern
+        self.verbose = verbose
+        # target -> [(time, metrics)]
+        self.samples = {target: [] for target in self.targets}
+        self.aborted = None
+        self._halt = threading.Event()
+
+    def run(self):
+        started = time.time()
+        last_change = None
+        last_total = 0
+        while not self._halt.wait(self.interval):
+            now = time.time()
+            lines = []
+            total = 0
+            for target in self.targets:
+                metrics = scrape(*target)
+                if metrics is None:
+                    continue
+                previous = self.samples[target][-1] if self.samples[target] else None
+                self.samples[target].append((now, metrics))
+                total += metrics.get(RECEIVED, 0) + metrics.get(PUBLISHED, 0)
+                lines.append(self.describe(target, metrics, previous))
+                if self.abort_p99 and metrics.get(P99, 0) > self.abort_p99:
+                    self.abort('e2e p99 of {} is {:.0f} us'.format(target[0], metrics[P99]))
+            if self.verbose and lines:
+                print('[{:7.1f} s] {}'.format(now - started, ' | '.join(lines)), flush=True)
+            if total != last_total:
+                last_total = total
+                last_change = now
+            elif self.stall and last_change is not None and lines and now - last_change >= self.stall:
+                self.abort('no message for {:.0f} s'.format(now - last_change))
+            if self.aborted or (not lines and any(self.samples.values())):
+                # Stopped, or all the clients are done
+                break
+
+    @staticmethod
+    def describe(target, metrics, previous):
+        if previous is None:
+            rates = (0, 0, 0)
+        else:
+            length = max(time.time() - previous[0], 1e-3)
+            rates = tuple((metrics.get(name, 0) - previous[1].get(name, 0)) / length
+                          for name in [RECEIVED, PUBLISHED, BYTES_RECEIVED])
+        return '{} rx {:.0f}/s tx {:.0f}/s {:.2f} MB/s p99 {:.0f} us conn {:.0f}'.format(
+            target[0], rates[0], rates[1], rates[2] / 2 ** 20, metrics.get(P99, 0),
+            sum(metrics.get(name, 0) for name in CONNECTED))
+
+    def abort(self, reason):
+        self.aborted = reason
+        print('!! Stopping the run: {}'.format(reason), flush=True)
+        for container in sorted(set(target[0] for target in self.targets)):
+            subprocess.run(['docker', 'exec', container, 'pkill', '-f', self.kill_pattern],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        self._halt.set()
+        self.join(self.interval + 15)
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Watches the live metrics of running clients '
+                                                 '(container_python.py or sub_thread.py --metrics-port)')
+    parser.add_argument('targets', nargs='+', help='<container>:<port>, e.g. mn.sub0:9100')
+    parser.add_argument('-i', '--interval', dest='interval', default=2, type=float)
+    parser.add_argument('--abort-p99', dest='abort_p99', default=0, type=float,
+                        help='stop the clients when the e2e p99 of one goes above this (us)')
+    parser.add_argument('--stall', dest='stall', default=0, type=float,
+                        help='stop the clients after this many seconds without messages')
+    parser.add_argument('--kill', dest='kill_pattern', default='container_python.py',
+                        help='command line of the clients to stop')
+    return parser.parse_args()
+
+
+def main():
+    args = arg_parse()
+    targets = [(target.rsplit(':', 1)[0], int(target.rsplit(':', 1)[1])) for target in args.targets]
+    watcher = MetricsWatcher(targets, args.interval, args.abort_p99, args.stall, args.kill_pattern)
+    watcher.start()
+    try:
+        while watcher.is_alive():
+            watcher.join(1)
+    except KeyboardInterrupt:
+        watcher.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import json
+import os
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+
+from broker_stats import BrokerStats
+from client_results import (BRIEF_PUBLISHED, BRIEF_RECEIVED, SummaryFile, fetch_histogram, generator_bound,
+                            merge_histograms, parse_brief)
+
+# Wildcard mixes run by default, see WILDCARD_DEFAULTS in topic_workload.py for the parameters
+SCENARIOS = {
+    'literal': {'mix': {'literal': 1}},
+    'plus': {'mix': {'plus': 1}},
+    'hash': {'mix': {'hash': 1}},
+    'mixed': {'mix': {'literal': 0.2, 'plus': 0.5, 'hash': 0.3}},
+    'deep_plus': {'depth': 8, 'plus_levels': 3, 'mix': {'plus': 1}},
+}
+
+# Seconds given to the subscribers to subscribe before the publishers start
+SUBSCRIBE_TIME = 10
+SUMMARY_HEADER = 'scenario;depth;filters;subscribers;publishers;published;delivered;deliveries_per_msg;' \
+                 'e2e_p50_us;e2e_p99_us;e2e_max_us;broker_cpu_s;broker_cpu_us_per_delivery;broker_mem_max_mb'
+
+
+def get_cluster_size():
+    import docker
+    client = docker.from_env()
+    size = 0
+    for container in client.containers.list():
+        if not any(x in container.attrs['Name'] for x in ['pub', 'sub']):
+            size += 1
+    return size
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description='Wildcard matching experiment')
+    parser.add_argument('-t', '--type', dest='BROKER_TYPE', required=True,
+                        help='Cluster type')
+    parser.add_argument('-b', '--brokers', dest='num_broker', default=None,
+                        help='cluster size, by default the running broker containers', type=int)
+    parser.add_argument('--scenarios', dest='scenarios', default=None,
+                        help='JSON file {name: wildcards section}, by default the built-in mixes')
+    parser.add_argument('--only', dest='only', default=None,
+                        help='comma separated scenarios to run')
+    parser.add_argument('-s', '--subscribers', dest='subscribers', default=200,
+                        help='subscribers per broker', type=int)
+    parser.add_argument('-f', '--filters', dest='filters', default=5,
+                        help='filters per subscriber', type=int)
+    parser.add_argument('-p', '--publishers', dest='publishers', default=10,
+                        help='publishers per broker', type=int)
+    parser.add_argument('--topics-per-pub', dest='topics_per_pub', default=10, type=int)
+    parser.add_argument('--matching', dest='matching', default=0.5, type=float,
+                        help='share of the published topics matching some filter')
+    parser.add_argument('-m', '--messages', dest='messages', default=1000,
+                        help='messages per publisher', type=int)
+    parser.add_argument('-r', '--rate', dest='rate', default=100, type=float,
+                        help='messages/s of each publisher')
+    parser.add_argument('-q', '--qos', dest='qos', default=0, type=int)
+    parser.add_argument('--idle', dest='idle', default=5, type=float,
+                        help='seconds without messages after which a subscriber stops')
+    parser.add_argument('--seed', dest='seed', default=1, type=int)
+    return parser.parse_args()
+
+
+def load_scenarios(args):
+    scenarios = SCENARIOS
+    if args.scenarios:
+        with open(args.scenarios) as f:
+            scenarios = json.load(f)
+    if args.only:
+        scenarios = {name: scenarios[name] for name in args.only.split(',')}
+    return scenarios
+
+
+def wildcard_section(args, scenario, broker_id):
+    section = {
+        'subs': args.subscribers,
+        'filters_per_sub': args.filters,
+        'pubs': args.publishers,
+        'topics_per_pub': args.topics_per_pub,
+        'matching': args.matching,
+        # Every broker gets its own filters, reproducible across runs
+        'seed': args.seed + broker_id,
+    }
+    section.update(copy.deepcopy(scenario))
+    return section
+
+
+def client_cmd(broker_id, config, description, role_args):
+    return ['docker', 'exec', 'mn.sub{}'.format(broker_id), 'python3', 'container_python.py',
+            '--hostname', '10.0.{}.100'.format(broker_id), '--multiple-topics', config,
+            '--qos', str(args.qos), '--no-raw-log', '--brief', '--description', description] + role_args
+
+
+def run_scenario(name, scenario, path):
+    print()
+    print("-" * 80)
+    print("++ Scenario {}: {}".format(name, scenario))
+    print("-" * 80)
+    configs = []
+    for b_id in range(CLUSTER_SIZE):
+        config = os.path.join(path, 'wildcards_{}.json'.format(b_id))
+        with open(config, 'w') as f:
+            json.dump({'wildcards': wildcard_section(args, scenario, b_id)}, f, indent=2)
+        configs.append(config)
+
+    stats = BrokerStats(['mn.{}{}'.format(BROKER_TYPE, b_id) for b_id in range(CLUSTER_SIZE)],
+                        log_path=os.path.join(path, 'stats.txt'))
+    stats.start()
+
+    # The experiments folder is mounted in the working directory of the client containers
+    subscribers = []
+    for b_id, config in enumerate(configs):
+        cmd = client_cmd(b_id, config, 'wild_{}_sub'.format(name),
+                         ['--sub-clients', str(args.subscribers), '--sub-idle', str(args.idle)])
+        subscribers.append(subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True))
+        print("Subscribers of broker {} created".format(b_id))
+    time.sleep(SUBSCRIBE_TIME)
+
+    start = time.time()
+    publishers = []
+    for b_id, config in enumerate(configs):
+        cmd = client_cmd(b_id, config, 'wild_{}_pub'.format(name),
+                         ['--pub-clients', str(args.publishers), '--pub-count', str(args.messages),
+                          '--rate', str(args.rate)])
+        publishers.append(subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True))
+    pub_outputs = [process.communicate()[0] for process in publishers]
+    sub_outputs = [process.communicate()[0] for process in subscribers]
+    # The subscribers stop idle seconds after their last message
+    end = time.time() - args.idle
+    stats.stop()
+
+    for role, outputs in [('sub', sub_outputs), ('pub', pub_outputs)]:
+        for b_id, output in enumerate(outputs):
+            with open(os.path.join(path, 'output_{}{}.txt'.format(role, b_id)), 'w') as f:
+                f.write(output)
+
+    delivered = published = 0
+    for output in sub_outputs:
+        fields = parse_brief(output)
+        if fields:
+            delivered += int(fields[BRIEF_RECEIVED])
+    for output in pub_outputs:
+        fields = parse_brief(output)
+        if fields:
+            published += int(fields[BRIEF_PUBLISHED])
+    latency = merge_histograms(fetch_histogram('mn.sub{}'.format(b_id), 'wild_{}_sub'.format(name))
+                               for b_id in range(CLUSTER_SIZE))
+    e2e = latency.summary() if latency is not None else {'p50': None, 'p99': None, 'max': None}
+
+    brokers = stats.summary(start, end)
+    cpu_seconds = sum(row['cpu_seconds'] for row in brokers.values())
+    section = wildcard_section(args, scenario, 0)
+    bound = any(generator_bound(parse_brief(output)) for output in pub_outputs + sub_outputs)
+    return bound, [name, section.get('depth', 7), args.subscribers * args.filters * CLUSTER_SIZE,
+            args.subscribers * CLUSTER_SIZE, args.publishers * CLUSTER_SIZE, published, delivered,
+            round(delivered / published, 3) if published else 0, e2e['p50'], e2e['p99'], e2e['max'],
+            round(cpu_seconds, 3), round(cpu_seconds * 1e6 / delivered, 2) if delivered else None,
+            round(max([row['mem_max'] for row in brokers.values()] or [0]), 1)]
+
+
+def main():
+    scenarios = load_scenarios(args)
+    path = "experiments/{day}/wildcard/{type}/{minute}/".format(day=START_DAY, type=BROKER_TYPE,
+                                                                minute=START_MINUTE)
+    Path(path).mkdir(parents=True, exist_ok=True)
+    print("++ Directory path: {}".format(path))
+
+    summary = SummaryFile(path, SUMMARY_HEADER)
+    for name, scenario in scenarios.items():
+        scenario_path = os.path.join(path, name)
+        Path(scenario_path).mkdir(parents=True, exist_ok=True)
+        bound, row = run_scenario(name, scenario, scenario_path)
+        summary.add(row, bound)
+        time.sleep(SUBSCRIBE_TIME / 2)
+    summary.close()
+    summary.show()
+
+
+if __name__ == "__main__":
+    print(">>> Wildcard matching experiment <<<")
+    START_DAY = datetime.now().strftime("%m-%d")
+    START_MINUTE = datetime.now().strftime("%H%M%S")
+    args = arg_parse()
+    BROKER_TYPE = args.BROKER_TYPE
+    CLUSTER_SIZE = args.num_broker or get_cluster_size()
+    main()